@@ -2,7 +2,8 @@ import numpy as np
 import cv2
 import time
 import os
-import imutils
+
+from utils.occ.decode import binarize, decode_bits, is_valid, led_boxes, led_centers, led_grid, unpack
 
 my_track_method = cv2.legacy.TrackerCSRT_create()
 cap = cv2.VideoCapture(0)
@@ -50,98 +51,16 @@ while(True):
 
         #print('selec_box2222: ', select_box)
         img= frame[select_box[1]:select_box[1]+select_box[3],select_box[0]:select_box[0]+select_box[2]]
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        thres = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,9,-30)
-        thres1=cv2.resize(thres,(img.shape[1]*4,img.shape[0]*4))
-        #cv2.imshow('Thres',thres1)
-        contours = cv2.findContours(thres, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(contours)
-        contours = sorted(contours, key=cv2.contourArea, reverse=False)
-        #print('Contours',contours)
-        number = 0
-        ma =[[],[],[],[]]
-        td =[] 
-        for c in contours:
-            (x, y, w, h) = cv2.boundingRect(c)
-            # print(x, y, w, h)
-            #cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            # approximate the contour
-            if (3<w<20) and(3<h<20):
-                ma[0].append(x)
-                ma[1].append(y)
-                a =[x+w/2,y+h/2] #Tin toa do tam cua các box LED
-                td.append(a)
-                ma[2].append(w)
-                ma[3].append(h)
-                #if x==min(maX)and y==min(maY):
-                #cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 1)
-                #print(x, y, w, h)
-                number +=1
-        #print('Xmin: ',ma)
-        #Roi LED cạnh
-        # print('Td==',td)
-        xmin = min(ma[0])
-        # print('xmin==',xmin)
-        # print('X',ma[0])
-        xmax = max(ma[0])
-        # print('xmax==',xmax)
-        ymin = min(ma[1])
-        ymax = max(ma[1])
-        # print('ymin==',ymin)
-        # print('ymax==',ymax)
-        # print('Xlen',len(ma[0]))
-
-        #===================
-        # cv2.rectangle(img, (xmin, ymin), (xmin + 7, ymin + 7), (255, 0, 0), 1)
-        # cv2.rectangle(img, (xmin, ymax), (xmin + 7, ymax + 7), (255, 0, 0), 1)
-        # cv2.rectangle(img, (xmax, ymax), (xmax + 7, ymax + 7), (255, 0, 0), 1)
-        # cv2.rectangle(img, (xmax, ymin), (xmax + 7, ymin + 7), (255, 0, 0), 1)
-        
-
-        # Xu ly bit==========================================
-        bit=[]
-        dx = (xmax-xmin)/(8-1)
-        # print('dx=',dx)
-        dy = (ymax-ymin)/(8-1)
-        # print('dy=',dy)
-        c = ymin
-        while c <= ymax+1: 
-            # print('x=====',c)
-            b = xmin
-            while b <= xmax+1:
-                for j in td:
-                    if b <= j[0] <= b+dx and c <= j[1] <= c+dy:
-                        d=1
-                        break
-                    else:
-                        d=0
-                bit.append(d)
-
-
-                # print('y=======',b)----+++++++++++++++++++
-                b = b+dx
-            c +=dy
-
-       # print(len(bit),'==>',bit)
+        thres = binarize(img)
+        boxes = led_boxes(thres, wh=(3, 20))
+        number = len(boxes)
+        bit = decode_bits(led_centers(boxes), led_grid(boxes)) if number else np.zeros(64, dtype=np.uint8)
         print("Number of Contours found = " + str(number))
-        img1=cv2.resize(img,(img.shape[0]*4,img.shape[1]*4))
-        #cv2.imshow('Pix',img1)
-           # my_track_method.init(frame, select_box)
 
-        #cv2.putText(frame, "LED Tracking", (80, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-       # print('bit1==',type(bit[0]))
-        
     # Tính và hiển thị nhiệt độ và độ ẩm
-        tem = bit[8:16]
-        tem1 = sum(val*(2**idx) for idx, val in enumerate(reversed(tem)))
-        #print('tem==',tem1)
-        hum = bit[16:24]
-        hum1 = sum(val*(2**idx) for idx, val in enumerate(reversed(hum)))
-        dis = bit[24:32]
-        dis1 = sum(val*(2**idx) for idx, val in enumerate(reversed(dis)))
-        vib = bit[32:40]
-        vib1 = sum(val*(2**idx) for idx, val in enumerate(reversed(vib)))
-        if bit[0:8]==[1,0,1,1,1,0,0,1]:
+        payload = unpack(bit)
+        tem1, hum1, dis1, vib1 = payload['temperature'], payload['humidity'], payload['distance'], payload['vibration']
+        if is_valid(bit):
             cv2.putText(frame, "Temperature: " + str(tem1) +"*C", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
             cv2.putText(frame, "Humidity: " + str(hum1) + "%", (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
             cv2.putText(frame, "Distance: " + str(dis1) + "cm", (50,110 ), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
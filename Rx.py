@@ -1,167 +1,112 @@
+import argparse
 
 import numpy as np
 import cv2
-import time
-import os
-import imutils
 
-class OCC:
-    def __init__(self):
-        self.my_track_method = cv2.legacy.TrackerCSRT_create()
-        self.cap = cv2.VideoCapture(0)
-        self.cap.set(cv2.CAP_PROP_EXPOSURE, -15) 
-        self.cap.set(cv2.CAP_PROP_BRIGHTNESS, -60)
-        self.cap.set(cv2.CAP_PROP_SATURATION,40)
-        self.cap.set(cv2.CAP_PROP_CONTRAST, -10 )
+from utils.occ.decode import NUM_THREADS
+from utils.occ.pipeline import Pipeline, frames
+from utils.occ.temporal import CachedDecoder, SymbolDecoder
+from utils.occ.tracking import DetectorTracker, yolo_detector
 
-# Biến đếm, để chỉ lưu dữ liệu sau khoảng 60 frame, tránh lúc đầu chưa kịp cầm tiền lên
-    def __call__(self):    
-        i=0
-        ma_tam =[[],[],[],[]]
-        while(True):
-            # Capture frame-by-frame
-            #
-            i+=1
-            ret, frame = self.cap.read()
-            if not ret:
-                continue
-            #frame = cv2.resize(frame, dsize=None,fx=0.3,fy=0.3)
-            if i<10:
-                continue
-            if i==10:
-                cv2.imwrite("linh.png",frame)
-                select_box = cv2.selectROI(frame)
-                select_box1 = select_box 
-                print('selec_box: ', type(select_box[0]))
-                self.my_track_method.init(frame, select_box)
-            # Hiển thị
-            ret, select_box = self.my_track_method.update(frame)
-            if ret:
-                tl, br  = (int(select_box[0]), int(select_box[1])), (int(select_box[0] + select_box[2]), int(select_box[1] + select_box[3]))
-                cv2.rectangle(frame, tl, br, (0, 255, 0), 2, 2)
-                select_box = (int(select_box[0]), int(select_box[1]), int(select_box[2]), int(select_box[3]))
-                #print('ffff', int(select_box[0]))
-                # select_box1 = ()
-                # select_box1[0] = int(select_box[0])
-                # select_box1[1] = int(select_box[1])
-                # select_box1[2] = int(select_box[2])
-                # select_box1[3] = int(select_box[3])
-                #select_box = select_box
 
-                #print('selec_box2222: ', select_box)
-                img= frame[select_box[1]:select_box[1]+select_box[3],select_box[0]:select_box[0]+select_box[2]]
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                thres = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,9,-30)
-                thres1=cv2.resize(thres,(img.shape[1]*4,img.shape[0]*4))
-                #cv2.imshow('Thres',thres1)
-                contours = cv2.findContours(thres, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-                contours = imutils.grab_contours(contours)
-                contours = sorted(contours, key=cv2.contourArea, reverse=False)
-                #print('Contours',contours)
-                number = 0
-                ma =[[],[],[],[]]
-                td =[] 
-                for c in contours:
-                    (x, y, w, h) = cv2.boundingRect(c)
-                    # print(x, y, w, h)
-                    #cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                    # approximate the contour
-                    if (3<w<20) and(3<h<20):
-                        ma[0].append(x)
-                        ma[1].append(y)
-                        a =[x+w/2,y+h/2] #Tin toa do tam cua các box LED
-                        td.append(a)
-                        ma[2].append(w)
-                        ma[3].append(h)
-                        #if x==min(maX)and y==min(maY):
-                        #cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 1)
-                        #print(x, y, w, h)
-                        number +=1
-                        ma_tam=ma
-                    else:
-                        ma = ma_tam
-                #print('Xmin: ',ma)
-                #Roi LED cạnh
-                # print('Td==',td)
-                xmin = min(ma[0])
-                # print('xmin==',xmin)
-                # print('X',ma[0])
-                xmax = max(ma[0])
-                # print('xmax==',xmax)
-                ymin = min(ma[1])
-                ymax = max(ma[1])
-                # print('ymin==',ymin)
-                # print('ymax==',ymax)
-                # print('Xlen',len(ma[0]))
+class OCC:
+    # Bộ thu OCC: capture -> tracking -> decode chạy song song qua Pipeline, hiển thị ở luồng chính
+    # weights: YOLOv5 phát hiện tấm LED (tự động, không cần chọn ROI bằng tay), tracker nhẹ chạy giữa các lần phát hiện
+    def __init__(self, source=0, view=True, roi=None, workers=NUM_THREADS, buffer=8, weights=None, interval=30,
+                 min_score=0.6, imgsz=640, conf_thres=0.25, device='', hold=None):
+        self.view = view  # headless nếu False
+        self.roi = roi  # ROI ban đầu (x, y, w, h), None = YOLO, chọn bằng tay (view) hoặc cả khung hình
+        detect = yolo_detector(weights, device, imgsz, conf_thres) if weights else None
+        self.my_track_method = DetectorTracker(detect, interval=interval, min_score=min_score)
+        if isinstance(source, int) or str(source).isnumeric():  # camera
+            source = cv2.VideoCapture(int(source))
+            source.set(cv2.CAP_PROP_EXPOSURE, -15)
+            source.set(cv2.CAP_PROP_BRIGHTNESS, -60)
+            source.set(cv2.CAP_PROP_SATURATION, 40)
+            source.set(cv2.CAP_PROP_CONTRAST, -10)
+        self.source = source
+        self.workers, self.buffer = workers, buffer
+        self.hold = hold  # số frame mỗi symbol nếu biết trước (FPS camera / tốc độ symbol), None = tự đồng bộ
 
-                #===================
-                # cv2.rectangle(img, (xmin, ymin), (xmin + 7, ymin + 7), (255, 0, 0), 1)
-                # cv2.rectangle(img, (xmin, ymax), (xmin + 7, ymax + 7), (255, 0, 0), 1)
-                # cv2.rectangle(img, (xmax, ymax), (xmax + 7, ymax + 7), (255, 0, 0), 1)
-                # cv2.rectangle(img, (xmax, ymin), (xmax + 7, ymin + 7), (255, 0, 0), 1)
-                
+    def __call__(self):
+        source = frames(self.source)
+        # Bỏ 9 frame đầu để camera ổn định phơi sáng
+        n, frame = 0, None
+        for n, frame in enumerate(source, 1):
+            if n == 10:
+                break
+        if n < 10:  # nguồn hết frame trước khi ổn định, không còn gì để chọn ROI hay giải mã
+            raise RuntimeError(f'Source ended after {n} frames, 10 needed for camera warm-up')
+        manual = self.my_track_method.detect is None
+        if self.roi is None and self.view and manual:
+            cv2.imwrite("linh.png", frame)
+            self.roi = cv2.selectROI(frame)
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            self.my_track_method.seed((x, y, x + w, y + h))
+        locate = self.my_track_method if self.roi is not None or not manual else None  # None: cả khung hình
 
-                # Xu ly bit==========================================
-                bit=[]
-                dx = (xmax-xmin)/(8-1)
-                # print('dx=',dx)
-                dy = (ymax-ymin)/(8-1)
-                # print('dy=',dy)
-                c = ymin
-                while c <= ymax+1: 
-                    # print('x=====',c)
-                    b = xmin
-                    while b <= xmax+1:
-                        for j in td:
-                            if b <= j[0] <= b+dx and c <= j[1] <= c+dy:
-                                d=1
-                                break
-                            else:
-                                d=0
-                        bit.append(d)
+        pipe = Pipeline(source, locate=locate, decode=CachedDecoder(wh=(3, 20)), workers=self.workers,
+                        buffer=self.buffer, drop=isinstance(self.source, cv2.VideoCapture))
+        symbols = SymbolDecoder(max_frames=self.hold)  # bỏ phiếu nhiều frame cho mỗi symbol, thay cho bit_tam
+        symbol = None  # symbol hợp lệ gần nhất
+        for r in pipe:
+            frame = r.frame
+            for _, symbol in symbols.update(r.bits, r.levels, r.seq):
+                if not self.view:
+                    print(f'{symbol.seq}: {symbol.payload} confidence={symbol.confidence:.2f} frames={symbol.frames}')
+            if not self.view:
+                continue
+            if len(r.boxes):
+                print("Number of Contours found = " + str(int(r.leds[0])))
+                x1, y1, x2, y2 = (int(x) for x in r.boxes[0])
+                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2, 2)
+            else:
+                cv2.putText(frame, "Object can not be tracked!", (80, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
 
+            # Tính và hiển thị nhiệt độ và độ ẩm
+            if symbol is not None:
+                tem1, hum1, dis1 = symbol.payload['temperature'], symbol.payload['humidity'], symbol.payload['distance']
+                cv2.putText(frame, "Temperature: " + str(tem1) +"*C", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(frame, "Humidity: " + str(hum1) + "%", (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(frame, "Distance: " + str(dis1) + "cm", (50,110 ), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.putText(frame, f"Confidence: {symbol.confidence:.2f}", (50, 140), cv2.FONT_HERSHEY_SIMPLEX, 1,
+                            (0, 255, 0), 2)
 
-                        # print('y=======',b)
-                        b = b+dx
-                    c +=dy
+            cv2.imshow('frame', frame)
+            key = cv2.waitKey(1) & 0xFF  # đọc phím một lần mỗi frame
+            if key == ord('q'):
+                pipe.stop()
+            elif key == ord('r'):
+                x, y, w, h = cv2.selectROI(frame)
+                self.my_track_method.seed((x, y, x + w, y + h))
+        for _, symbol in symbols.flush():
+            if not self.view:
+                print(f'{symbol.seq}: {symbol.payload} confidence={symbol.confidence:.2f} frames={symbol.frames}')
+        print(pipe.stats())
+        return pipe
 
-               # print(len(bit),'==>',bit)
-                print("Number of Contours found = " + str(number))
-                img1=cv2.resize(img,(img.shape[0]*4,img.shape[1]*4))
-                #cv2.imshow('Pix',img1)
-                   # my_track_method.init(frame, select_box)
 
-                #cv2.putText(frame, "LED Tracking", (80, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-               # print('bit1==',type(bit[0]))
-                
-            # Tính và hiển thị nhiệt độ và độ ẩm
-                tem = bit[8:16]
-                tem1 = sum(val*(2**idx) for idx, val in enumerate(reversed(tem)))
-                #print('tem==',tem1)
-                hum = bit[16:24]
-                hum1 = sum(val*(2**idx) for idx, val in enumerate(reversed(hum)))
-                dis = bit[24:32]
-                dis1 = sum(val*(2**idx) for idx, val in enumerate(reversed(dis)))
-                if bit[0:8]==[1,0,1,1,1,0,0,1]:
-                    cv2.putText(frame, "Temperature: " + str(tem1) +"*C", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                    cv2.putText(frame, "Humidity: " + str(hum1) + "%", (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                    cv2.putText(frame, "Distance: " + str(dis1) + "cm", (50,110 ), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                cv2.imshow('frame',frame)
-            else:
-                cv2.putText(frame, "Object can not be tracked!", (80, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                cv2.imshow('frame',frame)
-               # continue
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default='0', help='camera index or video file')
+    parser.add_argument('--roi', nargs=4, type=int, default=None, help='initial LED panel ROI x y w h')
+    parser.add_argument('--headless', action='store_true', help='do not display frames')
+    parser.add_argument('--workers', type=int, default=NUM_THREADS, help='decode threads')
+    parser.add_argument('--buffer', type=int, default=8, help='capture ring-buffer length')
+    parser.add_argument('--weights', type=str, default=None, help='YOLOv5 LED-panel model, seeds the tracker')
+    parser.add_argument('--interval', type=int, default=30, help='frames between detector runs while tracking')
+    parser.add_argument('--min-score', type=float, default=0.6, help='tracker confidence to re-run the detector')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--hold', type=int, default=None, help='frames per symbol if known, default detect boundaries')
+    return parser.parse_args()
 
-            if (cv2.waitKey(1) & 0xFF == ord('q')):
-                break
-            if cv2.waitKey(1) & 0xFF == ord('r'):
-                select_box =cv2.selectROI(frame)
-                self.my_track_method.clear()
-                self.my_track_method = cv2.legacy.TrackerCSRT_create()
-                self.my_track_method.init(frame,select_box)
-                #continue
 
-        # When everything done, release the capture
 if __name__=='__main__':
-    occ=OCC()
-    occ()
\ No newline at end of file
+    opt = parse_opt()
+    occ=OCC(opt.source, view=not opt.headless, roi=opt.roi, workers=opt.workers, buffer=opt.buffer, weights=opt.weights,
+            interval=opt.interval, min_score=opt.min_score, imgsz=opt.imgsz, conf_thres=opt.conf_thres, device=opt.device,
+            hold=opt.hold)
+    occ()
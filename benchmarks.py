@@ -23,15 +23,38 @@ Requirements:
 
 Usage:
     $ python benchmarks.py --weights yolov5s.pt --img 640
+
+Usage - LoadStreams preprocessing, numpy letterbox vs BatchLetterBox, 16 streams of 1280x720 frames:
+    $ python benchmarks.py --preprocess --img 640 --batch-size 16 --device 0
+
+Usage - ComputeLoss.build_targets() share of the train step, 10 to 500 labels per image:
+    $ python benchmarks.py --loss --img 640 --batch-size 16 --device 0
+
+Usage - Detect() inference decode, per-layer cat vs fused in-place decode with cached grids, over rect batch shapes:
+    $ python benchmarks.py --decode --img 640 --batch-size 16 --device 0
+
+Usage - --augment latency vs mAP, single-scale vs TTA views in sequential or packed forwards vs weighted box fusion:
+    $ python benchmarks.py --tta --weights yolov5s.pt --data coco128.yaml --img 640 --batch-size 16 --device 0
+
+Usage - inference-only import time in fresh interpreters, fails if heavy optional modules are imported:
+    $ python benchmarks.py --imports --weights yolov5s.pt --hard-fail
+
+Usage - utils/serving.py endpoint p50/p99 latency vs throughput, 1 vs up to 16 images per forward:
+    $ python benchmarks.py --serve --weights yolov5s.pt --img 640 --batch-size 16 --device 0
 """
 
 import argparse
+import json
 import platform
+import subprocess
 import sys
+import threading
 import time
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import torch
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLOv5 root directory
@@ -41,13 +64,20 @@ if str(ROOT) not in sys.path:
 
 import export
 from models.experimental import attempt_load
-from models.yolo import SegmentationModel
+from models.yolo import DetectionModel, Model, SegmentationModel
 from segment.val import run as val_seg
 from utils import notebook_init
-from utils.general import LOGGER, check_yaml, file_size, print_args
+from utils.augmentations import BatchLetterBox, letterbox
+from utils.dataloaders import create_dataloader
+from utils.general import (LOGGER, check_dataset, check_yaml, file_size, non_max_suppression, print_args,
+                           yaml_load)
+from utils.loss import ComputeLoss
+from utils.serving import BatchServer, endpoint, load
 from utils.torch_utils import select_device
 from val import run as val_det
 
+pd.options.display.max_columns = 10
+
 
 def run(
         weights=ROOT / 'yolov5s.pt',  # weights path
@@ -143,6 +173,303 @@ def test(
     return py
 
 
+def preprocess(
+        imgsz=640,  # inference size (pixels)
+        batch_size=16,  # number of streams
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        shape=(720, 1280),  # stream frame shape (h, w)
+        n=20,  # iterations
+):
+    # Benchmark LoadStreams.__next__() + detect.run() preprocessing: numpy letterbox path vs BatchLetterBox
+    device = select_device(device)
+    cuda = device.type == 'cuda'
+    ims = [np.random.randint(0, 256, (*shape, 3), dtype=np.uint8) for _ in range(batch_size)]
+
+    def numpy_path():
+        im = np.stack([letterbox(x, imgsz, stride=32, auto=True)[0] for x in ims])  # LoadStreams.__next__()
+        im = np.ascontiguousarray(im[..., ::-1].transpose((0, 3, 1, 2)))
+        im = torch.from_numpy(im).to(device)  # detect.run()
+        im = im.half() if half else im.float()
+        im /= 255
+        return im
+
+    y, x0 = [], None
+    for name, f in ('letterbox (numpy)', numpy_path), ('BatchLetterBox', BatchLetterBox(imgsz, 32, device=device,
+                                                                                          half=half)):
+        x = f(ims) if name == 'BatchLetterBox' else f()  # warmup
+        x0 = x.clone() if x0 is None else x0
+        t = time.perf_counter()
+        for _ in range(n):
+            x = f(ims) if name == 'BatchLetterBox' else f()
+            if cuda:
+                torch.cuda.synchronize()
+        dt = (time.perf_counter() - t) / n
+        y.append([name, dt / batch_size * 1E3, batch_size / dt, (x.float() - x0.float()).abs().max().item()])
+
+    py = pd.DataFrame(y, columns=['Preprocess', 'ms/frame', 'frames/s', 'max abs diff'])
+    LOGGER.info(f'\n{batch_size}x{shape[1]}x{shape[0]} frames to {tuple(x.shape)} {x.dtype} on {device}\n{py}')
+    return py
+
+
+def nms(
+        batch_sizes=(1, 4, 16),  # images per batch
+        candidates=(100, 1000, 10000),  # boxes above conf_thres per image
+        nc=80,  # number of classes
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        imgsz=640,  # inference size (pixels)
+        n=10,  # iterations
+):
+    # Benchmark non_max_suppression() per-image loop vs batched mode on random YOLOv5 outputs (25200 anchors at 640)
+    device = select_device(device)
+    cuda = device.type == 'cuda'
+    na = 3 * sum((imgsz // s) ** 2 for s in (8, 16, 32))  # anchors
+    y = []
+    for bs in batch_sizes:
+        for k in candidates:
+            p = torch.rand(bs, na, 5 + nc, device=device)
+            p[..., :2] *= imgsz  # xy
+            p[..., 2:4] *= imgsz / 8  # wh
+            p[..., 4] = 0
+            p[:, torch.randperm(na, device=device)[:k], 4] = 1  # k candidates per image
+            ms, out = [], []
+            for batched in False, True:
+                out.append(non_max_suppression(p, batched=batched))  # warmup
+                t = time.perf_counter()
+                for _ in range(n):
+                    non_max_suppression(p, batched=batched)
+                    if cuda:
+                        torch.cuda.synchronize()
+                ms.append((time.perf_counter() - t) / n * 1E3)
+            match = all(a.shape == b.shape and torch.allclose(a, b) for a, b in zip(*out))
+            y.append([bs, k, ms[0], ms[1], ms[0] / ms[1], match])
+
+    py = pd.DataFrame(y, columns=['batch', 'candidates/img', 'loop (ms)', 'batched (ms)', 'speedup', 'match'])
+    LOGGER.info(f'\nnon_max_suppression() {nc} classes on {device}\n{py}')
+    return py
+
+
+def cache(
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        imgsz=640,  # inference size (pixels)
+        batch_size=16,  # batch size
+        workers=8,  # max dataloader workers
+        epochs=2,  # epochs
+):
+    # Benchmark LoadImagesAndLabels images/s for --cache False, ram, disk and mmap (val loader, no augmentation)
+    path = check_dataset(data)['train']
+    y = []
+    for c in False, 'ram', 'disk', 'mmap':
+        t = time.perf_counter()
+        loader, dataset = create_dataloader(path, imgsz, batch_size, 32, cache=c, workers=workers)
+        t0 = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in range(dataset.n):
+            dataset.load_image(i)
+        t1 = time.perf_counter() - t
+        t = time.perf_counter()
+        for _ in range(epochs):
+            for _ in loader:
+                pass
+        t2 = time.perf_counter() - t
+        y.append([str(c), t0, dataset.n / t1, dataset.n * epochs / t2])
+
+    py = pd.DataFrame(y, columns=['cache', 'setup (s)', 'load_image() images/s', 'DataLoader images/s'])
+    LOGGER.info(f'\n{dataset.n} images from {path} at --imgsz {imgsz}, {loader.num_workers} workers\n{py}')
+    return py
+
+
+def loss(
+        cfg=ROOT / 'models/yolov5s.yaml',  # model.yaml path
+        imgsz=640,  # train size (pixels)
+        batch_size=16,  # batch size
+        targets=(10, 100, 500),  # labels per image
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        n=10,  # iterations
+):
+    # Benchmark ComputeLoss.build_targets() against the full train step (forward, loss, backward) on dense random labels
+    device = select_device(device, batch_size=batch_size)
+    cuda = device.type == 'cuda'
+    model = Model(cfg).to(device).train()
+    model.hyp = yaml_load(ROOT / 'data/hyps/hyp.scratch-low.yaml')
+    compute_loss = ComputeLoss(model)
+    im = torch.rand(batch_size, 3, imgsz, imgsz, device=device)
+
+    def timed(fn):
+        fn()  # warmup
+        t = time.perf_counter()
+        for _ in range(n):
+            fn()
+            if cuda:
+                torch.cuda.synchronize()
+        return (time.perf_counter() - t) / n * 1E3
+
+    def step():
+        pred = model(im)
+        compute_loss(pred, labels)[0].backward()
+
+    y = []
+    for k in targets:
+        nt = batch_size * k
+        labels = torch.cat((torch.arange(batch_size, device=device).repeat_interleave(k)[:, None].float(),
+                            torch.randint(0, model.yaml['nc'], (nt, 1), device=device).float(),
+                            torch.rand(nt, 2, device=device),
+                            torch.rand(nt, 2, device=device) * 0.2 + 0.01), 1)  # image, class, xywh
+        with torch.no_grad():
+            pred = model(im)
+        ms = timed(lambda: compute_loss.build_targets(pred, labels)), timed(step)
+        y.append([k, ms[0], ms[1], 100 * ms[0] / ms[1]])
+
+    py = pd.DataFrame(y, columns=['labels/img', 'build_targets (ms)', 'train step (ms)', 'build_targets (%)'])
+    LOGGER.info(f'\n{Path(cfg).stem} batch {batch_size} at --imgsz {imgsz} on {device}\n{py}')
+    return py
+
+
+def decode(
+        cfg=ROOT / 'models/yolov5s.yaml',  # model.yaml path
+        imgsz=640,  # inference size (pixels)
+        batch_sizes=(1, 16),  # images per batch
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        obj_thres=0.25,  # pre-NMS objectness filter for the rows kept column
+        n=10,  # iterations over all shapes
+):
+    # Benchmark Detect() inference decode only (output convs excluded) on random logits, cycling rect batch shapes
+    device = select_device(device)
+    cuda = device.type == 'cuda'
+    m = Model(cfg).model[-1]  # Detect()
+    m.m = torch.nn.ModuleList(torch.nn.Identity() for _ in m.m)  # decode only
+    m = m.to(device).eval()
+    m = m.half() if half else m
+    shapes = [(imgsz, w) for w in range(imgsz, imgsz // 2 - 1, -64)]  # rect validation batch shapes, h x w
+    y = []
+    for bs in batch_sizes:
+        inputs = []
+        for h, w in shapes:
+            x = [torch.randn(bs, m.na, m.no, h // int(s), w // int(s), device=device) for s in m.stride]
+            for xi in x:
+                xi[:, :, 4] -= 5  # few objects
+            inputs.append([xi.view(bs, -1, *xi.shape[-2:]).to(m.anchors.dtype) for xi in x])
+        ms, out = [], []
+        for fused in False, True:
+            m.fused = fused
+            out.append([m(list(x))[0] for x in inputs])  # warmup
+            t = time.perf_counter()
+            for _ in range(n):
+                for x in inputs:
+                    m(list(x))
+                if cuda:
+                    torch.cuda.synchronize()
+            ms.append((time.perf_counter() - t) / (n * len(inputs)) * 1E3)
+        m.obj_thres = obj_thres
+        kept = sum(m(list(x))[0].shape[1] for x in inputs) / sum(z.shape[1] for z in out[1])
+        m.obj_thres = None
+        match = all(torch.allclose(a, b) for a, b in zip(*out))  # 1 ulp sigmoid differences on strided tails
+        y.append([bs, ms[0], ms[1], ms[0] / ms[1], 100 * kept, match])
+
+    py = pd.DataFrame(y, columns=['batch', 'cat (ms)', 'fused (ms)', 'speedup', 'rows kept (%)', 'match'])
+    LOGGER.info(f'\nDetect() decode per batch, {len(shapes)} batch shapes up to {imgsz}x{imgsz} on {device}, '
+                f'rows kept at obj_thres={obj_thres}\n{py}')
+    return py
+
+
+def tta(
+        weights=ROOT / 'yolov5s.pt',  # weights path
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        imgsz=640,  # inference size (pixels)
+        batch_size=16,  # batch size
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        wbf=0.55,  # weighted box fusion IoU threshold
+):
+    # Benchmark augmented inference (val.py --augment) latency vs mAP on a detection dataset
+    y = []
+    for name, augment, pack, tta_wbf in (('single-scale', False, None, None),
+                                         ('TTA', True, False, None),
+                                         ('TTA packed', True, True, None),
+                                         ('TTA WBF', True, None, wbf)):
+        DetectionModel.tta_pack = pack
+        try:
+            result = val_det(data, weights, batch_size, imgsz, device=device, half=half, augment=augment,
+                             tta_wbf=tta_wbf, plots=False)
+        finally:
+            DetectionModel.tta_pack = None
+        speed = result[2][1] + result[2][2]  # inference + NMS per image
+        y.append([name, round(result[0][2], 4), round(result[0][3], 4), round(speed, 2)])
+
+    py = pd.DataFrame(y, columns=['Mode', 'mAP50', 'mAP50-95', 'Inference + NMS (ms)'])
+    LOGGER.info(f'\nTTA latency vs mAP, {Path(weights).name} on {Path(data).name} at --imgsz {imgsz}\n{py}')
+    return py
+
+
+def serve(
+        weights=ROOT / 'yolov5s.pt',  # weights path
+        imgsz=640,  # inference size (pixels)
+        batch_size=16,  # maximum images per forward
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        clients=(1, 4, 16),  # concurrent clients
+        requests=100,  # requests per client count
+):
+    # Benchmark utils.serving HTTP endpoint latency vs throughput, one image per forward vs dynamic batching
+    model = BatchServer(weights, device, imgsz, half=half)
+    httpd = endpoint(model, '127.0.0.1:0')  # free port
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    address = f'127.0.0.1:{httpd.server_address[1]}'
+    data = (ROOT / 'data/images/zidane.jpg').read_bytes()
+    load(address, data, (1,), 2)  # warmup
+    y = []
+    for b in sorted({1, batch_size}):
+        model.max_batch = b
+        for c in clients:
+            model.batches = model.images = 0
+            py = load(address, data, (c,), requests)
+            y.append([b, *py.values[0], model.stats()['mean batch']])
+    httpd.shutdown()
+    httpd.server_close()
+    model.close()
+
+    py = pd.DataFrame(y, columns=['max batch', 'clients', 'requests/s', 'p50 (ms)', 'p99 (ms)', 'mean batch'])
+    LOGGER.info(f'\n{Path(weights).name} at --imgsz {imgsz}, {requests} requests per row\n{py}')
+    return py
+
+
+def imports(
+        weights=ROOT / 'yolov5s.pt',  # weights path, also timed as DetectMultiBackend(weights) if it exists
+        n=3,  # fresh interpreters per row, median time reported
+        hard_fail=False,  # raise if an inference-only import loads a heavy optional module
+        heavy=('pandas', 'matplotlib', 'seaborn', 'scipy', 'IPython', 'requests', 'thop', 'tensorflow', 'coremltools'),
+):
+    # Benchmark inference-only import time (models.common, detect.py, hubconf.py) in fresh interpreters
+    rows = {
+        'torch, torchvision (baseline)': 'import torch, torchvision',
+        'models.common': 'import models.common',
+        'detect': 'import detect',
+        'hubconf': 'import hubconf',}
+    if Path(weights).is_file():
+        rows['DetectMultiBackend(weights)'] = f'from models.common import DetectMultiBackend; ' \
+                                              f'DetectMultiBackend({str(weights)!r})'  # fuse() uses thop
+    y = []
+    for name, code in rows.items():
+        code = f'import sys, time; t = time.perf_counter(); {code}; dt = time.perf_counter() - t; ' \
+               f'print(json.dumps([dt, [m for m in {heavy!r} if m in sys.modules]]))'
+        t = []
+        for _ in range(n):
+            r = subprocess.run([sys.executable, '-c', f'import json; {code}'], cwd=ROOT, capture_output=True, text=True)
+            assert r.returncode == 0, f'{name} failed:\n{r.stderr}'
+            dt, loaded = json.loads(r.stdout.strip().splitlines()[-1])
+            t.append(dt)
+        y.append([name, np.median(t) * 1E3, ', '.join(loaded)])
+    y = [[*x[:2], x[1] - y[0][1], x[2]] for x in y]
+
+    py = pd.DataFrame(y, columns=['import', 'time (ms)', 'vs baseline (ms)', 'heavy modules'])
+    LOGGER.info(f'\nImport time, median of {n} fresh interpreters\n{py}')
+    bad = [x[0] for x in y[1:] if x[3] and rows[x[0]].startswith('import')]  # first use of thop is fuse()
+    if hard_fail and bad:
+        raise AssertionError(f'HARD FAIL: heavy optional modules imported by {bad}, import them on first use')
+    return py
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='weights path')
@@ -154,6 +481,14 @@ def parse_opt():
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
     parser.add_argument('--hard-fail', nargs='?', const=True, default=False, help='Exception on error or < min metric')
+    parser.add_argument('--preprocess', action='store_true', help='benchmark stream preprocessing only')
+    parser.add_argument('--nms', action='store_true', help='benchmark per-image vs batched NMS only')
+    parser.add_argument('--cache', action='store_true', help='benchmark dataset image caching only')
+    parser.add_argument('--loss', action='store_true', help='benchmark build_targets() and train step time only')
+    parser.add_argument('--serve', action='store_true', help='benchmark batching inference server only')
+    parser.add_argument('--decode', action='store_true', help='benchmark Detect() inference decode only')
+    parser.add_argument('--tta', action='store_true', help='benchmark augmented inference latency vs mAP only')
+    parser.add_argument('--imports', action='store_true', help='benchmark inference-only import time only')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     print_args(vars(opt))
@@ -161,7 +496,25 @@ def parse_opt():
 
 
 def main(opt):
-    test(**vars(opt)) if opt.test else run(**vars(opt))
+    if opt.preprocess:
+        return preprocess(opt.imgsz, max(opt.batch_size, 1), opt.device, opt.half)
+    if opt.nms:
+        return nms(device=opt.device, imgsz=opt.imgsz)
+    if opt.cache:
+        return cache(opt.data, opt.imgsz, max(opt.batch_size, 1))
+    if opt.loss:
+        return loss(imgsz=opt.imgsz, batch_size=max(opt.batch_size, 1), device=opt.device)
+    if opt.serve:
+        return serve(opt.weights, opt.imgsz, max(opt.batch_size, 1), opt.device, opt.half)
+    if opt.decode:
+        return decode(imgsz=opt.imgsz, batch_sizes=sorted({1, opt.batch_size}), device=opt.device, half=opt.half)
+    if opt.tta:
+        return tta(opt.weights, opt.data, opt.imgsz, max(opt.batch_size, 1), opt.device, opt.half)
+    if opt.imports:
+        return imports(opt.weights, hard_fail=opt.hard_fail)
+    exclude = 'preprocess', 'nms', 'cache', 'loss', 'serve', 'decode', 'tta', 'imports'  # benchmark selection flags
+    opt = {k: v for k, v in vars(opt).items() if k not in exclude}
+    test(**opt) if opt['test'] else run(**opt)
 
 
 if __name__ == "__main__":
@@ -34,6 +34,7 @@ import platform
 import sys
 from pathlib import Path
 
+import numpy as np
 import torch
 
 FILE = Path(__file__).resolve()
@@ -43,9 +44,11 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from models.yolo import Detect, DetectionModel
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+from utils.occ.postprocess import LEDDecoder, payload_label
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -67,7 +70,10 @@ def run(
         nosave=False,  # do not save images/videos
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
+        batched_nms=False,  # one NMS call per batch, no time limit
+        nms_topk=None,  # maximum candidates per image into NMS
         augment=False,  # augmented inference
+        tta_wbf=None,  # merge --augment views by weighted box fusion at this IoU, i.e. 0.55
         visualize=False,  # visualize features
         update=False,  # update all models
         project=ROOT / 'runs/detect',  # save results to project/name
@@ -79,6 +85,10 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        batch_letterbox=False,  # letterbox and normalize with BatchLetterBox on device
+        led=False,  # decode OCC LED-panel payloads in detections
+        led_vote=False,  # vote LED payloads across frames
+        model_cache=None,  # compiled-model cache directory, see DetectMultiBackend
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -95,30 +105,39 @@ def run(
 
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half, cache=model_cache)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    if pt:  # drop anchors below conf_thres in Detect() before NMS, detections unchanged
+        for m in model.model.modules():
+            if isinstance(m, Detect):
+                m.obj_thres = conf_thres
+            elif isinstance(m, DetectionModel):
+                m.tta_wbf = tta_wbf
 
     # Dataloader
     bs = 1  # batch_size
+    preprocess = {'device': model.device, 'half': model.fp16} if batch_letterbox else {}
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride, **preprocess)
         bs = len(dataset)
     elif screenshot:
-        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
+        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt, **preprocess)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride, **preprocess)
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
-    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
+    seen, windows, dt = 0, [], (Profile(), Profile(), Profile(), Profile())
+    led = LEDDecoder(vote=led_vote) if led or led_vote else None
     for path, im, im0s, vid_cap, s in dataset:
         with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
+            if isinstance(im, np.ndarray):  # BatchLetterBox returns normalized tensors
+                im = torch.from_numpy(im).to(model.device)
+                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
             if len(im.shape) == 3:
                 im = im[None]  # expand for batch dim
 
@@ -129,11 +148,22 @@ def run(
 
         # NMS
         with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            pred = non_max_suppression(pred,
+                                       conf_thres,
+                                       iou_thres,
+                                       classes,
+                                       agnostic_nms,
+                                       max_det=max_det,
+                                       batched=batched_nms,
+                                       topk=nms_topk)
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
 
+        # LED decode (optional)
+        with dt[3]:
+            payloads = led(im0s if webcam else [im0s], pred, im.shape[2:]) if led else None
+
         # Process predictions
         for i, det in enumerate(pred):  # per image
             seen += 1
@@ -158,9 +188,11 @@ def run(
                 for c in det[:, 5].unique():
                     n = (det[:, 5] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+                if led:
+                    s += f'{int(payloads[i][:, 1].sum())} payloads, '
 
                 # Write results
-                for *xyxy, conf, cls in reversed(det):
+                for j, (*xyxy, conf, cls) in reversed(list(enumerate(det))):
                     if save_txt:  # Write to file
                         xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
                         line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
@@ -170,6 +202,8 @@ def run(
                     if save_img or save_crop or view_img:  # Add bbox to image
                         c = int(cls)  # integer class
                         label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+                        if led and not hide_labels:
+                            label = f'{label} {payload_label(payloads[i][j])}'.rstrip()
                         annotator.box_label(xyxy, label, color=colors(c, True))
                     if save_crop:
                         save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
@@ -208,7 +242,13 @@ def run(
 
     # Print results
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
-    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    d = f', {t[3]:.1f}ms LED decode' if led else ''
+    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS{d} per image at shape {(1, 3, *imgsz)}' %
+                t[:3])
+    if webcam:
+        for k, v in dataset.stats().items():
+            s = ', '.join(f'{x:.1f} {n}' if isinstance(x, float) else f'{x} {n}' for n, x in v.items())
+            LOGGER.info(f'{k}: {s}')  # per-stream frame accounting
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -233,7 +273,10 @@ def parse_opt():
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--batched-nms', action='store_true', help='single NMS call per batch, no time limit')
+    parser.add_argument('--nms-topk', type=int, default=None, help='maximum candidates per image into NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta-wbf', nargs='?', type=float, const=0.55, help='--augment weighted box fusion IoU')
     parser.add_argument('--visualize', action='store_true', help='visualize features')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default=ROOT / 'runs/detect', help='save results to project/name')
@@ -245,6 +288,10 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--batch-letterbox', action='store_true', help='letterbox and normalize frames on device')
+    parser.add_argument('--led', action='store_true', help='decode OCC LED-panel payloads in detections')
+    parser.add_argument('--led-vote', action='store_true', help='vote LED payloads across frames')
+    parser.add_argument('--model-cache', type=str, default=None, help='compiled-model cache dir for fast restarts')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
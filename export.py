@@ -56,7 +56,6 @@ import time
 import warnings
 from pathlib import Path
 
-import pandas as pd
 import torch
 from torch.utils.mobile_optimizer import optimize_for_mobile
 
@@ -77,8 +76,8 @@ from utils.torch_utils import select_device, smart_inference_mode
 MACOS = platform.system() == 'Darwin'  # macOS environment
 
 
-def export_formats():
-    # YOLOv5 export formats
+def export_formats(rows=False):
+    # YOLOv5 export formats, as a pandas DataFrame or a list of rows (pandas is slow to import for inference)
     x = [
         ['PyTorch', '-', '.pt', True, True],
         ['TorchScript', 'torchscript', '.torchscript', True, True],
@@ -92,6 +91,9 @@ def export_formats():
         ['TensorFlow Edge TPU', 'edgetpu', '_edgetpu.tflite', False, False],
         ['TensorFlow.js', 'tfjs', '_web_model', False, False],
         ['PaddlePaddle', 'paddle', '_paddle_model', True, True],]
+    if rows:
+        return x
+    import pandas as pd
     return pd.DataFrame(x, columns=['Format', 'Argument', 'Suffix', 'CPU', 'GPU'])
 
 
@@ -5,23 +5,23 @@ Common modules
 
 import ast
 import contextlib
+import hashlib
 import json
 import math
 import platform
+import time
 import warnings
 import zipfile
 from collections import OrderedDict, namedtuple
 from copy import copy
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from urllib.parse import urlparse
 
 import cv2
 import numpy as np
-import pandas as pd
-import requests
 import torch
 import torch.nn as nn
-from IPython.display import display
 from PIL import Image
 from torch.cuda import amp
 
@@ -313,9 +313,55 @@ class Concat(nn.Module):
         return torch.cat(x, self.d)
 
 
+class ModelCache:
+    """DetectMultiBackend compiled-model cache, one directory per weights version, backend, device and dtype.
+
+    An entry holds the compiled artifacts of a backend (fused PyTorch model, optimized ONNX Runtime graph, OpenVINO
+    blobs) and meta.json with the session options and warmup input shape used to build them. meta.json is written last,
+    so an entry without it is incomplete and rebuilt. Weights are identified by resolved path, size and modification
+    time of their files rather than a content hash, which would cost more than a warm start on large checkpoints.
+    """
+
+    def __init__(self, dir, weights, backend, device, fp16=False):
+        h = hashlib.sha256()
+        for w in weights if isinstance(weights, (list, tuple)) else [weights]:
+            for f in sorted(Path(w).rglob('*')) if Path(w).is_dir() else [Path(w)]:
+                if f.is_file():
+                    st = f.stat()
+                    h.update(f'{f.resolve()}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+        d = f'{device.type}{device.index if device.index is not None else ""}'
+        self.dir = Path(dir) / f'{Path(str(w)).stem}-{h.hexdigest()[:16]}-{backend}-{d}-{"fp16" if fp16 else "fp32"}'
+        self.file = self.dir / 'meta.json'
+        self.meta = json.loads(self.file.read_text()) if self.file.exists() else {}
+
+    def get(self, name):
+        # Return path of a cached artifact if the entry is complete, else None
+        f = self.dir / name
+        return f if self.meta and f.exists() else None
+
+    def path(self, name):
+        # Return path to write an artifact to
+        self.dir.mkdir(parents=True, exist_ok=True)
+        return self.dir / name
+
+    def save(self, **kwargs):
+        self.meta.update(kwargs)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.meta, indent=2))
+        tmp.replace(self.file)  # atomic
+
+
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolov5s.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 cache=None):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -329,24 +375,51 @@ class DetectMultiBackend(nn.Module):
         #   TensorFlow Lite:                *.tflite
         #   TensorFlow Edge TPU:            *_edgetpu.tflite
         #   PaddlePaddle:                   *_paddle_model
+        #
+        # cache: directory of compiled models (fused PyTorch, optimized ONNX Runtime graph, OpenVINO blobs) reused on
+        # the next start with the same weights, backend, device and dtype, see ModelCache
         from models.experimental import attempt_download, attempt_load  # scoped to avoid circular import
 
         super().__init__()
+        t0 = time.perf_counter()
+        dt = {k: Profile() for k in ('import', 'load', 'compile', 'warmup')}  # startup times
         w = str(weights[0] if isinstance(weights, list) else weights)
         pt, jit, onnx, xml, engine, coreml, saved_model, pb, tflite, edgetpu, tfjs, paddle, triton = self._model_type(w)
         fp16 &= pt or jit or onnx or engine  # FP16
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
         stride = 32  # default stride
+        batch_size = 1  # fixed input batch size, None if dynamic (larger batches are tiled, see forward())
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
         if not (pt or triton):
             w = attempt_download(w)  # download if not local
+        if cache and (pt and fuse or onnx and not dnn or xml):
+            backend = 'pt' if pt else 'onnx' if onnx else 'openvino'
+            cache = ModelCache(cache, weights if pt and isinstance(weights, list) else w, backend, device, fp16)
+        else:
+            cache = None
+        cached = bool(cache and cache.meta)  # complete cache entry
 
         if pt:  # PyTorch
-            model = attempt_load(weights if isinstance(weights, list) else w, device=device, inplace=True, fuse=fuse)
+            f = cached and cache.get('model.pt')
+            if f:  # fused model from cache
+                with dt['load']:
+                    mmap = {'mmap': True} if check_version(torch.__version__, '2.1.0') else {}  # memory-map tensors
+                    model = torch.load(f, map_location=device, **mmap)
+            else:
+                with dt['load']:
+                    model = attempt_load(weights if isinstance(weights, list) else w, device=device, inplace=True,
+                                         fuse=False)
+                with dt['compile']:
+                    for m in model if isinstance(model, nn.ModuleList) else [model]:  # ensemble or model
+                        if fuse and hasattr(m, 'fuse'):
+                            m.fuse()
+                    model.half() if fp16 else model.float()
+                if cache:
+                    torch.save(model, cache.path('model.pt'))
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
-            model.half() if fp16 else model.float()
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
+            batch_size = None
         elif jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
             extra_files = {'config.txt': ''}  # model metadata
@@ -357,38 +430,61 @@ class DetectMultiBackend(nn.Module):
                                object_hook=lambda d: {int(k) if k.isdigit() else k: v
                                                       for k, v in d.items()})
                 stride, names = int(d['stride']), d['names']
+            batch_size = None
         elif dnn:  # ONNX OpenCV DNN
             LOGGER.info(f'Loading {w} for ONNX OpenCV DNN inference...')
             check_requirements('opencv-python>=4.5.4')
             net = cv2.dnn.readNetFromONNX(w)
         elif onnx:  # ONNX Runtime
             LOGGER.info(f'Loading {w} for ONNX Runtime inference...')
-            check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
-            import onnxruntime
+            with dt['import']:
+                if not cached:  # requirements met when the cache entry was built
+                    check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
+                import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            session_options = onnxruntime.SessionOptions()
+            f = cached and cache.get('model.optimized.onnx')
+            with dt['compile']:
+                if f:  # graph optimized by a previous start, load with its saved session options
+                    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+                    session_options.intra_op_num_threads = cache.meta['intra_op_num_threads']
+                    session = onnxruntime.InferenceSession(str(f), session_options, providers=cache.meta['providers'])
+                else:
+                    if cache:
+                        session_options.optimized_model_filepath = str(cache.path('model.optimized.onnx'))
+                    session = onnxruntime.InferenceSession(w, session_options, providers=providers)
+                    if cache:
+                        cache.meta.update(providers=session.get_providers(),
+                                          intra_op_num_threads=session_options.intra_op_num_threads)
             output_names = [x.name for x in session.get_outputs()]
+            batch_size = session.get_inputs()[0].shape[0]  # 'batch' or None if exported with --dynamic
+            batch_size = batch_size if isinstance(batch_size, int) else None
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
                 stride, names = int(meta['stride']), eval(meta['names'])
         elif xml:  # OpenVINO
             LOGGER.info(f'Loading {w} for OpenVINO inference...')
-            check_requirements('openvino')  # requires openvino-dev: https://pypi.org/project/openvino-dev/
-            from openvino.runtime import Core, Layout, get_batch
+            with dt['import']:
+                if not cached:  # requirements met when the cache entry was built
+                    check_requirements('openvino')  # requires openvino-dev: https://pypi.org/project/openvino-dev/
+                from openvino.runtime import Core, Layout, get_batch
             ie = Core()
+            if cache:
+                ie.set_property({'CACHE_DIR': str(cache.path('openvino'))})  # compiled blobs, reused by compile_model()
             if not Path(w).is_file():  # if not *.xml
                 w = next(Path(w).glob('*.xml'))  # get *.xml file from *_openvino_model dir
             network = ie.read_model(model=w, weights=Path(w).with_suffix('.bin'))
             if network.get_parameters()[0].get_layout().empty:
                 network.get_parameters()[0].set_layout(Layout("NCHW"))
             batch_dim = get_batch(network)
-            if batch_dim.is_static:
-                batch_size = batch_dim.get_length()
-            executable_network = ie.compile_model(network, device_name="CPU")  # device_name="MYRIAD" for Intel NCS2
+            batch_size = batch_dim.get_length() if batch_dim.is_static else None
+            with dt['compile']:
+                executable_network = ie.compile_model(network, device_name="CPU")  # "MYRIAD" for Intel NCS2
             stride, names = self._load_metadata(Path(w).with_suffix('.yaml'))  # load metadata
         elif engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
-            import tensorrt as trt  # https://developer.nvidia.com/nvidia-tensorrt-download
+            with dt['import']:
+                import tensorrt as trt  # https://developer.nvidia.com/nvidia-tensorrt-download
             check_version(trt.__version__, '7.0.0', hard=True)  # require tensorrt>=7.0.0
             if device.type == 'cpu':
                 device = torch.device('cuda:0')
@@ -465,6 +561,7 @@ class DetectMultiBackend(nn.Module):
             interpreter.allocate_tensors()  # allocate
             input_details = interpreter.get_input_details()  # inputs
             output_details = interpreter.get_output_details()  # outputs
+            batch_size = int(input_details[0]['shape'][0])
             # load metadata
             with contextlib.suppress(zipfile.BadZipFile):
                 with zipfile.ZipFile(w, "r") as model:
@@ -501,10 +598,35 @@ class DetectMultiBackend(nn.Module):
         if names[0] == 'n01440764' and len(names) == 1000:  # ImageNet
             names = yaml_load(ROOT / 'data/ImageNet.yaml')['names']  # human-readable names
 
+        dt['load'].t = time.perf_counter() - t0 - dt['import'].t - dt['compile'].t  # everything else
+        if cache and not cached:  # new entry, meta.json last
+            cache.save(weights=str(w), startup={k: v.t for k, v in dt.items()})
         self.__dict__.update(locals())  # assign all variables to self
 
     def forward(self, im, augment=False, visualize=False):
-        # YOLOv5 MultiBackend inference
+        # YOLOv5 MultiBackend inference, batches that do not fit a fixed-batch export are tiled into several calls
+        if self.batch_size and im.shape[0] != self.batch_size and not self.engine:
+            return self._forward_tiled(im)
+        return self._forward(im, augment, visualize)
+
+    def _forward_tiled(self, im, workers=4):
+        # Run fixed batch-size inference over im in zero-padded chunks, concurrently if the backend is thread-safe
+        n, b = im.shape[0], self.batch_size
+        chunks = list(im.split(b))
+        if chunks[-1].shape[0] < b:
+            chunks[-1] = torch.cat((chunks[-1], chunks[-1].new_zeros((b - chunks[-1].shape[0], *im.shape[1:]))))
+        if self.onnx and len(chunks) > 1:  # ONNX Runtime sessions are thread-safe
+            with ThreadPool(min(workers, len(chunks))) as pool:
+                y = pool.map(self._forward, chunks)
+        else:
+            y = [self._forward(x) for x in chunks]
+
+        def cat(y):  # concatenate chunk outputs, element-wise for (nested) lists, i.e. PyTorch (pred, [P3, P4, P5])
+            return [cat(x) for x in zip(*y)] if isinstance(y[0], (list, tuple)) else torch.cat(y)[:n]
+
+        return cat(y)
+
+    def _forward(self, im, augment=False, visualize=False):
         b, ch, h, w = im.shape  # batch, channel, height, width
         if self.fp16 and im.dtype != torch.float16:
             im = im.half()  # to FP16
@@ -588,13 +710,19 @@ class DetectMultiBackend(nn.Module):
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
-    def warmup(self, imgsz=(1, 3, 640, 640)):
-        # Warmup model by running inference once
+    def warmup(self, imgsz=None):
+        # Warmup model by running inference once, default the input shape of the cached or a (1,3,640,640) warmup
+        imgsz = imgsz or (self.cache and self.cache.meta.get('shape')) or (1, 3, 640, 640)
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
-        if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
-            im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
-            for _ in range(2 if self.jit else 1):  #
-                self.forward(im)  # warmup
+        with self.dt['warmup']:
+            if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
+                im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
+                for _ in range(2 if self.jit else 1):  #
+                    self.forward(im)  # warmup
+        if self.cache and self.cache.meta.get('shape') != list(imgsz):
+            self.cache.save(shape=list(imgsz))
+        s = ', '.join(f'{v.t * 1E3:.1f}ms {k}' for k, v in self.dt.items())
+        LOGGER.info(f"Startup {s}{f' (cache {self.cache.dir})' if self.cache else ''}")
 
     @staticmethod
     def _model_type(p='path/to/model.pt'):
@@ -602,7 +730,7 @@ class DetectMultiBackend(nn.Module):
         # types = [pt, jit, onnx, xml, engine, coreml, saved_model, pb, tflite, edgetpu, tfjs, paddle]
         from export import export_formats
         from utils.downloads import is_url
-        sf = list(export_formats().Suffix)  # export suffixes
+        sf = [x[2] for x in export_formats(rows=True)]  # export suffixes
         if not is_url(p, check=False):
             check_suffix(p, sf)  # checks
         url = urlparse(p)  # if url may be Triton inference server
@@ -629,6 +757,7 @@ class AutoShape(nn.Module):
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
     amp = False  # Automatic Mixed Precision (AMP) inference
+    led = None  # (optional) post-NMS LED-panel decoder, i.e. = utils.occ.postprocess.LEDDecoder(rgb=True)
 
     def __init__(self, model, verbose=True):
         super().__init__()
@@ -665,7 +794,7 @@ class AutoShape(nn.Module):
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
 
-        dt = (Profile(), Profile(), Profile())
+        dt = (Profile(), Profile(), Profile(), Profile())
         with dt[0]:
             if isinstance(size, int):  # expand
                 size = (size, size)
@@ -681,8 +810,11 @@ class AutoShape(nn.Module):
             for i, im in enumerate(ims):
                 f = f'image{i}'  # filename
                 if isinstance(im, (str, Path)):  # filename or uri
-                    im, f = Image.open(requests.get(im, stream=True).raw if str(im).startswith('http') else im), im
-                    im = np.asarray(exif_transpose(im))
+                    f = im
+                    if str(im).startswith('http'):
+                        import requests  # slow to import, URLs only
+                        im = requests.get(im, stream=True).raw
+                    im = np.asarray(exif_transpose(Image.open(im)))
                 elif isinstance(im, Image.Image):  # PIL Image
                     im, f = np.asarray(exif_transpose(im)), getattr(im, 'filename', f) or f
                 files.append(Path(f).with_suffix('.jpg').name)
@@ -716,12 +848,16 @@ class AutoShape(nn.Module):
                 for i in range(n):
                     scale_boxes(shape1, y[i][:, :4], shape0[i])
 
-            return Detections(ims, y, files, dt, self.names, x.shape)
+            # LED decode (optional)
+            with dt[3]:
+                payloads = self.led(ims, y) if self.led else None
+
+            return Detections(ims, y, files, dt, self.names, x.shape, payloads)
 
 
 class Detections:
     # YOLOv5 detections class for inference results
-    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None):
+    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None, payloads=None):
         super().__init__()
         d = pred[0].device  # device
         gn = [torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=d) for im in ims]  # normalizations
@@ -737,6 +873,18 @@ class Detections:
         self.n = len(self.pred)  # number of images (batch size)
         self.t = tuple(x.t / self.n * 1E3 for x in times)  # timestamps (ms)
         self.s = tuple(shape)  # inference BCHW shape
+        self.led = payloads  # (optional) LED payload tables, one (n,len(COLUMNS)) array per image
+
+    @property
+    def payloads(self):
+        # LED payloads as pandas DataFrames, one per image, None without LED decoding
+        if self.led is None:
+            return None
+        import pandas as pd
+
+        from utils.occ.postprocess import COLUMNS
+        dtypes = {k: int for k in COLUMNS if k != 'confidence'}
+        return [pd.DataFrame(x, columns=COLUMNS).astype(dtypes) for x in self.led]
 
     def _run(self, pprint=False, show=False, save=False, crop=False, render=False, labels=True, save_dir=Path('')):
         s, crops = '', []
@@ -767,7 +915,11 @@ class Detections:
 
             im = Image.fromarray(im.astype(np.uint8)) if isinstance(im, np.ndarray) else im  # from np
             if show:
-                display(im) if is_notebook() else im.show(self.files[i])
+                if is_notebook():
+                    from IPython.display import display
+                    display(im)
+                else:
+                    im.show(self.files[i])
             if save:
                 f = self.files[i]
                 im.save(save_dir / f)  # save
@@ -777,7 +929,9 @@ class Detections:
                 self.ims[i] = np.asarray(im)
         if pprint:
             s = s.lstrip('\n')
-            return f'{s}\nSpeed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {self.s}' % self.t
+            d = f', {self.t[3]:.1f}ms LED decode' if self.led is not None else ''
+            return f'{s}\nSpeed: %.1fms pre-process, %.1fms inference, %.1fms NMS{d} per image at shape {self.s}' % \
+                self.t[:3]
         if crop:
             if save:
                 LOGGER.info(f'Saved results to {save_dir}\n')
@@ -801,6 +955,8 @@ class Detections:
 
     def pandas(self):
         # return detections as pandas DataFrames, i.e. print(results.pandas().xyxy[0])
+        import pandas as pd
+
         new = copy(self)  # return copy
         ca = 'xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class', 'name'  # xyxy columns
         cb = 'xcenter', 'ycenter', 'width', 'height', 'confidence', 'class', 'name'  # xywh columns
@@ -812,7 +968,9 @@ class Detections:
     def tolist(self):
         # return a list of Detections objects, i.e. 'for result in results.tolist():'
         r = range(self.n)  # iterable
-        x = [Detections([self.ims[i]], [self.pred[i]], [self.files[i]], self.times, self.names, self.s) for i in r]
+        x = [
+            Detections([self.ims[i]], [self.pred[i]], [self.files[i]], self.times, self.names, self.s,
+                       None if self.led is None else [self.led[i]]) for i in r]
         # for d in x:
         #    for k in ['ims', 'pred', 'xyxy', 'xyxyn', 'xywh', 'xywhn']:
         #        setattr(d, k, getattr(d, k)[0])  # pop out of list
@@ -11,6 +11,7 @@ import contextlib
 import os
 import platform
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 
@@ -24,22 +25,21 @@ if platform.system() != 'Windows':
 from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
-from utils.general import LOGGER, check_version, check_yaml, make_divisible, print_args
+from utils.general import (LOGGER, check_version, check_yaml, make_divisible, non_max_suppression, print_args,
+                           weighted_boxes_fusion, xyxy2xywh)
 from utils.plots import feature_visualization
 from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, model_info, profile, scale_img, select_device,
                                time_sync)
 
-try:
-    import thop  # for FLOPs computation
-except ImportError:
-    thop = None
-
 
 class Detect(nn.Module):
     # YOLOv5 Detect head for detection models
     stride = None  # strides computed during build
     dynamic = False  # force grid reconstruction
     export = False  # export mode
+    fused = True  # decode inference outputs in place into one tensor, see _forward_fused()
+    obj_thres = None  # pre-NMS filter, drop anchors with objectness <= obj_thres in every image of the batch
+    grid_cache_size = 32  # LRU cache of (grid, anchor_grid) per (layer, ny, nx, device, dtype)
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -54,6 +54,8 @@ class Detect(nn.Module):
         self.inplace = inplace  # use inplace ops (e.g. slice assignment)
 
     def forward(self, x):
+        if self.fused and not self.training and not self.dynamic and not torch.jit.is_tracing():
+            return self._forward_fused(x)
         z = []  # inference output
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
@@ -78,6 +80,55 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def _forward_fused(self, x):
+        # Inference decode of all layers in place into one output, allocated per call as callers may still hold it
+        for i in range(self.nl):
+            x[i] = self.m[i](x[i])  # conv
+            bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
+            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2)
+            if not self.export:
+                x[i] = x[i].contiguous()  # returned raw outputs
+
+        n = [self.na * xi.shape[2] * xi.shape[3] for xi in x]  # anchors per layer
+        z = x[0].new_empty((bs, sum(n), self.no))  # inference output
+        k = self.nc + 5  # sigmoid outputs, Segment mask coefficients stay raw
+        a = 0
+        for i, xi in enumerate(x):
+            _, _, ny, nx, _ = xi.shape
+            grid, anchor_grid = self._cached_grid(nx, ny, i)
+            y = z[:, a:a + n[i]].view(bs, self.na, ny, nx, self.no)
+            a += n[i]
+            y.copy_(xi)
+            y[..., :k].sigmoid_()
+            y[..., :2].mul_(2).add_(grid).mul_(self.stride[i])  # xy
+            y[..., 2:4].mul_(2).pow_(2).mul_(anchor_grid)  # wh
+
+        if self.obj_thres is not None:
+            z = z[:, (z[..., 4] > self.obj_thres).any(0)]
+        return (z,) if self.export else (z, x)
+
+    def __getstate__(self):
+        # Pickle (checkpoints, deepcopy) without the grid cache, it is rebuilt on the next inference
+        state = self.__dict__.copy()
+        state.pop('grid_cache', None)
+        return state
+
+    def _apply(self, fn, *args, **kwargs):
+        # Drop cached grids on to(), cpu(), cuda(), half(), they are rebuilt for the new device and dtype
+        self.__dict__.pop('grid_cache', None)
+        return super()._apply(fn, *args, **kwargs)
+
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # Return layer i (grid, anchor_grid) from an LRU cache keyed by (i, ny, nx, device, dtype)
+        if not hasattr(self, 'grid_cache'):  # models saved before the cache
+            self.grid_cache = OrderedDict()
+        cache, key = self.grid_cache, (i, ny, nx, self.anchors.device, self.anchors.dtype)
+        cache[key] = g = cache.pop(key, None) or self._make_grid(nx, ny, i)  # most recently used last
+        while len(cache) > self.grid_cache_size:
+            cache.popitem(last=False)
+        self.grid[i], self.anchor_grid[i] = g
+        return g
+
     def _make_grid(self, nx=20, ny=20, i=0, torch_1_10=check_version(torch.__version__, '1.10.0')):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -126,7 +177,11 @@ class BaseModel(nn.Module):
 
     def _profile_one_layer(self, m, x, dt):
         c = m == self.model[-1]  # is final layer, copy input as inplace fix
-        o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPs
+        try:
+            import thop  # for FLOPs computation, slow to import
+            o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2  # FLOPs
+        except ImportError:
+            o = 0
         t = time_sync()
         for _ in range(10):
             m(x.copy() if c else x)
@@ -164,6 +219,9 @@ class BaseModel(nn.Module):
 
 class DetectionModel(BaseModel):
     # YOLOv5 detection model
+    tta_pack = None  # augmented inference views in one padded batched forward, None for CUDA only
+    tta_wbf = None  # augmented inference weighted box fusion IoU threshold, i.e. 0.55, None to concatenate views
+
     def __init__(self, cfg='yolov5s.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super().__init__()
         if isinstance(cfg, dict):
@@ -212,43 +270,59 @@ class DetectionModel(BaseModel):
         img_size = x.shape[-2:]  # height, width
         s = [1, 0.83, 0.67]  # scales
         f = [None, 3, None]  # flips (2-ud, 3-lr)
-        y = []  # outputs
-        for si, fi in zip(s, f):
-            xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
-            yi = self._forward_once(xi)[0]  # forward
-            # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-            yi = self._descale_pred(yi, fi, si, img_size)
-            y.append(yi)
-        y = self._clip_augmented(y)  # clip augmented tails
-        return torch.cat(y, 1), None  # augmented inference, train
-
-    def _descale_pred(self, p, flips, scale, img_size):
-        # de-scale predictions following augmented inference (inverse operation)
-        if self.inplace:
-            p[..., :4] /= scale  # de-scale
-            if flips == 2:
-                p[..., 1] = img_size[0] - p[..., 1]  # de-flip ud
-            elif flips == 3:
-                p[..., 0] = img_size[1] - p[..., 0]  # de-flip lr
-        else:
-            x, y, wh = p[..., 0:1] / scale, p[..., 1:2] / scale, p[..., 2:4] / scale  # de-scale
-            if flips == 2:
-                y = img_size[0] - y  # de-flip ud
-            elif flips == 3:
-                x = img_size[1] - x  # de-flip lr
-            p = torch.cat((x, y, wh, p[..., 4:]), -1)
-        return p
-
-    def _clip_augmented(self, y):
-        # Clip YOLOv5 augmented inference tails
-        nl = self.model[-1].nl  # number of detection layers (P3-P5)
-        g = sum(4 ** x for x in range(nl))  # grid points
-        e = 1  # exclude layer count
-        i = (y[0].shape[1] // g) * sum(4 ** x for x in range(e))  # indices
-        y[0] = y[0][:, :-i]  # large
-        i = (y[-1].shape[1] // g) * sum(4 ** (nl - 1 - x) for x in range(e))  # indices
-        y[-1] = y[-1][:, i:]  # small
-        return y
+        drop = [{self.model[-1].nl - 1}, set(), {0}]  # clipped augmented tails, large objects at 1, small at 0.67
+        xs = [scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max())) for si, fi in zip(s, f)]  # views
+        h, w = (max(xi.shape[i] for xi in xs) for i in (2, 3))  # packed shape
+        pack = x.device.type != 'cpu' if self.tta_pack is None else self.tta_pack
+        m = self.model[-1]  # Detect()
+        thres, m.obj_thres = m.obj_thres, None  # view rows are selected by position, filter after
+        try:
+            if pack:  # one batched forward, views padded to a common shape
+                xp = [nn.functional.pad(xi, [0, w - xi.shape[3], 0, h - xi.shape[2]], value=0.447) for xi in xs]
+                ys = self._forward_once(torch.cat(xp))[0].chunk(len(xs))
+            else:
+                ys = [self._forward_once(xi)[0] for xi in xs]
+        finally:
+            m.obj_thres = thres
+        keep = [self._augmented_rows(xi.shape[2:], (h, w) if pack else xi.shape[2:], d, x.device)
+                for xi, d in zip(xs, drop)]
+        y = torch.cat([yi[:, k] for yi, k in zip(ys, keep)], 1)
+        view = torch.arange(len(xs), device=x.device).repeat_interleave(torch.stack([k.sum() for k in keep]))
+
+        # De-scale and de-flip all views in one op, xywh = xywh * gain + offset
+        gain = torch.tensor([[(-1 if fi == 3 else 1) / si, (-1 if fi == 2 else 1) / si, 1 / si, 1 / si]
+                             for si, fi in zip(s, f)], device=y.device, dtype=y.dtype)
+        offset = torch.tensor([[img_size[1] * (fi == 3), img_size[0] * (fi == 2), 0, 0] for fi in f],
+                              device=y.device, dtype=y.dtype)
+        y[..., :4] = y[..., :4] * gain[view] + offset[view]
+        if thres is not None:
+            k = (y[..., 4] > thres).any(0)
+            y, view = y[:, k], view[k]
+        if self.tta_wbf and not isinstance(m, Segment):
+            y = self._fuse_augmented(y, view, len(xs))
+        return y, None  # augmented inference, train
+
+    def _augmented_rows(self, shape, canvas, drop=(), device=None):
+        # Return bool mask of Detect() output rows on a (h,w) canvas that fall inside a (h,w) view, except drop layers
+        m = self.model[-1]  # Detect()
+        rows = []
+        for i, s in enumerate(m.stride.tolist()):
+            r = torch.zeros(m.na, int(canvas[0] // s), int(canvas[1] // s), dtype=torch.bool, device=device)
+            if i not in drop:
+                r[:, :int(shape[0] // s), :int(shape[1] // s)] = True
+            rows.append(r.view(-1))
+        return torch.cat(rows)
+
+    def _fuse_augmented(self, y, view, n):
+        # Merge n TTA views by weighted box fusion of their NMS results, returned as Detect() output rows
+        p = [non_max_suppression(y[:, view == i], 0.001, 0.6, max_det=300) for i in range(n)]  # per view and image
+        d = [weighted_boxes_fusion(torch.cat(x), n, self.tta_wbf) for x in zip(*p)]  # per image
+        z = y.new_zeros((len(d), max(len(x) for x in d), y.shape[2]))
+        for i, x in enumerate(d):
+            z[i, :len(x), :4] = xyxy2xywh(x[:, :4])
+            z[i, :len(x), 4] = x[:, 4]  # obj_conf = fused conf, cls_conf = 1
+            z[i, range(len(x)), 5 + x[:, 5].long()] = 1
+        return z
 
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
@@ -0,0 +1,71 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Serve YOLOv5 detection over HTTP or a Unix socket with dynamic batching, see utils/serving.py
+
+Usage - endpoint:
+    $ python serve.py --weights yolov5s.pt --port 5000 --max-batch 16 --max-wait 5
+    $ python serve.py --weights yolov5s.pt --unix /tmp/yolov5.sock
+    $ curl -X POST --data-binary @data/images/zidane.jpg localhost:5000/v1/object-detection
+
+Usage - load generator, p50/p99 latency vs throughput against a running endpoint:
+    $ python serve.py --load localhost:5000 --clients 1 4 16 --requests 200
+    $ python serve.py --load /tmp/yolov5.sock
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.general import LOGGER, print_args
+from utils.serving import DETECTION_URL, BatchServer, endpoint, load
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='model path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--model-cache', type=str, default=None, help='compiled-model cache dir for fast restarts')
+    parser.add_argument('--max-batch', type=int, default=16, help='maximum images per forward')
+    parser.add_argument('--max-wait', type=float, default=5.0, help='maximum batching delay (ms)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--port', type=int, default=5000, help='HTTP port')
+    parser.add_argument('--unix', type=str, default=None, help='serve on this Unix socket path instead of HTTP port')
+    parser.add_argument('--load', type=str, default=None, help='run load generator against host:port or socket path')
+    parser.add_argument('--source', type=str, default=ROOT / 'data/images/zidane.jpg', help='load generator image')
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 4, 16], help='load generator clients')
+    parser.add_argument('--requests', type=int, default=200, help='load generator requests per client count')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    if opt.load:
+        py = load(opt.load, Path(opt.source).read_bytes(), opt.clients, opt.requests)
+        LOGGER.info(f'\n{opt.load} {DETECTION_URL}\n{py}')
+        return py
+    model = BatchServer(opt.weights, opt.device, opt.imgsz, opt.max_batch, opt.max_wait, opt.half, opt.model_cache,
+                        conf=opt.conf_thres, iou=opt.iou_thres)
+    address = opt.unix or f'0.0.0.0:{opt.port}'
+    httpd = endpoint(model, address)
+    LOGGER.info(f'Serving {opt.weights} on {address}{DETECTION_URL}, max batch {opt.max_batch}, '
+                f'max wait {opt.max_wait}ms')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+    model.close()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,25 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Augmentation tests
+
+Usage:
+    $ python -m pytest tests/test_augmentations.py
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from utils.augmentations import BatchLetterBox, letterbox
+
+
+@pytest.mark.parametrize('auto,shapes', [(False, ((480, 640), (400, 640))), (True, ((490, 640), (485, 640)))])
+def test_batch_letterbox_repad(auto, shapes):
+    # Consecutive calls with equal output but different resized shapes match letterbox(), borders are repadded
+    lb = BatchLetterBox(640, auto=auto)
+    for shape, v in zip(shapes, (255, 0)):
+        im = np.full((*shape, 3), v, dtype=np.uint8)
+        y = letterbox(im, 640, auto=auto)[0].transpose((2, 0, 1))[::-1] / 255
+        x = lb([im])[0]
+        assert x.shape == y.shape
+        assert torch.allclose(x, torch.from_numpy(y.astype(np.float32)))
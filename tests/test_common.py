@@ -0,0 +1,38 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Common modules tests
+
+Usage:
+    $ python -m pytest tests/test_common.py
+"""
+
+import functools
+
+import pytest
+import torch
+
+from models.common import DetectMultiBackend
+from models.yolo import Model
+from utils.general import ROOT
+
+
+@pytest.fixture
+def weights(tmp_path, monkeypatch):
+    # Untrained yolov5n checkpoint, torch>=2.6 defaults to weights_only=True and YOLOv5 checkpoints pickle the model
+    monkeypatch.setattr(torch, 'load', functools.partial(torch.load, weights_only=False))
+    torch.manual_seed(0)
+    f = tmp_path / 'yolov5n.pt'
+    torch.save({'model': Model(ROOT / 'models/yolov5n.yaml').half()}, f)
+    return f
+
+
+@pytest.mark.parametrize('n', [4, 5])
+def test_forward_tiled(weights, n):
+    # Batches tiled into fixed batch-size chunks match direct inference, including nested PyTorch outputs
+    model = DetectMultiBackend(weights)
+    im = torch.rand(n, 3, 64, 96)
+    y = model(im)
+    model.batch_size = 2
+    x = model(im)
+    assert torch.allclose(x[0], y[0], atol=1e-5)
+    assert len(x[1]) == len(y[1]) and all(torch.allclose(a, b, atol=1e-5) for a, b in zip(x[1], y[1]))
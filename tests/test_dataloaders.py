@@ -0,0 +1,36 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Dataloader tests
+
+Usage:
+    $ python -m pytest tests/test_dataloaders.py
+"""
+
+import cv2
+import numpy as np
+
+from utils.dataloaders import LoadImagesAndLabels
+from utils.general import ROOT, yaml_load
+
+
+def test_mosaic_mixed_labels(tmp_path):
+    # Mosaics of polygon-labelled and box-labelled images, segments are only used when every label has one
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'labels').mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(8):
+        cv2.imwrite(str(tmp_path / 'images' / f'{i}.jpg'), rng.integers(0, 255, (240, 320, 3), dtype=np.uint8))
+        with open(tmp_path / 'labels' / f'{i}.txt', 'w') as f:
+            for _ in range(1 + i % 3):
+                x, y = rng.uniform(0.2, 0.6, 2)
+                if i % 2:  # polygon
+                    f.write(f'0 {x} {y} {x + 0.2} {y} {x + 0.2} {y + 0.2} {x} {y + 0.2}\n')
+                else:  # box
+                    f.write(f'0 {x + 0.1} {y + 0.1} 0.2 0.2\n')
+
+    hyp = yaml_load(ROOT / 'data/hyps/hyp.scratch-low.yaml')
+    dataset = LoadImagesAndLabels(tmp_path / 'images', img_size=160, augment=True, hyp=hyp)
+    for i in range(40):
+        im, labels, _, _ = dataset[i % len(dataset)]
+        assert im.shape == (3, 160, 160)
+        assert labels.shape[1] == 6 and ((labels[:, 2:] >= 0) & (labels[:, 2:] <= 1)).all()
@@ -0,0 +1,26 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+OCC pipeline tests
+
+Usage:
+    $ python -m pytest tests/test_pipeline.py
+"""
+
+import time
+
+import numpy as np
+
+from utils.occ.pipeline import Pipeline
+
+
+def test_slow_consumer_backpressure():
+    # A slow caller bounds the decoded results in flight, every frame of a non-live source is still yielded in order
+    workers, n = 2, 100
+    pipe = Pipeline((np.zeros((64, 64, 3), dtype=np.uint8) for _ in range(n)), workers=workers, buffer=4)
+    seq, peak = [], 0
+    for r in pipe:
+        peak = max(peak, pipe.results.qsize())
+        seq.append(r.seq)
+        time.sleep(0.01)
+    assert seq == list(range(n))
+    assert peak <= 2 * workers
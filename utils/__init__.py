@@ -4,6 +4,7 @@ utils/initialization
 """
 
 import contextlib
+import functools
 import platform
 import threading
 
@@ -37,6 +38,16 @@ def threaded(func):
     return wrapper
 
 
+@functools.lru_cache(maxsize=None)
+def pyplot():
+    # Return matplotlib.pyplot, imported on first use as it is slow to import. Usage: plt = pyplot()
+    import matplotlib
+    matplotlib.rc('font', **{'size': 11})
+    matplotlib.use('Agg')  # for writing to files only
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def join_threads(verbose=False):
     # Join all daemon threads, i.e. atexit.register(lambda: join_threads())
     main_thread = threading.current_thread()
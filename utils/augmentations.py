@@ -9,10 +9,11 @@ import random
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 
-from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy
+from utils.general import LOGGER, check_version, colorstr, resample_segments, xywhn2xyxy
 from utils.metrics import bbox_ioa
 
 IMAGENET_MEAN = 0.485, 0.456, 0.406  # RGB mean
@@ -152,14 +153,31 @@ def random_perspective(im,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
     # targets = [cls, xyxy]
+    M, s, (width, height) = random_perspective_matrix(im.shape, degrees, translate, scale, shear, perspective, border)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(im[:, :, ::-1])  # base
+    # ax[1].imshow(im2[:, :, ::-1])  # warped
+
+    return im, warp_labels(targets, segments, M, s, width, height, perspective)
 
-    height = im.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = im.shape[1] + border[1] * 2
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Return random_perspective() (3,3) transform, scale and output (width, height) for an image of shape (h,w)
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -im.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -im.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -186,33 +204,26 @@ def random_perspective(im,
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return M, s, (width, height)
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(im[:, :, ::-1])  # base
-    # ax[1].imshow(im2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_labels(targets, segments, M, s, width, height, perspective=False):
+    # Transform [cls, xyxy] targets (and their segments) by M into a (width, height) image, dropping degenerate boxes
     n = len(targets)
     if n:
-        use_segments = any(x.any() for x in segments)
-        new = np.zeros((n, 4))
+        use_segments = len(segments) == n and any(x.any() for x in segments)  # boxes if any label has no segment
         if use_segments:  # warp segments
-            segments = resample_segments(segments)  # upsample
-            for i, segment in enumerate(segments):
-                xy = np.ones((len(segment), 3))
-                xy[:, :2] = segment
-                xy = xy @ M.T  # transform
-                xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]  # perspective rescale or affine
+            xy = np.ones((n, 1000, 3))
+            xy[..., :2] = resample_segments(segments)  # upsample
+            xy = xy @ M.T  # transform
+            xy = xy[..., :2] / xy[..., 2:3] if perspective else xy[..., :2]  # perspective rescale or affine
 
-                # clip
-                new[i] = segment2box(xy, width, height)
+            # clip, as segment2box()
+            x, y = xy[..., 0], xy[..., 1]
+            inside = (x >= 0) & (y >= 0) & (x <= width) & (y <= height)
+            new = np.stack((np.where(inside, x, np.inf).min(1), np.where(inside, y, np.inf).min(1),
+                            np.where(inside, x, -np.inf).max(1), np.where(inside, y, -np.inf).max(1)), 1)
+            new[~(inside & (x != 0)).any(1)] = 0  # no points inside
 
         else:  # warp boxes
             xy = np.ones((n * 4, 3))
@@ -234,7 +245,39 @@ def random_perspective(im,
         targets = targets[i]
         targets[:, 1:5] = new[i]
 
-    return im, targets
+    return targets
+
+
+def warp_mosaic(tiles, M, out, perspective=False):
+    """Compose mosaic tiles directly into the preallocated (h,w,3) output of a canvas transform M.
+
+    Equivalent to pasting every (im, x, y) tile at canvas pixel (x, y) of a gray canvas and warping the whole canvas
+    with M, but each tile is warped once with its combined transform into the bounding box it covers in out, so no
+    canvas is allocated and no pixels outside the tiles are interpolated.
+    """
+    h, w = out.shape[:2]
+    out[:] = 114
+    for im, x, y in tiles:
+        if not im.size:
+            continue
+        Mi = M @ np.array([[1, 0, x], [0, 1, y], [0, 0, 1]])  # tile to output
+        hi, wi = im.shape[:2]
+        xy = np.array([[0, 0, 1], [wi, 0, 1], [0, hi, 1], [wi, hi, 1]]) @ Mi.T  # corners
+        if (xy[:, 2] <= 0).any():  # behind the perspective horizon, warp the full output
+            x1, y1, x2, y2 = 0, 0, w, h
+        else:
+            xy = xy[:, :2] / xy[:, 2:3]
+            x1, y1 = (np.floor(xy.min(0)).astype(int) - 1).clip(0, (w, h))  # 1 pixel margin for interpolation
+            x2, y2 = (np.ceil(xy.max(0)).astype(int) + 1).clip(0, (w, h))
+            if x2 <= x1 or y2 <= y1:  # outside the output
+                continue
+        Mi = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]]) @ Mi  # tile to output box
+        dst = out[y1:y2, x1:x2]
+        if perspective:
+            cv2.warpPerspective(im, Mi, (x2 - x1, y2 - y1), dst=dst, borderMode=cv2.BORDER_TRANSPARENT)
+        else:
+            cv2.warpAffine(im, Mi[:2], (x2 - x1, y2 - y1), dst=dst, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
 
 
 def copy_paste(im, labels, segments, p=0.5):
@@ -287,9 +330,9 @@ def cutout(im, labels, p=0.5):
 
 
 def mixup(im, labels, im2, labels2):
-    # Applies MixUp augmentation https://arxiv.org/pdf/1710.09412.pdf
+    # Applies MixUp augmentation https://arxiv.org/pdf/1710.09412.pdf, blending im2 into im in place
     r = np.random.beta(32.0, 32.0)  # mixup ratio, alpha=beta=32.0
-    im = (im * r + im2 * (1 - r)).astype(np.uint8)
+    im = cv2.addWeighted(im, r, im2, 1 - r, 0.0, dst=im)
     labels = np.concatenate((labels, labels2), 0)
     return im, labels
 
@@ -395,3 +438,95 @@ class ToTensor:
         im = im.half() if self.half else im.float()  # uint8 to fp16/32
         im /= 255.0  # 0-255 to 0.0-1.0
         return im
+
+
+class BatchLetterBox:
+    """YOLOv5 batched letterbox, BGR to RGB and 0-1 normalization into a preallocated BCHW input tensor.
+
+    Replaces letterbox() -> np.stack() -> [..., ::-1] -> np.ascontiguousarray() -> torch.from_numpy() -> float() ->
+    /255, which allocates and copies the batch five times. On CPU images are resized with cv2 into a reused uint8
+    buffer and converted once into the input tensor. On CUDA raw uint8 frames are uploaded once from pinned memory and
+    resized, padded, channel-swapped and normalized with batched torch ops on device. The returned tensor is reused by
+    the next call, consume it (inference) before calling again.
+
+    Usage: x = BatchLetterBox(640, stride=32, device=model.device, half=model.fp16)(ims)  # list of HWC BGR uint8
+    """
+
+    def __init__(self, new_shape=640, stride=32, auto=True, scaleup=True, device='cpu', half=False, color=114):
+        self.new_shape = (new_shape, new_shape) if isinstance(new_shape, int) else tuple(new_shape)
+        self.stride, self.auto, self.scaleup, self.color = stride, auto, scaleup, color
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.half = half
+        self.dtype = torch.float16 if half and self.cuda else torch.float32  # numpy float16 math is slow on CPU
+        self.x = None  # output buffer
+        self.g = None  # geometry() of the images in the output buffer
+        self.stage = {}  # uint8 input buffers by (n, h, w)
+        self.event = None  # CUDA upload event, guards pinned buffer reuse
+
+    def geometry(self, shape):
+        # Return letterbox() resized (h, w), output (h, w) and (top, left) padding for an image (h, w) shape
+        r = min(self.new_shape[0] / shape[0], self.new_shape[1] / shape[1])
+        if not self.scaleup:  # only scale down, do not scale up (for better val mAP)
+            r = min(r, 1.0)
+        h, w = int(round(shape[0] * r)), int(round(shape[1] * r))
+        dh, dw = self.new_shape[0] - h, self.new_shape[1] - w  # padding
+        if self.auto:  # minimum rectangle
+            dh, dw = dh % self.stride, dw % self.stride
+        return (h, w), (h + dh, w + dw), (int(round(dh / 2 - 0.1)), int(round(dw / 2 - 0.1)))
+
+    def _buffer(self, key, shape, dtype, pin=False):
+        # Return reusable buffer for key, reallocated if its shape changed
+        if key not in self.stage or self.stage[key].shape != shape:
+            self.stage[key] = torch.empty(shape, dtype=dtype, pin_memory=pin)
+        return self.stage[key]
+
+    def __call__(self, ims):
+        g = [self.geometry(im.shape[:2]) for im in ims]
+        shape = g[0][1]
+        assert all(x[1] == shape for x in g), 'BatchLetterBox requires equal output shapes, use auto=False'
+        n = len(ims)
+        if self.x is None or self.x.shape != (n, 3, *shape):
+            self.x = torch.full((n, 3, *shape), self.color / 255, dtype=self.dtype, device=self.device)  # pad
+        else:  # repad images whose resized shape or padding changed, their old pixels are left in the border
+            for i, x in enumerate(g):
+                if x != self.g[i]:
+                    self.x[i].fill_(self.color / 255)
+        self.g = g
+        if self.cuda:
+            self._cuda(ims, g)
+        else:
+            self._cpu(ims, g)
+        return self.x.half() if self.half and not self.cuda else self.x
+
+    def _cpu(self, ims, g):
+        x = self.x.numpy()
+        for i, (im, ((h, w), _, (top, left))) in enumerate(zip(ims, g)):
+            if im.shape[:2] != (h, w):
+                im = cv2.resize(im, (w, h), dst=self._buffer(i, (h, w, 3), torch.uint8).numpy(),
+                                interpolation=cv2.INTER_LINEAR)
+            # HWC to CHW, BGR to RGB, uint8 to float, 0-255 to 0.0-1.0 in a single pass
+            np.multiply(im.transpose((2, 0, 1))[::-1], x.dtype.type(1 / 255), out=x[i, :, top:top + h, left:left + w],
+                        casting='unsafe')
+
+    def _cuda(self, ims, g):
+        if self.event is not None:
+            self.event.synchronize()  # previous upload finished, pinned buffers can be overwritten
+        groups = {}  # images grouped by input shape, one upload and resize per group
+        for i, im in enumerate(ims):
+            groups.setdefault(im.shape, []).append(i)
+        for s, idx in groups.items():
+            stage = self._buffer((len(idx), *s), (len(idx), *s), torch.uint8, pin=True)
+            np.stack([ims[i] for i in idx], out=stage.numpy())
+            y = stage.to(self.device, non_blocking=True).permute(0, 3, 1, 2).flip(1).to(self.dtype)  # BGR to RGB
+            (h, w), _, (top, left) = g[idx[0]]
+            if s[:2] != (h, w):
+                y = F.interpolate(y, size=(h, w), mode='bilinear', align_corners=False)
+            y = y.mul_(1 / 255)
+            if len(idx) == len(ims):
+                self.x[:, :, top:top + h, left:left + w] = y
+            else:
+                for j, i in enumerate(idx):
+                    self.x[i, :, top:top + h, left:left + w] = y[j]
+        self.event = torch.cuda.Event()
+        self.event.record()
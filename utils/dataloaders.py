@@ -3,6 +3,7 @@
 Dataloaders and dataset utils
 """
 
+import atexit
 import contextlib
 import glob
 import hashlib
@@ -15,7 +16,7 @@ import time
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 from urllib.parse import urlparse
 
 import numpy as np
@@ -28,8 +29,9 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
-                                 letterbox, mixup, random_perspective)
+from utils.augmentations import (Albumentations, BatchLetterBox, augment_hsv, classify_albumentations,
+                                 classify_transforms, copy_paste, letterbox, mixup, random_perspective,
+                                 random_perspective_matrix, warp_labels, warp_mosaic)
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
@@ -41,6 +43,7 @@ IMG_FORMATS = 'bmp', 'dng', 'jpeg', 'jpg', 'mpo', 'png', 'tif', 'tiff', 'webp',
 VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'wmv'  # include video suffixes
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
+LOCAL_WORLD_SIZE = int(os.getenv('LOCAL_WORLD_SIZE', 1))  # processes per node
 PIN_MEMORY = str(os.getenv('PIN_MEMORY', True)).lower() == 'true'  # global pin_memory for dataloaders
 
 # Get orientation exif tag
@@ -187,9 +190,47 @@ class _RepeatSampler:
             yield from iter(self.sampler)
 
 
+def prefetch(batches, fn, depth=2, device=None):
+    """Yield fn(*batch) for every batch, computed up to `depth` batches ahead on a background thread.
+
+    On CUDA `fn` runs on a side stream, so host to device copies and normalization of the next batch overlap work on the
+    current one, i.e. `prefetch(dataloader, lambda im, *x: (im.to(device, non_blocking=True).float() / 255, *x))`.
+    """
+    from queue import Queue
+
+    stream = torch.cuda.Stream(device) if device is not None and device.type == 'cuda' else None
+    q, done = Queue(maxsize=depth), object()
+
+    def worker():
+        try:
+            for batch in batches:
+                with torch.cuda.stream(stream) if stream else contextlib.nullcontext():
+                    y = fn(*batch)
+                    event = stream.record_event() if stream else None
+                q.put((y, event))
+            q.put((done, None))
+        except Exception as e:
+            q.put((e, None))
+
+    Thread(target=worker, daemon=True).start()
+    while True:
+        y, event = q.get()
+        if y is done:
+            return
+        if isinstance(y, Exception):
+            raise y
+        if event is not None:
+            current = torch.cuda.current_stream(device)
+            current.wait_event(event)
+            for x in y:
+                if isinstance(x, torch.Tensor) and x.is_cuda:
+                    x.record_stream(current)  # side stream memory is in use on the current stream
+        yield y
+
+
 class LoadScreenshots:
     # YOLOv5 screenshot dataloader, i.e. `python detect.py --source "screen 0 100 100 512 256"`
-    def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None):
+    def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None, device=None, half=False):
         # source = [screen_number left top width height] (pixels)
         check_requirements('mss')
         import mss
@@ -206,6 +247,7 @@ class LoadScreenshots:
         self.stride = stride
         self.transforms = transforms
         self.auto = auto
+        self.letterbox = None if device is None else BatchLetterBox(img_size, stride, auto, device=device, half=half)
         self.mode = 'stream'
         self.frame = 0
         self.sct = mss.mss()
@@ -228,6 +270,8 @@ class LoadScreenshots:
 
         if self.transforms:
             im = self.transforms(im0)  # transforms
+        elif self.letterbox:
+            im = self.letterbox([im0])  # padded resize, BGR to RGB, normalize, BCHW tensor
         else:
             im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
             im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
@@ -238,7 +282,15 @@ class LoadScreenshots:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 device=None,
+                 half=False):
         if isinstance(path, str) and Path(path).suffix == ".txt":  # *.txt file with img/vid/dir on each line
             path = Path(path).read_text().rsplit()
         files = []
@@ -266,6 +318,8 @@ class LoadImages:
         self.auto = auto
         self.transforms = transforms  # optional
         self.vid_stride = vid_stride  # video frame-rate stride
+        # optional BatchLetterBox preprocessing on device, returns normalized torch tensors
+        self.letterbox = None if device is None else BatchLetterBox(img_size, stride, auto, device=device, half=half)
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -310,6 +364,8 @@ class LoadImages:
 
         if self.transforms:
             im = self.transforms(im0)  # transforms
+        elif self.letterbox:
+            im = self.letterbox([im0])  # padded resize, BGR to RGB, normalize, BCHW tensor
         else:
             im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
             im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
@@ -339,9 +395,81 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class StreamBuffer:
+    """Latest-frame triple buffer for one video stream.
+
+    The capture thread decodes into a free slot with cap.retrieve() (zero-copy while the frame shape is unchanged) and
+    publishes it with a sequence number and capture timestamp. The consumer blocks on a condition variable until a frame
+    newer than the last one it took is published, and holds that slot until its next get(), so frames are never
+    overwritten while in use. Frames published but never taken are counted as dropped, frames taken twice (timeout) as
+    duplicated.
+    """
+
+    def __init__(self, im):
+        self.ims = [im, np.empty_like(im), np.empty_like(im)]  # slots
+        self.ready, self.write, self.read = 0, 1, None  # latest published, being written, held by the consumer
+        self.seq, self.t, self.last = 1, time.time(), 0  # latest sequence number and capture time, last taken
+        self.grabbed, self.consumed, self.dropped, self.duplicated = 1, 0, 0, 0
+        self.latency, self.latency_max = 0.0, 0.0  # capture-to-consume seconds, total and max
+        self.closed = False
+        self.cond = Condition()
+
+    def buffer(self):
+        # Return the free slot for the capture thread to decode into
+        return self.ims[self.write]
+
+    def publish(self, im):
+        # Publish im (normally the buffer() slot) as the latest frame
+        with self.cond:
+            self.ims[self.write] = im
+            self.ready = self.write
+            self.write = ({0, 1, 2} - {self.ready, self.read}).pop()
+            self.seq += 1
+            self.grabbed += 1
+            self.t = time.time()
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        # Return the latest frame, waiting up to timeout seconds for one newer than the last frame taken
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > self.last or self.closed, timeout) or self.seq == self.last:
+                self.duplicated += 1  # no new frame in time (or stream closed), re-use the last one
+            else:
+                self.dropped += self.seq - self.last - 1
+                self.consumed += 1
+                self.read, self.last = self.ready, self.seq
+                dt = time.time() - self.t
+                self.latency += dt
+                self.latency_max = max(self.latency_max, dt)
+            return self.ims[self.read]
+
+    def stats(self):
+        # Return frame counters and capture-to-consume latency (ms)
+        return {
+            'grabbed': self.grabbed,
+            'consumed': self.consumed,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'latency (ms)': self.latency / max(self.consumed, 1) * 1E3,
+            'max latency (ms)': self.latency_max * 1E3}
+
+
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='file.streams', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    def __init__(self,
+                 sources='file.streams',
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 device=None,
+                 half=False):
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
         self.img_size = img_size
@@ -351,6 +479,7 @@ class LoadStreams:
         n = len(sources)
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        self.buffers = [None] * n  # StreamBuffer per stream
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
@@ -372,6 +501,7 @@ class LoadStreams:
             self.fps[i] = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.buffers[i] = StreamBuffer(self.imgs[i])
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             LOGGER.info(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
             self.threads[i].start()
@@ -382,24 +512,27 @@ class LoadStreams:
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         self.auto = auto and self.rect
         self.transforms = transforms  # optional
+        # optional BatchLetterBox preprocessing on device, returns normalized torch tensors
+        self.letterbox = None if device is None else BatchLetterBox(
+            img_size, stride, self.auto, device=device, half=half)
         if not self.rect:
             LOGGER.warning('WARNING ⚠️ Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
     def update(self, i, cap, stream):
         # Read stream `i` frames in daemon thread
-        n, f = 0, self.frames[i]  # frame number, frame array
+        n, f, b = 0, self.frames[i], self.buffers[i]  # frame number, frame array, StreamBuffer
         while cap.isOpened() and n < f:
             n += 1
             cap.grab()  # .read() = .grab() followed by .retrieve()
             if n % self.vid_stride == 0:
-                success, im = cap.retrieve()
+                success, im = cap.retrieve(b.buffer())  # decode into the free slot
                 if success:
-                    self.imgs[i] = im
+                    b.publish(im)
                 else:
                     LOGGER.warning('WARNING ⚠️ Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
+                    b.publish(np.zeros_like(self.imgs[i]))
                     cap.open(stream)  # re-open stream if signal was lost
-            time.sleep(0.0)  # wait time
+        b.close()
 
     def __iter__(self):
         self.count = -1
@@ -411,9 +544,12 @@ class LoadStreams:
             cv2.destroyAllWindows()
             raise StopIteration
 
-        im0 = self.imgs.copy()
+        t = time.time() + 2 / min(self.fps)  # wait up to 2 frame intervals of the slowest stream for new frames
+        im0 = self.imgs = [b.get(max(t - time.time(), 0)) for b in self.buffers]  # valid until the next __next__()
         if self.transforms:
             im = np.stack([self.transforms(x) for x in im0])  # transforms
+        elif self.letterbox:
+            im = self.letterbox(im0)  # resize, BGR to RGB, normalize, BCHW tensor
         else:
             im = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0])  # resize
             im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
@@ -424,6 +560,225 @@ class LoadStreams:
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
+    def stats(self):
+        # Return {source: StreamBuffer.stats()} frame counters and capture-to-consume latency per stream
+        return {s: b.stats() for s, b in zip(self.sources, self.buffers)}
+
+
+class ImageShards:
+    """Read-only images stored back to back in a few large uint8 shard files, see LoadImagesAndLabels(cache='mmap').
+
+    Indexing returns a zero-copy (h,w,c) view of a memory-mapped shard. Shards are mapped lazily so that DataLoader
+    workers map their own instead of receiving pickled copies of the arrays.
+
+    Args:
+        files: shard file paths
+        index: (n,5) int64 per image shard, byte offset, h, w, c
+    """
+
+    def __init__(self, files, index):
+        self.files, self.index = [str(f) for f in files], index
+        self.maps = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if self.maps is None:
+            self.maps = self._map()
+        s, o, h, w, c = self.index[i]
+        return self.maps[s][o:o + h * w * c].reshape(h, w, c)
+
+    def __getstate__(self):
+        return {**self.__dict__, 'maps': None}  # map again after unpickling
+
+    def _map(self):
+        return [np.memmap(f, dtype=np.uint8, mode='r') for f in self.files]
+
+
+class SharedImages(ImageShards):
+    """ImageShards in a single named shared-memory block, see LoadImagesAndLabels.cache_images_to_shm().
+
+    The block holds the images back to back followed by one ready byte. Processes that did not create it (DDP ranks,
+    spawned DataLoader workers) attach read-only by name, forked workers inherit the mapping.
+    """
+
+    def __init__(self, shm, index):
+        super().__init__([shm.name], index)
+        self.shm = shm
+        self.maps = self._map()
+
+    def __getstate__(self):
+        return {**self.__dict__, 'maps': None, 'shm': None}
+
+    def _map(self):
+        self.shm = self.shm or attach_shared_memory(self.files[0])
+        im = np.frombuffer(self.shm.buf, dtype=np.uint8)
+        im.flags.writeable = False
+        return [im]
+
+
+def attach_shared_memory(name):
+    # Attach to the existing SharedMemory 'name' without owning it, the creator unlinks it
+    from multiprocessing import resource_tracker, shared_memory
+    shm = shared_memory.SharedMemory(name)
+    with contextlib.suppress(Exception):  # Python < 3.13 registers attached blocks too and unlinks them at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def unlink_shared_memory(shm):
+    # Unlink a SharedMemory created by this process, registered again as attaching in this process unregistered it
+    from multiprocessing import resource_tracker
+    with contextlib.suppress(Exception):
+        resource_tracker.register(shm._name, 'shared_memory')
+        shm.unlink()
+
+
+def file_stat(f):
+    # Returns (size, mtime ns) of file f, (-1, -1) if missing
+    try:
+        s = os.stat(f)
+        return s.st_size, s.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+class LabelStore:
+    """Ragged per-image arrays stored as one concatenated array, image i is data[offsets[i]:offsets[i + 1]].
+
+    Replaces lists of small per-image label arrays: indexing returns a view, selecting or reordering images is a single
+    gather and DataLoader workers receive two arrays instead of one pickled object per image.
+
+    Args:
+        data: (N,...) rows of all images
+        counts: (n,) rows per image
+    """
+
+    def __init__(self, data, counts):
+        self.data = data
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    @classmethod
+    def from_list(cls, arrays, shape=(0, 5), dtype=np.float32):
+        # LabelStore from a list of per-image arrays, shape is the shape of an image without rows
+        return cls(np.concatenate([np.zeros(shape, dtype=dtype), *arrays]).astype(dtype), [len(x) for x in arrays])
+
+    @classmethod
+    def cat(cls, stores):
+        # LabelStore of the images of all stores, in order
+        return cls(np.concatenate([x.data for x in stores]), np.concatenate([x.counts for x in stores]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def image_index(self):
+        # (N,) image index of every row
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def subset(self, images):
+        # LabelStore of images (indices or bool mask), in order
+        images = np.arange(len(self))[images]
+        counts = self.counts[images]
+        rows = np.repeat(self.offsets[images] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return LabelStore(self.data[rows], counts)
+
+    def filter(self, mask):
+        # LabelStore of the rows where (N,) bool mask is True
+        return LabelStore(self.data[mask], np.bincount(self.image_index()[mask], minlength=len(self)))
+
+
+class SegmentStore:
+    """Per-image lists of (k,2) polygon segments, stored as LabelStores of points per segment and segments per image.
+
+    Args:
+        points: LabelStore of (k,2) points, one entry per segment
+        counts: (n,) segments per image
+    """
+
+    def __init__(self, points, counts):
+        self.points = points
+        self.index = LabelStore(np.arange(len(points)), counts)  # segment indices per image
+
+    @classmethod
+    def from_list(cls, segments):
+        # SegmentStore from per-image lists of (k,2) arrays
+        return cls(LabelStore.from_list([x for s in segments for x in s], (0, 2)), [len(s) for s in segments])
+
+    @classmethod
+    def cat(cls, stores):
+        # SegmentStore of the images of all stores, in order
+        return cls(LabelStore.cat([x.points for x in stores]), np.concatenate([x.counts for x in stores]))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return [self.points[j] for j in self.index[i]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def counts(self):
+        return self.index.counts
+
+    def subset(self, images):
+        # SegmentStore of images (indices or bool mask), in order
+        index = self.index.subset(images)
+        return SegmentStore(self.points.subset(index.data), index.counts)
+
+    def filter(self, mask):
+        # SegmentStore of the segments where (S,) bool mask is True
+        return SegmentStore(self.points.subset(mask), self.index.filter(mask).counts)
+
+
+def save_label_cache(path, files, stat, status, msgs, labels, shapes, segments, version):
+    # Save a labels *.cache as columnar arrays in an uncompressed npz
+    c = {
+        'version': np.array(version),
+        'files': np.frombuffer('\0'.join(files).encode(), dtype=np.uint8),  # NUL-separated utf-8
+        'msgs': np.frombuffer('\0'.join(x.replace('\0', '') for x in msgs).encode(), dtype=np.uint8),
+        'stat': stat,  # (n,4) image size, mtime, label size, mtime
+        'status': status,  # (n,4) missing, found, empty, corrupt
+        'shapes': shapes,  # (n,2) wh
+        'labels': labels.data,  # (N,5) cls, xywh
+        'nl': labels.counts,  # labels per image
+        'segments': segments.points.data,  # (P,2) xy points
+        'np': segments.points.counts,  # points per segment
+        'ns': segments.counts}  # segments per image
+    f = path.with_suffix('.cache.tmp')
+    with open(f, 'wb') as file:
+        np.savez(file, **c)
+    f.replace(path)
+
+
+def load_label_cache(path, version):
+    # Load a labels *.cache saved by save_label_cache(), returns dict with label stores or None if missing or stale
+    try:
+        with np.load(path, allow_pickle=False) as c:
+            c = dict(c.items())
+        assert c['version'].item() == version  # matches current version
+    except Exception:
+        return None
+    n = len(c['stat'])
+    c['files'] = bytes(c['files']).decode().split('\0') if n else []
+    c['msgs'] = bytes(c['msgs']).decode().split('\0') if n else []
+    c['labels'] = LabelStore(c['labels'], c.pop('nl'))
+    c['segments'] = SegmentStore(LabelStore(c['segments'], c.pop('np')), c.pop('ns'))
+    return c
+
 
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
@@ -433,7 +788,7 @@ def img2label_paths(img_paths):
 
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.7  # dataset labels *.cache version
     rand_interp_methods = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_LANCZOS4]
 
     def __init__(self,
@@ -457,6 +812,7 @@ class LoadImagesAndLabels(Dataset):
         self.rect = False if image_weights else rect
         self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
         self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.buffers = {}  # preallocated mosaic outputs, see compose_mosaic()
         self.stride = stride
         self.path = path
         self.albumentations = Albumentations(size=img_size) if augment else None
@@ -485,12 +841,7 @@ class LoadImagesAndLabels(Dataset):
         # Check cache
         self.label_files = img2label_paths(self.im_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
-        try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-            assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
-        except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+        cache, exists = self.cache_labels(cache_path, prefix)  # verify new and modified files only
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
@@ -502,23 +853,21 @@ class LoadImagesAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        nl = len(np.concatenate(labels, 0))  # number of labels
+        self.labels, self.segments = cache['labels'], cache['segments']  # LabelStore, SegmentStore
+        nl = len(self.labels.data)  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
-        self.labels = list(labels)
-        self.shapes = np.array(shapes)
-        self.im_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.shapes = cache['shapes']
+        self.im_files = cache['files']  # update
+        self.label_files = img2label_paths(self.im_files)  # update
 
         # Filter images
         if min_items:
-            include = np.array([len(x) >= min_items for x in self.labels]).nonzero()[0].astype(int)
+            include = (self.labels.counts >= min_items).nonzero()[0]
             LOGGER.info(f'{prefix}{n - len(include)}/{n} images filtered from dataset')
             self.im_files = [self.im_files[i] for i in include]
             self.label_files = [self.label_files[i] for i in include]
-            self.labels = [self.labels[i] for i in include]
-            self.segments = [self.segments[i] for i in include]
+            self.labels = self.labels.subset(include)
+            self.segments = self.segments.subset(include)
             self.shapes = self.shapes[include]  # wh
 
         # Create indices
@@ -531,15 +880,12 @@ class LoadImagesAndLabels(Dataset):
 
         # Update labels
         include_class = []  # filter labels to include only these classes (optional)
-        include_class_array = np.array(include_class).reshape(1, -1)
-        for i, (label, segment) in enumerate(zip(self.labels, self.segments)):
-            if include_class:
-                j = (label[:, 0:1] == include_class_array).any(1)
-                self.labels[i] = label[j]
-                if segment:
-                    self.segments[i] = segment[j]
-            if single_cls:  # single-class training, merge all classes into 0
-                self.labels[i][:, 0] = 0
+        if include_class:
+            j = np.isin(self.labels.data[:, 0], include_class)
+            self.segments = self.segments.filter(j[np.repeat(self.segments.counts > 0, self.labels.counts)])
+            self.labels = self.labels.filter(j)
+        if single_cls:  # single-class training, merge all classes into 0
+            self.labels.data[:, 0] = 0
 
         # Rectangular Training
         if self.rect:
@@ -549,8 +895,8 @@ class LoadImagesAndLabels(Dataset):
             irect = ar.argsort()
             self.im_files = [self.im_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
-            self.segments = [self.segments[i] for i in irect]
+            self.labels = self.labels.subset(irect)
+            self.segments = self.segments.subset(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -571,7 +917,12 @@ class LoadImagesAndLabels(Dataset):
             cache_images = False
         self.ims = [None] * n
         self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
-        if cache_images:
+        if cache_images == 'mmap':
+            interp = 'linear' if self.augment else 'area'  # load_image() resize interpolation
+            self.cache_images_to_mmap(cache_path.with_name(f'{cache_path.stem}.{img_size}.{interp}.shards'), prefix)
+        elif cache_images == 'ram' and self.cache_images_to_shm(prefix):
+            pass  # one shared copy per node
+        elif cache_images:
             b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
             self.im_hw0, self.im_hw = [None] * n, [None] * n
             fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
@@ -587,14 +938,13 @@ class LoadImagesAndLabels(Dataset):
             pbar.close()
 
     def check_cache_ram(self, safety_margin=0.1, prefix=''):
-        # Check image caching requirements vs available memory
-        b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        n = min(self.n, 30)  # extrapolate from 30 random images
-        for _ in range(n):
-            im = cv2.imread(random.choice(self.im_files))  # sample image
-            ratio = self.img_size / max(im.shape[0], im.shape[1])  # max(h, w)  # ratio
-            b += im.nbytes * ratio ** 2
-        mem_required = b * self.n / n  # GB required to cache dataset into RAM
+        # Check image caching requirements vs available memory, one shared copy per node or one copy per process
+        gb = 1 << 30  # bytes per gigabytes
+        status = self._shm_status()
+        if status == 'ready':  # cached by another process, attached without new memory
+            return True
+        b = self._resized_shapes().prod(1).sum() * 3  # bytes of cached images
+        mem_required = b if status == 'free' else b * LOCAL_WORLD_SIZE  # bytes required on this node
         mem = psutil.virtual_memory()
         cache = mem_required * (1 + safety_margin) < mem.available  # to cache or not to cache, that is the question
         if not cache:
@@ -603,43 +953,139 @@ class LoadImagesAndLabels(Dataset):
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
+    def _resized_shapes(self):
+        # Returns (n,2) hw of images resized by load_image(), from the exif-corrected label cache shapes
+        hw0 = self.shapes[:, ::-1].astype(np.float64)
+        r = self.img_size / hw0.max(1, keepdims=True)  # ratio
+        return np.where(r != 1, np.ceil(hw0 * r), hw0).astype(np.int64)
+
+    def _shm_name(self):
+        # Shared-memory block name, identical for every process caching the same images at the same size
+        return 'yolov5_' + get_hash(self.im_files + [str(self.img_size), str(self.augment)])[:20]
+
+    def _shm_status(self):
+        # Returns 'ready' if the shared image cache exists, 'free' if it can be created, None if unsupported or full
+        b = self._resized_shapes().prod(1).sum() * 3  # bytes of cached images, followed by the ready byte
+        try:
+            shm = attach_shared_memory(self._shm_name())
+            ready = shm.size > b and shm.buf[b] == 1
+            shm.close()
+            return 'ready' if ready else None  # being built by another job
+        except FileNotFoundError:
+            pass
+        except Exception:  # Python < 3.8
+            return None
+        if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free < b:  # i.e. Docker default 64MB
+            return None  # writing past the tmpfs size would SIGBUS
+        return 'free'
+
+    def cache_images_to_shm(self, prefix=''):
+        # Caches images resized by load_image() in one shared-memory block per node, returns False if unsupported
+        status = self._shm_status()
+        if status is None:
+            LOGGER.info(f'{prefix}Shared memory unavailable, caching images per process')
+            return False
+        hw = self._resized_shapes()
+        nbytes = hw.prod(1) * 3
+        index = np.zeros((self.n, 5), dtype=np.int64)
+        index[:, 1], index[:, 2:4], index[:, 4] = nbytes.cumsum() - nbytes, hw, 3  # shard, offset, h, w, c
+        if status == 'ready':
+            shm = attach_shared_memory(self._shm_name())
+            LOGGER.info(f'{prefix}Using shared image cache {shm.name} ({nbytes.sum() / (1 << 30):.1f}GB ram)')
+        else:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(self._shm_name(), create=True, size=int(nbytes.sum()) + 1)
+            atexit.register(unlink_shared_memory, shm)
+            buf = np.frombuffer(shm.buf, dtype=np.uint8)
+            b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
+            results = ThreadPool(NUM_THREADS).imap(self.load_image, range(self.n))
+            pbar = tqdm(enumerate(results), total=self.n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+            for i, (im, _, _) in pbar:
+                _, o, h, w, c = index[i]
+                if im.shape != (h, w, c):  # label cache shape disagrees with the decoded image
+                    im = cv2.resize(im, (w, h), interpolation=cv2.INTER_AREA)
+                buf[o:o + im.nbytes] = im.reshape(-1)
+                b += im.nbytes
+                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB ram shared)'
+            pbar.close()
+            buf[b] = 1  # ready
+            del buf
+        self.ims = SharedImages(shm, index)
+        self.im_hw0 = [tuple(x) for x in self.shapes[:, ::-1].tolist()]
+        self.im_hw = [tuple(x) for x in hw.tolist()]
+        return True
+
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
+        # Cache dataset labels, check images and read shapes. Files are keyed by (path, size, mtime), only new or
+        # modified image-label pairs are verified and removed ones are dropped. Returns (cache dict, nothing verified)
+        n = len(self.im_files)
+        with ThreadPool(NUM_THREADS) as pool:
+            stat = np.array(pool.map(file_stat, self.im_files + self.label_files), dtype=np.int64)
+        stat = np.concatenate((stat[:n], stat[n:]), 1)  # (n,4) image size, mtime, label size, mtime
+        c = load_label_cache(path, self.cache_version)  # previous cache or None
+        if c is None:
+            j = np.full(n, -1)
+        else:  # previous row per file, -1 if new or modified
+            index = {f: i for i, f in enumerate(c['files'])}
+            j = np.array([index.get(f, -1) for f in self.im_files], dtype=np.int64)
+            j[(j >= 0) & (c['stat'][j] != stat).any(1)] = -1
+
+        # Verify
+        old, todo = (j >= 0).nonzero()[0], (j < 0).nonzero()[0]
+        shape = np.zeros((n, 2), dtype=np.int64)  # wh
+        status, msg = np.zeros((n, 4), dtype=np.int64), [''] * n  # (missing, found, empty, corrupt), message
+        if len(old):
+            shape[old], status[old] = c['shapes'][j[old]], c['status'][j[old]]
+            for i, k in zip(old, j[old]):
+                msg[i] = c['msgs'][k]
+        lb, segments = [np.zeros((0, 5), dtype=np.float32)] * len(todo), [[]] * len(todo)  # verified files
         desc = f"{prefix}Scanning {path.parent / path.stem}..."
-        with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
-                        desc=desc,
-                        total=len(self.im_files),
-                        bar_format=TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
-
-        pbar.close()
-        if msgs:
+        if len(todo):
+            nm, nf, ne, nc = status.sum(0)  # unchanged files
+            with Pool(NUM_THREADS) as pool:
+                args = zip((self.im_files[i] for i in todo), (self.label_files[i] for i in todo), repeat(prefix))
+                pbar = tqdm(pool.imap(verify_image_label, args), desc=desc, total=len(todo), bar_format=TQDM_BAR_FORMAT)
+                for k, (im_file, lb_i, shape_i, segments_i, nm_f, nf_f, ne_f, nc_f, msg_i) in enumerate(pbar):
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if im_file:
+                        lb[k], shape[todo[k]], segments[k] = lb_i, shape_i, segments_i
+                    status[todo[k]], msg[todo[k]] = (nm_f, nf_f, ne_f, nc_f), msg_i
+                    pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
+            pbar.close()
+        nm, nf, ne, nc = status.sum(0)
+        msgs = [x for x in msg if x]
+        if len(todo) and msgs:
             LOGGER.info('\n'.join(msgs))
         if nf == 0:
             LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.im_files)
-        x['results'] = nf, nm, ne, nc, len(self.im_files)
+
+        # Merge unchanged and verified files, in file order
+        order = np.argsort(np.concatenate((old, todo)))
+        labels, segments = LabelStore.from_list(lb), SegmentStore.from_list(segments)
+        if len(old):
+            labels = LabelStore.cat((c['labels'].subset(j[old]), labels))
+            segments = SegmentStore.cat((c['segments'].subset(j[old]), segments))
+        labels, segments = labels.subset(order), segments.subset(order)
+
+        # Save
+        if c is None or len(todo) or len(c['files']) != n:
+            try:
+                save_label_cache(path, self.im_files, stat, status, msg, labels, shape, segments, self.cache_version)
+                LOGGER.info(f'{prefix}{"New" if c is None else "Updated"} cache: {path} ({len(todo)}/{n} verified)')
+            except Exception as e:
+                LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')
+        valid = status[:, 3] == 0  # not corrupt
+        x = {
+            'files': [f for f, v in zip(self.im_files, valid) if v],
+            'labels': labels.subset(valid),
+            'shapes': shape[valid],
+            'segments': segments.subset(valid)}
+        x['results'] = nf, nm, ne, nc, n
         x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
-        try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
-            LOGGER.info(f'{prefix}New cache created: {path}')
-        except Exception as e:
-            LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
-        return x
+        return x, not len(todo)
 
     def __len__(self):
         return len(self.im_files)
@@ -662,7 +1108,7 @@ class LoadImagesAndLabels(Dataset):
 
             # MixUp augmentation
             if random.random() < hyp['mixup']:
-                img, labels = mixup(img, labels, *self.load_mosaic(random.randint(0, self.n - 1)))
+                img, labels = mixup(img, labels, *self.load_mosaic(random.randint(0, self.n - 1), buffer=1))
 
         else:
             # Load image
@@ -747,9 +1193,55 @@ class LoadImagesAndLabels(Dataset):
         if not f.exists():
             np.save(f.as_posix(), cv2.imread(self.im_files[i]))
 
-    def load_mosaic(self, index):
+    def cache_images_to_mmap(self, path, prefix='', shard_size=1 << 32):
+        # Caches images resized by load_image() into shard_size-byte memory-mapped shards in directory 'path'
+        h = get_hash(self.im_files + [str(self.img_size), str(self.augment)])  # images, resize ratio and interpolation
+        try:
+            x = np.load(path / 'index.npy', allow_pickle=True).item()  # load dict
+            assert x['version'] == self.cache_version  # matches current version
+            assert x['hash'] == h  # identical hash
+            LOGGER.info(f"{prefix}Using image cache {path} ({x['index'][:, 2:].prod(1).sum() / (1 << 30):.1f}GB mmap)")
+        except Exception:
+            try:
+                x = self._write_shards(path, h, prefix, shard_size)
+            except OSError as e:
+                LOGGER.warning(f'{prefix}WARNING ⚠️ Image cache directory {path} is not writeable: {e}')
+                return
+        self.ims = ImageShards([path / f for f in x['shards']], x['index'])
+        self.im_hw0 = [tuple(hw) for hw in x['hw0'].tolist()]
+        self.im_hw = [tuple(hw) for hw in x['index'][:, 2:4].tolist()]
+
+    def _write_shards(self, path, h, prefix, shard_size):
+        # Writes resized images and index.npy to directory 'path', returns the index dict
+        x = {'shards': [], 'index': np.zeros((self.n, 5), dtype=np.int64), 'hw0': np.zeros((self.n, 2), dtype=np.int64)}
+        path.mkdir(parents=True, exist_ok=True)
+        for f in path.glob('*'):  # stale cache
+            f.unlink()
+        f, b, t, gb = None, 0, 0, 1 << 30  # shard file, shard bytes, total bytes, bytes per gigabytes
+        results = ThreadPool(NUM_THREADS).imap(self.load_image, range(self.n))
+        pbar = tqdm(enumerate(results), total=self.n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+        for i, (im, hw0, _) in pbar:
+            if f is None or b + im.nbytes > shard_size:  # new shard
+                if f:
+                    f.close()
+                x['shards'].append(f"{len(x['shards'])}.bin")
+                f, b = open(path / x['shards'][-1], 'wb'), 0
+            f.write(np.ascontiguousarray(im).data)
+            x['index'][i] = len(x['shards']) - 1, b, *im.shape
+            x['hw0'][i] = hw0
+            b, t = b + im.nbytes, t + im.nbytes
+            pbar.desc = f'{prefix}Caching images ({t / gb:.1f}GB mmap)'
+        pbar.close()
+        f.close()
+        x['hash'] = h
+        x['version'] = self.cache_version  # cache version
+        np.save(path / 'index.npy', x)  # written last, marks the cache complete
+        LOGGER.info(f'{prefix}New image cache created: {path}')
+        return x
+
+    def load_mosaic(self, index, buffer=0):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
-        labels4, segments4 = [], []
+        tiles, pads = [], []
         s = self.img_size
         yc, xc = (int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border)  # mosaic center x, y
         indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -760,7 +1252,6 @@ class LoadImagesAndLabels(Dataset):
 
             # place img in img4
             if i == 0:  # top left
-                img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
                 x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
                 x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
             elif i == 1:  # top right
@@ -773,41 +1264,14 @@ class LoadImagesAndLabels(Dataset):
                 x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
                 x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-            img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-            padw = x1a - x1b
-            padh = y1a - y1b
+            tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))  # img4[ymin:ymax, xmin:xmax]
+            pads.append((w, h, x1a - x1b, y1a - y1b))  # tile size and offset for labels
 
-            # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
-            if labels.size:
-                labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-                segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-            labels4.append(labels)
-            segments4.extend(segments)
+        return self.compose_mosaic(indices, tiles, pads, buffer=buffer)
 
-        # Concat/clip labels
-        labels4 = np.concatenate(labels4, 0)
-        for x in (labels4[:, 1:], *segments4):
-            np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
-        # img4, labels4 = replicate(img4, labels4)  # replicate
-
-        # Augment
-        img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=self.hyp['copy_paste'])
-        img4, labels4 = random_perspective(img4,
-                                           labels4,
-                                           segments4,
-                                           degrees=self.hyp['degrees'],
-                                           translate=self.hyp['translate'],
-                                           scale=self.hyp['scale'],
-                                           shear=self.hyp['shear'],
-                                           perspective=self.hyp['perspective'],
-                                           border=self.mosaic_border)  # border to remove
-
-        return img4, labels4
-
-    def load_mosaic9(self, index):
+    def load_mosaic9(self, index, buffer=0):
         # YOLOv5 9-mosaic loader. Loads 1 image + 8 random images into a 9-image mosaic
-        labels9, segments9 = [], []
+        tiles, pads = [], []
         s = self.img_size
         indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
         random.shuffle(indices)
@@ -818,7 +1282,6 @@ class LoadImagesAndLabels(Dataset):
 
             # place img in img9
             if i == 0:  # center
-                img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
                 h0, w0 = h, w
                 c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
             elif i == 1:  # top
@@ -839,48 +1302,74 @@ class LoadImagesAndLabels(Dataset):
                 c = s - w, s + h0 - hp - h, s, s + h0 - hp
 
             padx, pady = c[:2]
-            x1, y1, x2, y2 = (max(x, 0) for x in c)  # allocate coords
-
-            # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
-            if labels.size:
-                labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
-                segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
-            labels9.append(labels)
-            segments9.extend(segments)
-
-            # Image
-            img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+            x1, y1 = (max(x, 0) for x in c[:2])  # allocate coords
+            tiles.append((img[y1 - pady:, x1 - padx:], x1, y1))  # img9[ymin:ymax, xmin:xmax]
+            pads.append((w, h, padx, pady))  # tile size and offset for labels
             hp, wp = h, w  # height, width previous
 
         # Offset
         yc, xc = (int(random.uniform(0, s)) for _ in self.mosaic_border)  # mosaic center x, y
-        img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
-
-        # Concat/clip labels
-        labels9 = np.concatenate(labels9, 0)
-        labels9[:, [1, 3]] -= xc
-        labels9[:, [2, 4]] -= yc
-        c = np.array([xc, yc])  # centers
-        segments9 = [x - c for x in segments9]
-
-        for x in (labels9[:, 1:], *segments9):
-            np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
-        # img9, labels9 = replicate(img9, labels9)  # replicate
+        return self.compose_mosaic(indices, tiles, pads, offset=(xc, yc), buffer=buffer)
+
+    def compose_mosaic(self, indices, tiles, pads, offset=(0, 0), buffer=0):
+        """Return augmented (img, labels) of a mosaic of (im, x, y) tiles of images `indices` on a 2*img_size canvas.
+
+        Instead of pasting the tiles into a canvas that random_perspective() warps and crops, every tile is warped once
+        into a preallocated output buffer (one per `buffer` id and DataLoader worker) and the labels of all tiles are
+        transformed together. Copy-paste needs the full canvas and keeps the canvas path.
+
+        Args:
+            pads: per tile (w, h, padw, padh) image size and canvas offset of its labels
+            offset: (x, y) canvas origin, subtracted from tile positions and labels
+        """
+        s, hyp = 2 * self.img_size, self.hyp
+
+        # Labels
+        n = [len(self.labels[i]) for i in indices]
+        labels = np.concatenate([self.labels[i] for i in indices], 0)
+        w, h, padw, padh = (np.repeat(x, n) for x in np.array(pads, dtype=labels.dtype).T)
+        labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
+        segments = [self.segments[i] for i in indices]
+        if any(n and len(x) for n, x in zip(n, segments)):
+            k = [sum(len(x) for x in segments[j]) if n[j] else 0 for j in range(len(indices))]  # points per tile
+            segments = [x for j, x in enumerate(segments) if n[j] for x in x]
+            xy = np.concatenate(segments, 0)
+            w, h, padw, padh = (np.repeat(x, k) for x in np.array(pads, dtype=xy.dtype).T)
+            xy = xyn2xy(xy, w, h, padw, padh) - np.array(offset) if any(offset) else xyn2xy(xy, w, h, padw, padh)
+            np.clip(xy, 0, s, out=xy)  # clip when using random_perspective()
+            segments = np.split(xy, np.cumsum([len(x) for x in segments])[:-1])
+        else:
+            segments = []
+        labels[:, [1, 3]] -= offset[0]
+        labels[:, [2, 4]] -= offset[1]
+        np.clip(labels[:, 1:], 0, s, out=labels[:, 1:])  # clip when using random_perspective()
+
+        # Tiles, cropped to the canvas
+        crops = []
+        for im, x, y in tiles:
+            x, y = x - offset[0], y - offset[1]
+            x1, y1 = max(-x, 0), max(-y, 0)
+            crops.append((im[y1:max(s - y, 0), x1:max(s - x, 0)], x + x1, y + y1))
 
         # Augment
-        img9, labels9, segments9 = copy_paste(img9, labels9, segments9, p=self.hyp['copy_paste'])
-        img9, labels9 = random_perspective(img9,
-                                           labels9,
-                                           segments9,
-                                           degrees=self.hyp['degrees'],
-                                           translate=self.hyp['translate'],
-                                           scale=self.hyp['scale'],
-                                           shear=self.hyp['shear'],
-                                           perspective=self.hyp['perspective'],
-                                           border=self.mosaic_border)  # border to remove
-
-        return img9, labels9
+        augment = dict(degrees=hyp['degrees'],
+                       translate=hyp['translate'],
+                       scale=hyp['scale'],
+                       shear=hyp['shear'],
+                       perspective=hyp['perspective'],
+                       border=self.mosaic_border)  # border to remove
+        if hyp['copy_paste']:
+            img = np.full((s, s, tiles[0][0].shape[2]), 114, dtype=np.uint8)
+            for im, x, y in crops:
+                img[y:y + im.shape[0], x:x + im.shape[1]] = im
+            img, labels, segments = copy_paste(img, labels, segments, p=hyp['copy_paste'])
+            return random_perspective(img, labels, segments, **augment)
+        M, scale, (width, height) = random_perspective_matrix((s, s), **augment)
+        out = self.buffers.get(buffer)
+        if out is None or out.shape[:2] != (height, width):
+            out = self.buffers[buffer] = np.empty((height, width, tiles[0][0].shape[2]), dtype=np.uint8)
+        img = warp_mosaic(crops, M, out, augment['perspective'])
+        return img, warp_labels(labels, segments, M, scale, width, height, augment['perspective'])
 
     @staticmethod
     def collate_fn(batch):
@@ -9,7 +9,6 @@ import subprocess
 import urllib
 from pathlib import Path
 
-import requests
 import torch
 
 
@@ -32,6 +31,8 @@ def gsutil_getsize(url=''):
 
 def url_getsize(url='https://ultralytics.com/images/bus.jpg'):
     # Return downloadable file size in bytes
+    import requests  # slow to import
+
     response = requests.head(url, allow_redirects=True)
     return int(response.headers.get('content-length', -1))
 
@@ -65,6 +66,8 @@ def attempt_download(file, repo='ultralytics/yolov5', release='v7.0'):
 
     def github_assets(repository, version='latest'):
         # Return GitHub repo tag (i.e. 'v7.0') and assets (i.e. ['yolov5s.pt', 'yolov5m.pt', ...])
+        import requests  # slow to import
+
         if version != 'latest':
             version = f'tags/{version}'  # i.e. tags/v7.0
         response = requests.get(f'https://api.github.com/repos/{repository}/releases/{version}').json()  # github api
@@ -28,9 +28,7 @@ from typing import Optional
 from zipfile import ZipFile, is_zipfile
 
 import cv2
-import IPython
 import numpy as np
-import pandas as pd
 import pkg_resources as pkg
 import torch
 import torchvision
@@ -54,7 +52,6 @@ FONT = 'Arial.ttf'  # https://ultralytics.com/assets/Arial.ttf
 
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(NUM_THREADS)  # NumExpr max threads
 os.environ['OMP_NUM_THREADS'] = '1' if platform.system() == 'darwin' else str(NUM_THREADS)  # OpenMP (PyTorch and SciPy)
@@ -78,7 +75,9 @@ def is_colab():
 
 def is_notebook():
     # Is environment a Jupyter notebook? Verified on Colab, Jupyterlab, Kaggle, Paperspace
-    ipython_type = str(type(IPython.get_ipython()))
+    if 'IPython' not in sys.modules:  # notebook kernels import IPython, scripts do not need to
+        return False
+    ipython_type = str(type(sys.modules['IPython'].get_ipython()))
     return 'colab' in ipython_type or 'zmqshell' in ipython_type
 
 
@@ -714,7 +713,7 @@ def labels_to_class_weights(labels, nc=80):
     if labels[0] is None:  # no labels loaded
         return torch.Tensor()
 
-    labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
+    labels = labels.data if hasattr(labels, 'data') else np.concatenate(labels, 0)  # (866643, 5) for COCO
     classes = labels[:, 0].astype(int)  # labels = [class xywh]
     weights = np.bincount(classes, minlength=nc)  # occurrences per class
 
@@ -729,9 +728,14 @@ def labels_to_class_weights(labels, nc=80):
 
 
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
-    # Produces image weights based on class_weights and image contents
+    # Produces image weights based on class_weights and image contents, labels is a list or utils.dataloaders.LabelStore
     # Usage: index = random.choices(range(n), weights=image_weights, k=1)  # weighted image sample
-    class_counts = np.array([np.bincount(x[:, 0].astype(int), minlength=nc) for x in labels])
+    if hasattr(labels, 'image_index'):  # LabelStore
+        i, c = labels.image_index(), labels.data[:, 0].astype(int)
+    else:
+        i = np.repeat(np.arange(len(labels)), [len(x) for x in labels])
+        c = np.concatenate([x[:, 0] for x in labels] + [np.zeros(0)]).astype(int)
+    class_counts = np.bincount(i * nc + c, minlength=len(labels) * nc).reshape(-1, nc)
     return (class_weights.reshape(1, nc) * class_counts).sum(1)
 
 
@@ -891,6 +895,9 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=False,  # one NMS call for the whole batch, see non_max_suppression_batched()
+        topk=None,  # maximum candidates per image into NMS, default 30000
+        time_limit=None,  # seconds to quit after, default 0.5 + 0.05 * batch size, math.inf for no limit
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
@@ -903,6 +910,9 @@ def non_max_suppression(
     assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
     if isinstance(prediction, (list, tuple)):  # YOLOv5 model in validation model, output = (inference_out, loss_out)
         prediction = prediction[0]  # select only inference output
+    if batched:
+        return non_max_suppression_batched(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                           max_det, nm, topk)
 
     device = prediction.device
     mps = 'mps' in device.type  # Apple MPS
@@ -915,8 +925,8 @@ def non_max_suppression(
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
     max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 0.5 + 0.05 * bs  # seconds to quit after
+    max_nms = topk or 30000  # maximum number of boxes into torchvision.ops.nms()
+    time_limit = time_limit or 0.5 + 0.05 * bs  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
@@ -994,6 +1004,119 @@ def non_max_suppression(
     return output
 
 
+def non_max_suppression_batched(
+        prediction,
+        conf_thres=0.25,
+        iou_thres=0.45,
+        classes=None,
+        agnostic=False,
+        multi_label=False,
+        labels=(),
+        max_det=300,
+        nm=0,  # number of masks
+        topk=None,  # maximum candidates per image into NMS, default 30000
+):
+    """Vectorized non_max_suppression() for the whole batch: candidates of all images are filtered together and
+    suppressed by a single torchvision.ops.nms() call with boxes offset by (image, class). There is no time limit, every
+    image is always processed. On CPU, where nms() cost grows with the square of its input, NMS runs per image on the
+    sorted candidates instead.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+    device = prediction.device
+    mps = 'mps' in device.type  # Apple MPS
+    if mps:  # MPS not fully supported yet, convert tensors to CPU before NMS
+        prediction = prediction.cpu()
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - nm - 5  # number of classes
+    max_nms = topk or 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    multi_label &= nc > 1  # multiple labels per box
+    mi = 5 + nc  # mask start index
+
+    # Candidates of all images, b = image index
+    b, a = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[b, a]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        v = torch.zeros((sum(len(lb) for lb in labels), nc + nm + 5), device=x.device, dtype=x.dtype)
+        lb = torch.cat([lb for lb in labels if len(lb)], 0)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(lb),), i, device=b.device) for i, lb in enumerate(labels)])))
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box, mask = xywh2xyxy(x[:, :4]), x[:, mi:]
+    if multi_label:
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=True)
+        x, b = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:mi].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float(), mask), 1)[i], b[i]
+    if classes is not None:  # filter by class
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    if not len(x):  # no boxes
+        return [torch.zeros((0, 6 + nm), device=device) for _ in range(bs)]
+
+    # Sort by image then confidence, keep top max_nms per image
+    i = x[:, 4].argsort(descending=True)
+    i = i[b[i].sort(stable=True)[1]]
+    x, b = x[i], b[i]
+    n = torch.bincount(b, minlength=bs)  # candidates per image
+    if n.max() > max_nms:
+        i = torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b] < max_nms  # confidence rank within image
+        x, b, n = x[i], b[i], n.clamp(max=max_nms)
+
+    # NMS, boxes offset by (image, class) key so that keys never overlap
+    c = 0 if agnostic else x[:, 5:6]  # class key
+    s = x[:, :4].max() - x[:, :4].min() + 1  # key stride
+    if x.device.type == 'cpu':  # CPU nms() is quadratic in boxes, one call per image on its (sorted) slice instead
+        boxes, z = x[:, :4] + c * s, (n.cumsum(0) - n).tolist()
+        i = torch.cat([torchvision.ops.nms(boxes[a:a + k], x[a:a + k, 4], iou_thres) + a
+                       for a, k in zip(z, n.tolist())])
+    else:  # single NMS call for the whole batch
+        boxes = x[:, :4] + (b[:, None] * (1 if agnostic else nc) + c) * s
+        i = torchvision.ops.nms(boxes, x[:, 4], iou_thres)
+
+    # Limit detections per image and split, i is confidence-descending so each image keeps its order
+    i = i[b[i].sort(stable=True)[1]]
+    n = torch.bincount(b[i], minlength=bs)
+    rank = torch.arange(len(i), device=i.device) - (n.cumsum(0) - n)[b[i]]
+    i = i[rank < max_det]
+    output = list(x[i].split(n.clamp(max=max_det).tolist()))
+    return [y.to(device) for y in output] if mps else output
+
+
+def weighted_boxes_fusion(x, views=1, iou_thres=0.55, agnostic=False):
+    """Weighted box fusion (https://arxiv.org/abs/1910.13302) of one image's detections from several views or models.
+
+    Clusters are seeded by NMS at iou_thres and every box joins its most confident overlapping seed of the same class.
+    Fused boxes are the confidence-weighted mean of their cluster, fused confidences the cluster mean scaled by
+    min(boxes, views) / views, so that boxes found in fewer views rank lower.
+
+    Returns:
+         (n,6) tensor of fused detections [xyxy, conf, cls], confidence descending
+    """
+    if not len(x):
+        return x
+    c = 0 if agnostic else x[:, 5:6] * (x[:, :4].max() - x[:, :4].min() + 1)  # class offsets
+    boxes = x[:, :4] + c
+    i = torchvision.ops.nms(boxes, x[:, 4], iou_thres)  # cluster seeds, confidence descending
+    iou = box_iou(boxes[i], boxes) > iou_thres  # seeds overlap themselves and every box they suppressed
+    member = torch.zeros_like(iou).scatter_(0, iou.byte().argmax(0, keepdim=True), True)  # most confident seed
+    w = member * x[:, 4]  # box weights
+    n, conf = member.sum(1, keepdim=True), w.sum(1, keepdim=True)
+    y = torch.cat((torch.mm(w, x[:, :4]) / conf, conf / n * n.clamp(max=views) / views, x[i, 5:6]), 1)
+    return y[y[:, 4].argsort(descending=True)]
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -1031,6 +1154,7 @@ def print_mutation(keys, results, hyp, save_dir, bucket, prefix=colorstr('evolve
 
     # Save yaml
     with open(evolve_yaml, 'w') as f:
+        import pandas as pd
         data = pd.read_csv(evolve_csv, skipinitialspace=True)
         data = data.rename(columns=lambda x: x.strip())  # strip keys
         i = np.argmax(fitness(data.values[:, :4]))  #
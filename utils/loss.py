@@ -88,6 +88,37 @@ class QFocalLoss(nn.Module):
             return loss
 
 
+def assign_targets(targets, anchors, grid, anchor_t, g=0.5):
+    """Match targets to the anchors and neighbouring grid cells of all detection layers in batched tensor ops.
+
+    Arguments:
+        targets: (na,nt,k) targets (image, class, x, y, w, h, anchor, ...) normalized xywh, repeated per anchor
+        anchors: (nl,na,2) anchors in grid units
+        grid: (nl,2) float grid sizes (nx, ny)
+        anchor_t: anchor-multiple threshold
+    Returns:
+        (n,k) targets in grid units, (n,2) offsets, (n,) layer indices and per-layer counts, rows grouped by layer and
+        ordered by offset, anchor and target within a layer
+    """
+    gain = torch.ones((grid.shape[0], 1, 1, targets.shape[2]), device=targets.device)  # normalized to gridspace gain
+    gain[..., 2:6] = grid.repeat(1, 2)[:, None, None]  # xyxy gain
+    t = targets * gain  # shape(nl,na,nt,k)
+
+    # Matches
+    r = t[..., 4:6] / anchors[:, :, None]  # wh ratio
+    j = torch.max(r, 1 / r).max(3)[0] < anchor_t  # compare
+
+    # Offsets
+    gxy = t[..., 2:4]  # grid xy
+    gxi = gain[..., 2:4] - gxy  # inverse
+    jk = (gxy % 1 < g) & (gxy > 1)
+    lm = (gxi % 1 < g) & (gxi > 1)
+    mask = torch.stack((j, j & jk[..., 0], j & jk[..., 1], j & lm[..., 0], j & lm[..., 1]), 1)  # (nl,5,na,nt)
+    i, o, a, n = mask.nonzero(as_tuple=True)  # layer, offset, anchor, target
+    off = torch.stack(((o == 1).float() - (o == 3).float(), (o == 2).float() - (o == 4).float()), 1) * g  # 0,j,k,l,m
+    return t[i, a, n], off, i, mask.sum((1, 2, 3)).tolist()
+
+
 class ComputeLoss:
     sort_obj_iou = False
 
@@ -116,6 +147,7 @@ class ComputeLoss:
         self.nc = m.nc  # number of classes
         self.nl = m.nl  # number of layers
         self.anchors = m.anchors
+        self.grids = {}  # (nl,2) grid sizes per prediction shape
         self.device = device
 
     def __call__(self, p, targets):  # predictions, targets
@@ -177,58 +209,25 @@ class ComputeLoss:
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        tcls, tbox, indices, anch = [], [], [], []
-        gain = torch.ones(7, device=self.device)  # normalized to gridspace gain
         ai = torch.arange(na, device=self.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
         targets = torch.cat((targets.repeat(na, 1, 1), ai[..., None]), 2)  # append anchor indices
 
-        g = 0.5  # bias
-        off = torch.tensor(
-            [
-                [0, 0],
-                [1, 0],
-                [0, 1],
-                [-1, 0],
-                [0, -1],  # j,k,l,m
-                # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-            ],
-            device=self.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors, shape = self.anchors[i], p[i].shape
-            gain[2:6] = torch.tensor(shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain  # shape(3,n,7)
-            if nt:
-                # Matches
-                r = t[..., 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1 / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1 < g) & (gxy > 1)).T
-                l, m = ((gxi % 1 < g) & (gxi > 1)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            bc, gxy, gwh, a = t.chunk(4, 1)  # (image, class), grid xy, grid wh, anchors
-            a, (b, c) = a.long().view(-1), bc.long().T  # anchors, image, class
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid indices
-
-            # Append
-            indices.append((b, a, gj.clamp_(0, shape[2] - 1), gi.clamp_(0, shape[3] - 1)))  # image, anchor, grid
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
-
+        # Match targets to anchors and grid cells of all layers
+        shape = tuple(x.shape[2:4] for x in p)  # (ny, nx) per layer
+        if shape not in self.grids:
+            self.grids[shape] = torch.tensor([(nx, ny) for ny, nx in shape], device=self.device).float()
+        grid = self.grids[shape]
+        t, offsets, i, n = assign_targets(targets, self.anchors, grid, self.hyp['anchor_t'])
+
+        # Define
+        bc, gxy, gwh, a = t.chunk(4, 1)  # (image, class), grid xy, grid wh, anchors
+        a, (b, c) = a.long().view(-1), bc.long().T  # anchors, image, class
+        gij = torch.minimum((gxy - offsets).long().clamp_(0), grid.long()[i] - 1)
+        gi, gj = gij.T  # grid indices
+
+        # Split by layer
+        indices = list(zip(b.split(n), a.split(n), gj.split(n), gi.split(n)))  # image, anchor, grid
+        tbox = list(torch.cat((gxy - gij, gwh), 1).split(n))  # box
+        anch = list(self.anchors[i, a].split(n))  # anchors
+        tcls = list(c.split(n))  # class
         return tcls, tbox, indices, anch
@@ -7,11 +7,10 @@ import math
 import warnings
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
-from utils import TryExcept, threaded
+from utils import TryExcept, pyplot, threaded
 
 
 def fitness(x):
@@ -78,6 +77,11 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
             if plot and j == 0:
                 py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
 
+    return pr_results(px, py, p, r, ap, nt, unique_classes, plot, save_dir, names, eps, prefix)
+
+
+def pr_results(px, py, p, r, ap, nt, unique_classes, plot=False, save_dir='.', names=(), eps=1e-16, prefix=""):
+    # Return ap_per_class() results from (nc,1000) P and R curves at confidences px, optionally plotting all curves
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + eps)
     names = [v for k, v in names.items() if k in unique_classes]  # list: only classes that have data
@@ -123,6 +127,101 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+class APAccumulator:
+    """Streaming, constant-memory ap_per_class().
+
+    Detections are binned by confidence into fixed-resolution histograms per class and IoU threshold as batches arrive,
+    instead of storing every detection until the end. Memory is O(nc * niou * bins) regardless of dataset size, results
+    are available at any time and histograms from several DDP ranks are summed with merge() or all_reduce(). PR curves
+    are sampled once per bin at its lowest confidence instead of once per detection, so results match ap_per_class() up
+    to the shape of the curves within a 1 / bins confidence interval.
+
+    Usage:
+        stats = APAccumulator(nc, niou=10)
+        stats.update(correct, conf, pred_cls, target_cls)  # per image or batch
+        tp, fp, p, r, f1, ap, ap_class = stats.compute()  # as ap_per_class()
+    """
+
+    def __init__(self, nc, niou=10, bins=1000, device='cpu'):
+        self.nc, self.niou, self.bins = nc, niou, bins
+        self.tp = torch.zeros((nc, niou, bins), dtype=torch.int64, device=device)  # true positives per confidence bin
+        self.n = torch.zeros((nc, bins), dtype=torch.int64, device=device)  # predictions per confidence bin
+        self.nt = torch.zeros(nc, dtype=torch.int64, device=device)  # labels per class
+        self.conf = torch.ones((nc, bins), device=device)  # lowest confidence per bin, exact PR curve points
+
+    def update(self, tp, conf, pred_cls, target_cls):
+        """Add detections and labels, arguments as ap_per_class() for any number of images.
+
+        Arguments:
+            tp: (n,niou) bool tensor, true positive at each IoU threshold
+            conf: (n,) confidence tensor
+            pred_cls: (n,) predicted class tensor
+            target_cls: (m,) label class tensor
+        """
+        d = self.n.device
+        b = (conf.to(d) * self.bins).long().clamp_(0, self.bins - 1)  # confidence bin
+        c = pred_cls.to(d).long()
+        k = c * self.bins + b
+        self.n.view(-1).index_put_((k,), torch.ones_like(b), accumulate=True)
+        self.conf.view(-1).scatter_reduce_(0, k, conf.to(d).float(), 'amin')
+        i, j = tp.to(d).nonzero(as_tuple=True)  # detection, IoU threshold
+        self.tp.view(-1).index_put_(((c[i] * self.niou + j) * self.bins + b[i],), torch.ones_like(i), accumulate=True)
+        self.nt += torch.bincount(target_cls.to(d).long(), minlength=self.nc)
+
+    def merge(self, other):
+        # Add the histograms of another APAccumulator, i.e. gathered from another rank
+        self.tp += other.tp.to(self.tp.device)
+        self.n += other.n.to(self.n.device)
+        self.nt += other.nt.to(self.nt.device)
+        torch.minimum(self.conf, other.conf.to(self.conf.device), out=self.conf)
+        return self
+
+    def all_reduce(self):
+        # Sum histograms in place across all DDP ranks, call on every rank
+        import torch.distributed as dist
+        if dist.is_available() and dist.is_initialized():
+            for x in self.tp, self.n, self.nt:
+                dist.all_reduce(x)
+            dist.all_reduce(self.conf, op=dist.ReduceOp.MIN)
+        return self
+
+    def any(self):
+        # True if any detection is a true positive, as stats[0].any() in val.py
+        return bool(self.tp.any())
+
+    def compute(self, plot=False, save_dir='.', names=(), eps=1e-16, prefix=""):
+        # Return (tp, fp, p, r, f1, ap, ap_class) as ap_per_class()
+        tp, n, nt, conf = (x.cpu().numpy() for x in (self.tp, self.n, self.nt, self.conf))
+        tpc = np.flip(np.flip(tp, -1).cumsum(-1), -1)  # true positives at confidence >= bin
+        npc = np.flip(np.flip(n, -1).cumsum(-1), -1)  # predictions at confidence >= bin
+        unique_classes = np.nonzero(nt)[0]  # classes with labels
+
+        px, py = np.linspace(0, 1, 1000), []  # for plotting
+        nc = unique_classes.shape[0]
+        ap, p, r = np.zeros((nc, self.niou)), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+        for ci, c in enumerate(unique_classes):
+            k = np.nonzero(n[c])[0][::-1]  # occupied bins, decreasing confidence
+            if not len(k):
+                continue
+            recall = tpc[c][:, k] / (nt[c] + eps)  # (niou,k) recall curves
+            precision = tpc[c][:, k] / npc[c][k]  # (niou,k) precision curves
+            r[ci] = np.interp(-px, -conf[c, k], recall[0], left=0)  # negative x, xp because xp decreases
+            p[ci] = np.interp(-px, -conf[c, k], precision[0], left=1)  # p at pr_score
+            for j in range(self.niou):
+                ap[ci, j], mpre, mrec = compute_ap(recall[j], precision[j])
+                if plot and j == 0:
+                    py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+
+        return pr_results(px, py, p, r, ap, nt[unique_classes], unique_classes, plot, save_dir, names, eps, prefix)
+
+    def mean_results(self):
+        # Return mean P, R, mAP@0.5, mAP@0.5:0.95 so far
+        if not self.any():
+            return 0.0, 0.0, 0.0, 0.0
+        _, _, p, r, _, ap, _ = self.compute(names={})
+        return p.mean(), r.mean(), ap[:, 0].mean(), ap.mean()
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -141,41 +240,38 @@ class ConfusionMatrix:
         Returns:
             None, updates confusion matrix accordingly
         """
+        nc1 = self.nc + 1  # classes + background
         if detections is None:
-            gt_classes = labels.int()
-            for gc in gt_classes:
-                self.matrix[self.nc, gc] += 1  # background FN
+            self.matrix[self.nc] += np.bincount(labels.int().cpu().numpy(), minlength=nc1)  # background FN
             return
 
         detections = detections[detections[:, 4] > self.conf]
-        gt_classes = labels[:, 0].int()
-        detection_classes = detections[:, 5].int()
+        gt_classes = labels[:, 0].long()
+        detection_classes = detections[:, 5].long()
+        m, n = len(labels), len(detections)
+        if not m or not n:  # no matches, only unmatched labels are counted
+            self.matrix[self.nc] += np.bincount(gt_classes.cpu().numpy(), minlength=nc1)  # true background
+            return
         iou = box_iou(labels[:, 1:], detections[:, :4])
 
-        x = torch.where(iou > self.iou_thres)
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-        else:
-            matches = np.zeros((0, 3))
-
-        n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(int)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[detection_classes[m1[j]], gc] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # true background
-
-        if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # predicted background
+        # Greedy matching: every detection takes its highest-IoU label, every label its highest-IoU detection, ties to
+        # the last index as in a stable descending sort
+        best, label = iou.flip(0).max(0)
+        label = m - 1 - label
+        i = best > self.iou_thres  # detections with a match
+        d = torch.arange(n, device=iou.device)
+        max_iou = torch.full((m,), -1.0, device=iou.device).scatter_reduce(0, label[i], best[i], 'amax')
+        i &= best == max_iou[label]
+        det = torch.full((m,), -1, device=iou.device).scatter_reduce(0, label[i], d[i], 'amax')  # -1 if unmatched
+
+        # Accumulate (predicted, true) class pairs
+        matched = det >= 0
+        x = [torch.where(matched, detection_classes[det.clamp(0)], self.nc) * nc1 + gt_classes]  # correct or true bg
+        if matched.any():
+            fp = torch.ones(n, dtype=torch.bool, device=iou.device)
+            fp[det[matched]] = False
+            x.append(detection_classes[fp] * nc1 + self.nc)  # predicted background
+        self.matrix += np.bincount(torch.cat(x).cpu().numpy(), minlength=nc1 * nc1).reshape(nc1, nc1)
 
     def tp_fp(self):
         tp = self.matrix.diagonal()  # true positives
@@ -187,6 +283,7 @@ class ConfusionMatrix:
     def plot(self, normalize=True, save_dir='', names=()):
         import seaborn as sn
 
+        plt = pyplot()
         array = self.matrix / ((self.matrix.sum(0).reshape(1, -1) + 1E-9) if normalize else 1)  # normalize columns
         array[array < 0.005] = np.nan  # don't annotate (would appear as 0.00)
 
@@ -219,6 +316,29 @@ class ConfusionMatrix:
             print(' '.join(map(str, self.matrix[i])))
 
 
+def match_predictions(iou, correct_class, iouv):
+    """
+    Return correct prediction matrix, greedy matching at all IoU thresholds at once
+    Every detection takes its highest-IoU class-matching label (ties to the last label, as in a stable descending sort)
+    and every label keeps the first of its detections whose IoU reaches the threshold.
+    Arguments:
+        iou (Tensor[M, N]), label-detection IoU
+        correct_class (Tensor[M, N]), label and detection classes match
+        iouv (Tensor[T]), IoU thresholds > 0
+    Returns:
+        correct (Tensor[N, T]), for T IoU levels
+    """
+    m, n = iou.shape
+    if not m or not n:
+        return torch.zeros((n, len(iouv)), dtype=torch.bool, device=iouv.device)
+    best, label = (iou * correct_class).flip(0).max(0)  # highest-IoU class-matching label per detection
+    label = (m - 1 - label).expand(len(iouv), n)
+    valid = best >= iouv[:, None]  # (T,N)
+    d = torch.arange(n, device=iou.device).expand(len(iouv), n)
+    first = torch.full((len(iouv), m), n, device=iou.device).scatter_reduce(1, label, torch.where(valid, d, n), 'amin')
+    return (valid & (first.gather(1, label) == d)).T.to(iouv.device)
+
+
 def bbox_iou(box1, box2, xywh=True, GIoU=False, DIoU=False, CIoU=False, eps=1e-7):
     # Returns Intersection over Union (IoU) of box1(1,4) to box2(n,4)
 
@@ -317,6 +437,7 @@ def wh_iou(wh1, wh2, eps=1e-7):
 @threaded
 def plot_pr_curve(px, py, ap, save_dir=Path('pr_curve.png'), names=()):
     # Precision-recall curve
+    plt = pyplot()
     fig, ax = plt.subplots(1, 1, figsize=(9, 6), tight_layout=True)
     py = np.stack(py, axis=1)
 
@@ -340,6 +461,7 @@ def plot_pr_curve(px, py, ap, save_dir=Path('pr_curve.png'), names=()):
 @threaded
 def plot_mc_curve(px, py, save_dir=Path('mc_curve.png'), names=(), xlabel='Confidence', ylabel='Metric'):
     # Metric-confidence curve
+    plt = pyplot()
     fig, ax = plt.subplots(1, 1, figsize=(9, 6), tight_layout=True)
 
     if 0 < len(names) < 21:  # display per-class legend if < 21 classes
@@ -0,0 +1,208 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Run OCC LED-decoding benchmarks
+
+Usage - decode speed, vectorized decoder vs reference loop:
+    $ python utils/occ/benchmarks.py --leds 64 256 1024
+
+Usage - BER and throughput of the Rx.OCC, RX_linh.py and detectLED decoders on synthetic LED-panel video:
+    $ python utils/occ/benchmarks.py --accuracy --frames 300 --blur 1.0 --noise 4 --motion 2
+
+Usage - goodput of per-frame decoding vs multi-frame symbol voting, 3 frames per symbol with rolling shutter:
+    $ python utils/occ/benchmarks.py --goodput --hold 3 --rolling 0.5 --noise 6
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[2]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.general import LOGGER, print_args
+from utils.occ.decode import (FIELDS, GRID, binarize, decode_batch, decode_bits, is_valid, led_boxes, led_centers,
+                              led_grid)
+from utils.occ.pipeline import Latency, Pipeline
+from utils.occ.synthetic import SyntheticLEDs
+from utils.occ.temporal import CachedDecoder, SymbolDecoder
+
+pd.options.display.max_columns = 10
+
+
+def decode_loop(boxes, n=GRID):
+    # Reference nested while/for grid scan from Rx.OCC.__call__, O(cells x LEDs) in pure Python
+    xmin, ymin, xmax, ymax = led_grid(boxes)
+    td = led_centers(boxes).tolist()
+    bit = []
+    dx, dy = (xmax - xmin) / (n - 1), (ymax - ymin) / (n - 1)
+    c = ymin
+    while c <= ymax + 1:
+        b = xmin
+        while b <= xmax + 1:
+            d = 0
+            for j in td:
+                if b <= j[0] <= b + dx and c <= j[1] <= c + dy:
+                    d = 1
+                    break
+            bit.append(d)
+            b = b + dx
+        c += dy
+    return bit
+
+
+def random_boxes(leds, size=160, seed=0):
+    # Return (leds,4) xywh LED boxes scattered on a size x size panel, corners pinned so grid geometry is fixed
+    rng = np.random.default_rng(seed)
+    boxes = np.concatenate((rng.uniform(0, size, (leds, 2)), rng.uniform(4, 8, (leds, 2))), 1).astype(np.float32)
+    boxes[:2, :2] = (0, 0), (size, size)
+    return boxes
+
+
+def decode_speed(leds=(64, 256, 1024), n=100):
+    # Time vectorized decode_bits() against the reference decode_loop() for each LED count
+    y = []
+    for k in leds:
+        boxes = random_boxes(k)
+        t, bits = [], []
+        for f in (decode_loop, lambda b: decode_bits(led_centers(b), led_grid(b))):
+            bits.append(np.asarray(f(boxes)))  # warmup
+            t0 = time.perf_counter()
+            for _ in range(n):
+                f(boxes)
+            t.append((time.perf_counter() - t0) / n * 1E3)  # ms per decode
+        y.append([k, *t, t[0] / t[1], np.array_equal(*bits)])
+    py = pd.DataFrame(y, columns=['LEDs', 'loop (ms)', 'vectorized (ms)', 'speedup', 'match'])
+    LOGGER.info(str(py))
+    return py
+
+
+def rx_linh(frames, boxes):
+    # RX_linh.py decoding, one panel at a time: threshold -> contours -> grid bits
+    dt = {k: Latency() for k in ('threshold', 'contours', 'decode')}
+    bits = []
+    for im, (x1, y1, x2, y2) in zip(frames, np.asarray(boxes).astype(int)):
+        t0 = time.time()
+        thres = binarize(im[y1:y2, x1:x2])
+        t1 = time.time()
+        b = led_boxes(thres, wh=(3, 20))
+        t2 = time.time()
+        bits.append(decode_bits(led_centers(b), led_grid(b)) if len(b) else np.zeros(GRID * GRID, dtype=np.uint8))
+        for k, t in zip(dt, (t1 - t0, t2 - t1, time.time() - t2)):
+            dt[k].add(t)
+    return bits, {f'{k} (ms)': round(v.mean, 3) for k, v in dt.items()}
+
+
+def detect_led(frames, boxes, batch=1):
+    # detect.py --led decoding (LEDDecoder), all panels of a batch at once
+    dt, bits, frames = Latency(), [], list(frames)
+    for i in range(0, len(frames), batch):
+        t = time.time()
+        b = decode_batch(frames[i:i + batch], [x[None] for x in boxes[i:i + batch]], wh=(2, 20))[0]
+        dt.add((time.time() - t) / len(b))
+        bits.extend(x[0] for x in b)
+    return bits, {'decode (ms)': round(dt.mean, 3)}
+
+
+def rx_occ(frames, boxes, workers=2):
+    # Rx.OCC decoding through the asynchronous Pipeline, ground-truth boxes stand in for the tracker
+    it = iter(boxes)
+    pipe = Pipeline(frames, locate=lambda im: next(it)[None], workers=workers, drop=False, wh=(3, 20))
+    bits = [r.bits[0] for r in pipe]
+    return bits, {k: v for k, v in pipe.stats().items() if k.endswith('(ms)')}
+
+
+def accuracy(frames=300, blur=0.0, noise=0.0, exposure=1.0, perspective=0.0, motion=0.0, workers=2, batch=1,
+             write=None):
+    # Report BER, accepted/correct frame rates, FPS and per-stage latency of each decoder on synthetic LED video
+    data = SyntheticLEDs(frames, exposure=exposure, blur=blur, noise=noise, perspective=perspective, motion=motion)
+    if write:
+        data.write(write)
+    ims, truth, boxes = zip(*data)
+    truth, boxes = np.stack(truth), np.stack(boxes)
+    y = []
+    for name, f in (('Rx.OCC', lambda: rx_occ(iter(ims), boxes, workers)),
+                    ('RX_linh.py', lambda: rx_linh(ims, boxes)),
+                    ('detectLED', lambda: detect_led(ims, boxes, batch))):
+        t = time.time()
+        bits, dt = f()
+        fps = len(bits) / (time.time() - t)
+        bits = np.stack(bits)
+        valid = np.array([is_valid(b) for b in bits])
+        y.append({'Decoder': name, 'BER': (bits != truth).mean(), 'header OK': valid.mean(),
+                  'frame OK': (bits == truth).all(1).mean(), 'FPS': fps, **dt})  # per-stage latency columns
+    py = pd.DataFrame(y)
+    LOGGER.info(py.to_string(na_rep='-'))
+    return py
+
+
+def goodput(frames=300, hold=3, rolling=0.0, blur=0.0, noise=0.0, exposure=1.0, perspective=0.0, motion=0.0, fps=30,
+            **kwargs):
+    # Report correct and wrong payloads delivered by per-frame decoding vs multi-frame voting, goodput in payload bits/s
+    data = SyntheticLEDs(frames, exposure=exposure, blur=blur, noise=noise, perspective=perspective, motion=motion,
+                         hold=hold, rolling=rolling)
+    ims, truth, boxes = zip(*data)
+    sent = {tuple(b) for b in truth[::hold]}
+    bps = 8 * (len(FIELDS) - 1) * fps / frames  # payload bits per correct symbol per second of video
+    y = []
+    for name, voting in (('per-frame', False), ('voting', True)):
+        decode, symbols, out = CachedDecoder(), SymbolDecoder(), []
+        t = time.time()
+        for i, (im, box) in enumerate(zip(ims, boxes)):
+            bits, _, levels = decode(im, box[None])
+            if voting:
+                out += [s.bits for _, s in symbols.update(bits, levels, i)]
+            elif is_valid(bits[0]):
+                out.append(bits[0])
+        out += [s.bits for _, s in symbols.flush()] if voting else []
+        dt = time.time() - t
+        got = [tuple(b) for b in out]
+        ok = {b for b in got if b in sent}
+        y.append({'Decoder': name, 'symbols': len(sent), 'delivered': len(got), 'correct': len(ok),
+                  'wrong': sum(b not in sent for b in got), 'goodput (bit/s)': len(ok) * bps, 'FPS': frames / dt,
+                  'cache hits': decode.hits})
+    py = pd.DataFrame(y)
+    LOGGER.info(py.to_string())
+    return py
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--leds', nargs='+', type=int, default=[64, 256, 1024], help='LED counts to decode')
+    parser.add_argument('--n', type=int, default=100, help='iterations per LED count')
+    parser.add_argument('--accuracy', action='store_true', help='benchmark BER and FPS on synthetic video instead')
+    parser.add_argument('--frames', type=int, default=300, help='synthetic frames')
+    parser.add_argument('--blur', type=float, default=0.0, help='Gaussian blur sigma (pixels)')
+    parser.add_argument('--noise', type=float, default=0.0, help='Gaussian noise standard deviation')
+    parser.add_argument('--exposure', type=float, default=1.0, help='LED intensity gain')
+    parser.add_argument('--perspective', type=float, default=0.0, help='corner jitter fraction')
+    parser.add_argument('--motion', type=float, default=0.0, help='panel speed (pixels/frame)')
+    parser.add_argument('--workers', type=int, default=2, help='Rx.OCC pipeline decode threads')
+    parser.add_argument('--batch', type=int, default=1, help='detectLED frames per batch')
+    parser.add_argument('--write', type=str, default=None, help='also save the synthetic video, i.e. leds.mp4')
+    parser.add_argument('--goodput', action='store_true', help='benchmark per-frame decoding vs symbol voting instead')
+    parser.add_argument('--hold', type=int, default=3, help='frames per symbol')
+    parser.add_argument('--rolling', type=float, default=0.0, help='rolling-shutter symbol change row (frame fraction)')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    if opt.goodput:
+        goodput(**{k: v for k, v in vars(opt).items() if k not in ('leds', 'n', 'accuracy', 'goodput')})
+    elif opt.accuracy:
+        accuracy(**{k: v for k, v in vars(opt).items() if k not in ('leds', 'n', 'accuracy', 'goodput', 'hold',
+                                                                        'rolling')})
+    else:
+        decode_speed(opt.leds, opt.n)
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,190 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Optical camera communication (OCC) LED-matrix decoding utils
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+GRID = 8  # LED matrix is GRID x GRID, one bit per LED
+HEADER = 0b10111001  # frame header byte, bits [1, 0, 1, 1, 1, 0, 0, 1]
+FIELDS = ('header', 'temperature', 'humidity', 'distance', 'vibration')  # payload bytes in frame order
+UNITS = {'temperature': '*C', 'humidity': '%', 'distance': 'cm', 'vibration': 'Hz'}
+NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of decoding threads
+
+
+def binarize(im, block=9, c=-30):
+    # Return inverted adaptive-threshold mask of a BGR or grayscale LED panel crop, lit LEDs are 0-valued holes
+    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, block, c)
+
+
+def led_boxes(thres, wh=(3, 20)):
+    # Return LED bounding boxes (n,4) xywh from a binary mask, keeping wh[0] < w, h < wh[1] (exclusive)
+    contours = cv2.findContours(thres, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]  # OpenCV 3 and 4 compatible
+    if not contours:
+        return np.zeros((0, 4), dtype=np.float32)
+    b = np.array([cv2.boundingRect(c) for c in contours], dtype=np.float32)
+    wh_ok = ((b[:, 2:] > wh[0]) & (b[:, 2:] < wh[1])).all(1)
+    return b[wh_ok]
+
+
+def led_grid(boxes):
+    # Return grid geometry (x0, y0, x1, y1) spanned by the top-left corners of LED boxes (n,4) xywh
+    return (*boxes[:, :2].min(0), *boxes[:, :2].max(0))
+
+
+def led_centers(boxes):
+    # Return LED centroids (n,2) from boxes (n,4) xywh
+    return boxes[:, :2] + boxes[:, 2:] / 2
+
+
+def decode_bits(centers, grid, n=GRID, eps=1E-7):
+    """Bin LED centroids into an n x n cell grid in a single vectorized pass.
+
+    Args:
+        centers: (m,2) LED centroids xy
+        grid: (x0, y0, x1, y1) top-left corners of the first and last grid cells, as returned by led_grid()
+        n: cells per side
+
+    Returns:
+        (n*n,) uint8 bit vector in row-major order, 1 where at least one LED centroid falls in the cell
+    """
+    x0, y0, x1, y1 = grid
+    step = np.maximum(np.array((x1 - x0, y1 - y0), dtype=np.float64) / (n - 1), eps)  # cell width, height
+    t = (np.asarray(centers, dtype=np.float64).reshape(-1, 2) - (x0, y0)) / step  # position in cell units
+    ij = np.floor(t).astype(np.int64)  # half-open cells, a centroid on a cell edge lights only the upper cell
+    ij = ij[((ij >= 0) & (ij < n)).all(1)]  # drop centroids outside the grid
+    bits = np.zeros(n * n, dtype=np.uint8)
+    bits[ij[:, 1] * n + ij[:, 0]] = 1
+    return bits
+
+
+def decode_panel(thres, wh=(3, 20), n=GRID):
+    # Return (bits, boxes) for a binary LED panel mask, bits is None if no LEDs are found
+    boxes = led_boxes(thres, wh)
+    if not len(boxes):
+        return None, boxes
+    return decode_bits(led_centers(boxes), led_grid(boxes), n), boxes
+
+
+def decode_crops(crops, wh=(2, 20), n=GRID, block=9, c=-30):
+    """Decode a list of LED panel crops with one threshold and one connected-components pass.
+
+    Crops are packed side by side on a single canvas, each with a block // 2 replicated border so the adaptive
+    threshold inside every crop matches binarize() on that crop alone. LED holes inside the crops are then labelled
+    with one connected-components call, and their boxes grown by 1 pixel per side to match the hole contours found by
+    led_boxes().
+
+    Returns:
+        bits: (k,n*n) uint8 bit vectors
+        leds: (k,) LED counts, 0 where no LED was found in the crop
+    """
+    k = len(crops)
+    bits, leds = np.zeros((k, n * n), dtype=np.uint8), np.zeros(k, dtype=np.int64)
+    if not k:
+        return bits, leds
+
+    # Pack
+    p = block // 2  # border so each crop thresholds in isolation
+    hw = np.array([x.shape[:2] for x in crops]).reshape(-1, 2) + 2 * p
+    xs = np.concatenate(([0], hw[:, 1].cumsum()))  # crop slot x offsets
+    canvas = np.zeros((hw[:, 0].max(), xs[-1]), dtype=np.uint8)
+    inside = np.zeros_like(canvas, dtype=bool)
+    for x, x0, (h, w) in zip(crops, xs, hw):
+        if x.size:
+            x = cv2.cvtColor(x, cv2.COLOR_BGR2GRAY) if x.ndim == 3 else x
+            canvas[:h, x0:x0 + w] = cv2.copyMakeBorder(x, p, p, p, p, cv2.BORDER_REPLICATE)
+            inside[p:h - p, x0 + p:x0 + w - p] = True
+
+    # Label
+    holes = ((binarize(canvas, block, c) == 0) & inside).astype(np.uint8)
+    stats = cv2.connectedComponentsWithStatsWithAlgorithm(holes, 8, cv2.CV_32S, cv2.CCL_GRANA)[2][1:, :4]  # xywh
+    stats = stats.astype(np.float32) + (-1, -1, 2, 2)  # hole to hole-contour box
+    stats = stats[((stats[:, 2:] > wh[0]) & (stats[:, 2:] < wh[1])).all(1)]
+    j = np.searchsorted(xs, stats[:, 0], side='right') - 1  # owner crop index
+    stats[:, 0] -= xs[j]  # crop-relative (border offset is shared by all LEDs of a crop and cancels in decoding)
+
+    # Decode, grid geometry per crop from LED top-left corners
+    leds = np.bincount(j, minlength=k)
+    g = np.full((k, 4), np.inf, dtype=np.float32)  # x0, y0, -x1, -y1
+    np.minimum.at(g, j, np.concatenate((stats[:, :2], -stats[:, :2]), 1))
+    g[:, 2:] *= -1
+    step = np.maximum((g[:, 2:] - g[:, :2]) / (n - 1), 1E-7)[j]
+    ij = np.floor((led_centers(stats) - g[j, :2]) / step).astype(np.int64)
+    i = ((ij >= 0) & (ij < n)).all(1)  # drop centroids outside the grid
+    bits[j[i], ij[i, 1] * n + ij[i, 0]] = 1
+    return bits, leds
+
+
+def crop_boxes(ims, boxes, rgb=False):
+    # Return flat list of BGR panel crops for a list of images and a list of (k,4) xyxy boxes per image, clipped
+    crops = []
+    for im, b in zip(ims, boxes):
+        h, w = im.shape[:2]
+        for x1, y1, x2, y2 in np.asarray(b, dtype=np.float32).reshape(-1, 4).round().astype(int):
+            x1, y1, x2, y2 = max(x1, 0), max(y1, 0), min(x2, w), min(y2, h)
+            crop = im[y1:max(y1, y2), x1:max(x1, x2)]
+            crops.append(np.ascontiguousarray(crop[..., ::-1]) if rgb else crop)  # RGB to BGR
+    return crops
+
+
+def led_levels(crops, n=GRID, contrast=16):
+    """Return soft LED intensities (k,n*n) in [0, 1] for a list of panel crops.
+
+    Each crop is area-averaged down to n x n cells, one per LED, and min-max normalized. `contrast` is the minimum
+    intensity range normalized to [0, 1], so that all-dark or all-lit panels do not amplify noise to full scale.
+    """
+    y = np.zeros((len(crops), n * n), dtype=np.float32)
+    for i, im in enumerate(crops):
+        if im.shape[0] < n or im.shape[1] < n:
+            continue
+        gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+        x = cv2.resize(gray, (n, n), interpolation=cv2.INTER_AREA).reshape(-1).astype(np.float32)
+        lo, hi = x.min(), x.max()
+        y[i] = (x - lo) / max(hi - lo, contrast)
+    return y
+
+
+def decode_batch(ims, boxes, wh=(2, 20), n=GRID, block=9, c=-30, workers=NUM_THREADS, chunk=8, rgb=False):
+    """Decode every LED panel in a batch of images.
+
+    Panels are decoded chunk at a time with decode_crops(), chunks run on a thread pool (OpenCV releases the GIL).
+
+    Args:
+        ims: list of BGR images
+        boxes: list of (k,4) xyxy panel boxes in pixels, one array per image
+        wh: (min, max) exclusive LED box width and height
+        n: cells per side
+        workers: maximum threads, 0 to decode in the calling thread
+        chunk: panels per canvas
+        rgb: images are RGB (i.e. AutoShape inputs), default BGR (cv2)
+
+    Returns:
+        bits: list of (k,n*n) uint8 bit vectors, one array per image
+        leds: list of (k,) LED counts, one array per image
+    """
+    crops = crop_boxes(ims, boxes, rgb)
+    chunks = [crops[i:i + chunk] for i in range(0, len(crops), chunk)]
+    f = lambda x: decode_crops(x, wh, n, block, c)
+    if workers and len(chunks) > 1:
+        with ThreadPool(min(workers, len(chunks))) as pool:
+            y = pool.map(f, chunks)
+    else:
+        y = [f(x) for x in chunks] or [f([])]
+    i = np.cumsum([len(b) for b in boxes])[:-1]  # split per image
+    return np.split(np.concatenate([x[0] for x in y]), i), np.split(np.concatenate([x[1] for x in y]), i)
+
+
+def unpack(bits):
+    # Return {field: int} for the first len(FIELDS) bytes of a bit vector, MSB first
+    b = np.packbits(np.asarray(bits, dtype=np.uint8)[:8 * len(FIELDS)])
+    return dict(zip(FIELDS, b.tolist()))
+
+
+def is_valid(bits):
+    # Frame is valid if its first byte matches HEADER
+    return int(np.packbits(np.asarray(bits[:8], dtype=np.uint8))[0]) == HEADER
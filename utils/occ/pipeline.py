@@ -0,0 +1,252 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Asynchronous capture -> locate -> decode pipeline for OCC receivers
+
+Usage:
+    from utils.occ.pipeline import Pipeline
+
+    pipe = Pipeline('video.mp4', locate=lambda im: [(0, 0, im.shape[1], im.shape[0])])
+    for r in pipe:  # results in capture order
+        print(r.seq, r.bits)
+    print(pipe.stats())
+"""
+
+import heapq
+import math
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+from utils.occ.decode import NUM_THREADS, decode_batch
+
+
+class Latency:
+    # Thread-safe latency counter, milliseconds
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n, self.t, self.max = 0, 0.0, 0.0
+
+    def add(self, dt):
+        dt *= 1E3  # s to ms
+        with self.lock:
+            self.n += 1
+            self.t += dt
+            self.max = max(self.max, dt)
+
+    @property
+    def mean(self):
+        return self.t / self.n if self.n else 0.0
+
+
+class RingBuffer:
+    # Bounded FIFO of timestamped frames. When full, put() drops the oldest frame (drop=True) or blocks (backpressure)
+    def __init__(self, maxlen=8, drop=True):
+        self.buf = deque()
+        self.maxlen, self.drop = maxlen, drop
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, x):
+        with self.cond:
+            if self.drop and len(self.buf) >= self.maxlen:
+                self.buf.popleft()
+                self.dropped += 1
+            while not self.drop and len(self.buf) >= self.maxlen and not self.closed:
+                self.cond.wait()
+            self.buf.append(x)
+            self.cond.notify_all()
+
+    def get(self):
+        # Return oldest item, or None once closed and drained
+        with self.cond:
+            while not self.buf and not self.closed:
+                self.cond.wait()
+            x = self.buf.popleft() if self.buf else None
+            self.cond.notify_all()
+            return x
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.buf)
+
+
+class Result:
+    # Decoded frame: capture index, decode sequence number, capture time, frame, panel boxes (k,4) xyxy, bits (k,64),
+    # LED counts (k,), soft LED levels (k,64) or None
+    __slots__ = 'i', 'seq', 't', 'frame', 'boxes', 'bits', 'leds', 'levels'
+
+    def __init__(self, i, t, frame):
+        self.i, self.seq, self.t, self.frame = i, None, t, frame
+        self.boxes = self.bits = self.leds = self.levels = None
+
+    def __lt__(self, other):
+        return self.seq < other.seq
+
+
+def frames(source):
+    # Yield frames from a camera index, video file or stream URL, an opened cv2.VideoCapture, or any iterable of BGR
+    # images (synthetic sources)
+    if isinstance(source, (str, int, cv2.VideoCapture)):
+        cap = source
+        if not isinstance(cap, cv2.VideoCapture):
+            cap = cv2.VideoCapture(int(source) if str(source).isnumeric() else source)
+        assert cap.isOpened(), f'Failed to open {source}'
+        try:
+            while True:
+                success, im = cap.read()
+                if not success:
+                    break
+                yield im
+        finally:
+            cap.release()
+    else:
+        yield from source
+
+
+class Pipeline:
+    """Staged OCC receiver: capture thread -> locate thread -> decode thread pool -> caller (display sink).
+
+    Capture pushes timestamped frames into a RingBuffer that drops the oldest frame when the receiver falls behind a
+    live camera, or applies backpressure to file and synthetic sources so every frame is decoded. The locate stage runs
+    the (stateful) tracker or detector on one thread, and decoding fans out to a thread pool. Iterating the pipeline
+    yields Results in capture order, so display and logging stay on the calling thread.
+
+    Args:
+        source: camera index, video path/URL, cv2.VideoCapture or iterable of BGR frames
+        locate: callable(frame) -> (k,4) xyxy panel boxes, default whole frame
+        decode: callable(frame, boxes) -> (bits, leds) or (bits, leds, levels), default decode_batch()
+        workers: decode threads
+        buffer: capture ring-buffer length
+        drop: drop oldest frames when full, default True for cameras and streams only
+    """
+
+    def __init__(self, source, locate=None, decode=None, workers=NUM_THREADS, buffer=8, drop=None, wh=(3, 20)):
+        live = isinstance(source, (int, cv2.VideoCapture)) or str(source).isnumeric() or str(source).lower().startswith(
+            ('rtsp://', 'rtmp://', 'http://', 'https://'))
+        self.source = source
+        self.locate = locate or (lambda im: np.array([[0, 0, im.shape[1], im.shape[0]]], dtype=np.float32))
+        self.decode = decode or (lambda im, b: tuple(x[0] for x in decode_batch([im], [b], wh=wh, workers=0)))
+        self.workers = max(workers, 1)
+        self.frames = RingBuffer(buffer, live if drop is None else drop)  # capture -> locate
+        self.jobs = RingBuffer(2 * self.workers, drop=False)  # locate -> decode, backpressure
+        self.results = queue.Queue(2 * self.workers)  # decode -> caller, backpressure from a slow caller
+        self.dt = {k: Latency() for k in ('capture', 'locate', 'decode', 'total')}
+        self.captured = 0
+        self.running = False
+        self.error = None
+
+    def start(self):
+        self.running = True
+        self.t0 = time.time()
+        self.threads = [threading.Thread(target=self._capture, daemon=True),
+                        threading.Thread(target=self._locate, daemon=True)]
+        self.pool = ThreadPool(self.workers)
+        for _ in range(self.workers):
+            self.pool.apply_async(self._decode)
+        for t in self.threads:
+            t.start()
+        return self
+
+    def stop(self):
+        # Stop capturing, pending frames are still decoded and yielded
+        self.running = False
+
+    def _capture(self):
+        t = time.time()
+        try:
+            for i, im in enumerate(frames(self.source)):
+                if not self.running:
+                    break
+                now = time.time()
+                self.dt['capture'].add(now - t)
+                self.frames.put(Result(i, now, im))
+                self.captured += 1
+                t = time.time()
+        except Exception as e:  # re-raised by __iter__
+            self.error = e
+            self.stop()
+        finally:
+            self.frames.close()
+
+    def _locate(self):
+        seq = 0
+        try:
+            while True:
+                r = self.frames.get()
+                if r is None:
+                    break
+                r.seq, seq = seq, seq + 1  # consecutive over frames that survived the ring buffer
+                t = time.time()
+                r.boxes = np.asarray(self.locate(r.frame), dtype=np.float32).reshape(-1, 4)
+                self.dt['locate'].add(time.time() - t)
+                self.jobs.put(r)
+        except Exception as e:  # re-raised by __iter__
+            self.error = e
+            self.stop()
+            self.frames.close()
+        finally:
+            self.jobs.close()
+
+    def _decode(self):
+        try:
+            while True:
+                r = self.jobs.get()
+                if r is None:
+                    break
+                t = time.time()
+                y = self.decode(r.frame, r.boxes)
+                r.bits, r.leds = y[:2]
+                r.levels = y[2] if len(y) > 2 else None
+                self.dt['decode'].add(time.time() - t)
+                self.results.put(r)
+        except Exception as e:  # re-raised by __iter__
+            self.error = e
+            self.stop()
+            self.jobs.close()
+        finally:
+            self.results.put(None)  # one end-of-stream marker per worker
+
+    def __iter__(self):
+        # Yield Results in capture order, reordering the out-of-order output of the decode pool
+        if not self.running:
+            self.start()
+        heap, done, seq = [], 0, 0
+        while done < self.workers or heap:
+            if done < self.workers:
+                r = self.results.get()
+                if r is None:
+                    done += 1
+                else:
+                    heapq.heappush(heap, r)
+            while heap and (heap[0].seq == seq or done == self.workers):
+                r = heapq.heappop(heap)
+                seq = r.seq + 1
+                self.dt['total'].add(time.time() - r.t)
+                yield r
+        self.pool.close()
+        self.elapsed = time.time() - self.t0
+        if self.error:
+            raise self.error
+
+    def stats(self):
+        # Return per-stage latency (ms), frame counters and throughput (FPS)
+        elapsed = getattr(self, 'elapsed', None) or (time.time() - self.t0)
+        n = self.dt['total'].n
+        s = {f'{k} (ms)': round(v.mean, 3) for k, v in self.dt.items()}
+        s.update({
+            'max total (ms)': round(self.dt['total'].max, 3),
+            'captured': self.captured,
+            'dropped': self.frames.dropped,
+            'decoded': n,
+            'FPS': round(n / elapsed, 2) if elapsed > 0 else math.nan})
+        return s
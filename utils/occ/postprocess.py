@@ -0,0 +1,93 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Post-NMS OCC LED-panel decoding stage for detect.py and AutoShape
+
+Usage - detect.py:
+    $ python detect.py --weights leds.pt --source 0 --led --led-vote
+
+Usage - PyTorch Hub / AutoShape:
+    from utils.occ.postprocess import LEDDecoder
+
+    model = torch.hub.load('ultralytics/yolov5', 'custom', 'leds.pt')
+    model.led = LEDDecoder(rgb=True)  # AutoShape images are RGB
+    results = model(im)
+    results.payloads[0]  # pandas DataFrame, one row per detection
+"""
+
+import numpy as np
+import torch
+
+from utils.general import scale_boxes
+from utils.occ.decode import FIELDS, NUM_THREADS, UNITS, crop_boxes, decode_batch, is_valid, led_levels, unpack
+from utils.occ.temporal import SymbolDecoder
+
+COLUMNS = ('leds', 'valid', 'confidence', *FIELDS)  # payload table columns, one row per detection
+
+
+class LEDDecoder:
+    """Decode the LED panel inside every detection box of a batch, after NMS.
+
+    Returns one (k,len(COLUMNS)) float32 payload table per image, rows in detection order: LED count, header valid,
+    confidence and the payload fields. Without voting confidence is 1 for valid frames and 0 otherwise. With voting,
+    rows carry the latest symbol voted for the same (image, detection index) transmitter, so detections should be
+    stable in order, i.e. one panel per stream.
+
+    Args:
+        wh: (min, max) exclusive LED box width and height
+        classes: decode only these classes, default all
+        vote: vote payloads across frames with utils.occ.temporal.SymbolDecoder
+        rgb: images are RGB (AutoShape), default BGR (cv2, detect.py)
+        workers: decode threads
+    """
+
+    def __init__(self, wh=(2, 20), classes=None, vote=False, rgb=False, workers=NUM_THREADS):
+        self.wh, self.classes, self.rgb, self.workers = wh, classes, rgb, workers
+        self.symbols = SymbolDecoder() if vote else None
+        self.last = {}  # latest voted Symbol per transmitter key
+        self.seq = 0
+
+    def __call__(self, ims, pred, shape=None):
+        """Return payload tables for a list of images and their (n,6) xyxy, conf, cls detections.
+
+        Args:
+            ims: list of images
+            pred: list of (n,6) detection tensors or arrays
+            shape: (h, w) inference shape of pred boxes, None if already in image pixels
+        """
+        boxes = []
+        for im, det in zip(ims, pred):
+            b = det[:, :4].clone() if isinstance(det, torch.Tensor) else np.array(det[:, :4])
+            if shape is not None:
+                b = scale_boxes(shape, b, im.shape)
+            b = b.cpu().numpy() if isinstance(b, torch.Tensor) else b
+            if self.classes is not None:
+                cls = det[:, 5].cpu().numpy() if isinstance(det, torch.Tensor) else det[:, 5]
+                b = np.where(np.isin(cls, self.classes)[:, None], b, 0)  # zero-size boxes decode to nothing
+            boxes.append(b)
+        bits, leds = decode_batch(ims, boxes, self.wh, workers=self.workers, rgb=self.rgb)
+
+        tables = []
+        for i, (b, k) in enumerate(zip(bits, leds)):
+            t = np.zeros((len(b), len(COLUMNS)), dtype=np.float32)
+            t[:, 0] = k
+            if self.symbols is None:
+                for j, x in enumerate(b):
+                    t[j, 1] = t[j, 2] = is_valid(x)
+                    t[j, 3:] = list(unpack(x).values())
+            else:
+                keys = [(i, j) for j in range(len(b))]
+                levels = led_levels(crop_boxes([ims[i]], [boxes[i]], self.rgb))
+                self.last.update(self.symbols.update(b, levels, self.seq, keys))
+                for j, key in enumerate(keys):
+                    if key in self.last:
+                        s = self.last[key]
+                        t[j, 1:3] = is_valid(s.bits), s.confidence
+                        t[j, 3:] = list(s.payload.values())
+            tables.append(t)
+        self.seq += 1
+        return tables
+
+
+def payload_label(row):
+    # Return short payload annotation, i.e. '25*C 60% 120cm 3Hz', for a valid payload table row, '' otherwise
+    return ' '.join(f'{int(v)}{UNITS[k]}' for k, v in zip(FIELDS[1:], row[4:])) if row[1] else ''
@@ -0,0 +1,131 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Synthetic OCC LED-panel video generator
+
+Usage:
+    from utils.occ.synthetic import SyntheticLEDs
+
+    for frame, bits, box in SyntheticLEDs(n=100, blur=1.0, noise=4):  # in-memory iterator
+        ...
+    SyntheticLEDs(n=300, motion=2).write('leds.mp4')  # video file
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+from utils.occ.decode import FIELDS, GRID, HEADER
+
+TRAILER = 0b10000001  # last byte lights the bottom corner LEDs so decoders can recover the full grid extent
+
+
+def encode(payload, trailer=TRAILER, n=GRID):
+    # Return (n*n,) uint8 bits for a {field: int} payload, HEADER first, MSB first, trailer in the last byte
+    b = np.zeros(n * n // 8, dtype=np.uint8)
+    b[:len(FIELDS)] = [HEADER] + [payload.get(k, 0) for k in FIELDS[1:]]
+    b[-1] = trailer
+    return np.unpackbits(b)
+
+
+def render_panel(bits, pitch=12, radius=3, on=255, off=40, n=GRID):
+    # Return a grayscale panel image with one disc per LED, lit LEDs at intensity on, dark LEDs at intensity off
+    s = n * pitch
+    im = np.full((s, s), 10, dtype=np.uint8)
+    for k, b in enumerate(bits):
+        c = (pitch // 2 + pitch * (k % n), pitch // 2 + pitch * (k // n))
+        cv2.circle(im, c, radius, on if b else off, -1, cv2.LINE_AA)
+    return im
+
+
+class SyntheticLEDs:
+    """Iterator of (frame, bits, box) for an 8x8 LED panel carrying random payloads.
+
+    Args:
+        n: number of frames
+        size: frame (height, width)
+        pitch: LED spacing in pixels
+        radius: LED radius in pixels
+        exposure: LED intensity gain, <1 under-exposed, >1 saturated
+        blur: Gaussian blur sigma in pixels
+        noise: additive Gaussian noise standard deviation
+        perspective: random corner jitter as a fraction of panel size
+        motion: panel speed in pixels per frame, also the motion-blur length
+        hold: frames each payload is held, i.e. camera FPS / symbol rate
+        rolling: rolling-shutter readout position of symbol changes as a fraction of frame height, rows above it still
+            show the previous symbol in the first frame of a new symbol, 0 for global shutter
+        seed: random seed
+    """
+
+    def __init__(self, n=100, size=(480, 640), pitch=12, radius=3, exposure=1.0, blur=0.0, noise=0.0,
+                 perspective=0.0, motion=0.0, hold=1, rolling=0.0, seed=0):
+        self.n, self.size, self.pitch, self.radius = n, size, pitch, radius
+        self.exposure, self.blur, self.noise, self.perspective, self.motion = exposure, blur, noise, perspective, motion
+        self.hold, self.rolling = max(hold, 1), rolling
+        self.seed = seed
+
+    def __len__(self):
+        return self.n
+
+    def payloads(self, rng):
+        # Random {field: int} payload
+        return {k: int(v) for k, v in zip(FIELDS[1:], rng.integers(0, 256, len(FIELDS) - 1))}
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        h, w = self.size
+        s = GRID * self.pitch  # panel size
+        pos = np.array((w - s, h - s), dtype=np.float32) / 2  # panel top-left corner
+        angle = rng.uniform(0, 2 * math.pi)
+        v = self.motion * np.array((math.cos(angle), math.sin(angle)), dtype=np.float32)  # velocity, pixels per frame
+        panel = None
+        for i in range(self.n):
+            old = None
+            if i % self.hold == 0:
+                old = panel
+                bits = encode(self.payloads(rng))
+                panel = render_panel(bits, self.pitch, self.radius, on=min(255, 255 * self.exposure),
+                                     off=min(255, 40 * self.exposure))
+
+            # Move, bouncing off frame edges
+            pos += v
+            for j, lim in enumerate((w - s, h - s)):
+                if not 0 <= pos[j] <= lim:
+                    v[j] *= -1
+                    pos[j] = np.clip(pos[j], 0, lim)
+
+            # Warp panel into frame
+            src = np.array(((0, 0), (s, 0), (s, s), (0, s)), dtype=np.float32)
+            dst = src + pos + rng.uniform(-1, 1, (4, 2)).astype(np.float32) * self.perspective * s
+            M = cv2.getPerspectiveTransform(src, dst)
+            im = cv2.warpPerspective(panel, M, (w, h), borderValue=0)
+            if self.rolling and old is not None:  # rows read out before the symbol change
+                y = int(self.rolling * h)
+                im[:y] = cv2.warpPerspective(old, M, (w, h), borderValue=0)[:y]
+
+            # Camera effects
+            if self.motion:
+                k = max(int(round(self.motion)), 1)
+                kernel = np.zeros((2 * k + 1, 2 * k + 1), dtype=np.float32)
+                d = v / (np.linalg.norm(v) + 1E-7) * k
+                cv2.line(kernel, (int(k - d[0]), int(k - d[1])), (int(k + d[0]), int(k + d[1])), 1.0)
+                im = cv2.filter2D(im, -1, kernel / kernel.sum())
+            if self.blur:
+                im = cv2.GaussianBlur(im, (0, 0), self.blur)
+            if self.noise:
+                im = np.clip(im + rng.normal(0, self.noise, im.shape), 0, 255).astype(np.uint8)
+
+            box = np.concatenate((dst.min(0), dst.max(0))).clip(0, (w, h, w, h))  # xyxy
+            yield cv2.cvtColor(im, cv2.COLOR_GRAY2BGR), bits, box
+
+    def write(self, file, fps=30):
+        # Write frames to a video file, return (bits, boxes) ground truth
+        h, w = self.size
+        writer = cv2.VideoWriter(str(file), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        bits, boxes = [], []
+        for im, b, box in self:
+            writer.write(im)
+            bits.append(b)
+            boxes.append(box)
+        writer.release()
+        return np.stack(bits), np.stack(boxes)
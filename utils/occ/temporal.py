@@ -0,0 +1,218 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Temporal multi-frame voting and symbol synchronization for OCC receivers
+
+The camera samples each transmitted 8x8 symbol over several frames (camera FPS > symbol rate). Instead of accepting or
+rejecting every frame on its own, frames are accumulated per transmitter until a symbol boundary is detected, and the
+symbol is emitted once, majority-voted over all of its frames with a confidence score.
+
+Usage:
+    from utils.occ.pipeline import Pipeline
+    from utils.occ.temporal import CachedDecoder, SymbolDecoder
+
+    symbols = SymbolDecoder()
+    for r in Pipeline('video.mp4', decode=CachedDecoder()):
+        for key, s in symbols.update(r.bits, r.levels, r.seq):
+            print(key, s.payload, s.confidence)
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.occ.decode import GRID, crop_boxes, decode_crops, is_valid, led_levels, unpack
+
+
+class Symbol:
+    # Decoded symbol: voted bits (n*n,), {field: int} payload, confidence in [0, 1], frames voted, first frame seq
+    __slots__ = 'bits', 'payload', 'confidence', 'frames', 'seq'
+
+    def __init__(self, bits, confidence, frames, seq):
+        self.bits, self.confidence, self.frames, self.seq = bits, confidence, frames, seq
+        self.payload = unpack(bits)
+
+    def __repr__(self):
+        return f'Symbol(seq={self.seq}, frames={self.frames}, confidence={self.confidence:.3f}, payload={self.payload})'
+
+
+class SymbolVoter:
+    """Per-transmitter frame accumulator with rolling-shutter-aware symbol boundary detection.
+
+    Each frame contributes per-LED evidence in [0, 1], a blend of the hard decoded bits and the soft LED levels. A frame
+    whose rows disagree with the running vote marks a candidate boundary. Rolling-shutter sensors read rows top to
+    bottom, so a frame captured across a symbol change shows the old symbol in its top rows and the new symbol below:
+    rows above the first disagreeing row are still voted into the current symbol, the rest seed the next one. A
+    candidate is confirmed when the next frame agrees with it, or discarded as an outlier (bad threshold, glare) when
+    the next frame agrees with the current symbol, so one bad frame no longer costs a whole symbol.
+
+    Args:
+        n: cells per side
+        change: fraction of mismatching LEDs above which a row is changed, default any LED
+        soft: weight of soft LED levels against hard bits in the per-frame evidence, >0.5 lets the levels overrule a
+            bad threshold and the bits break ties between ambiguous levels
+        max_frames: emit the symbol after this many frames even without a boundary, i.e. the known frames per symbol
+    """
+
+    def __init__(self, n=GRID, change=0.1, soft=0.6, max_frames=None):
+        self.n, self.change, self.soft, self.max_frames = n, change, soft, max_frames
+        self.sum = np.zeros((n, n), dtype=np.float32)  # evidence sum per LED
+        self.count = np.zeros(n, dtype=np.float32)  # frames per row
+        self.seq = None  # first frame of the current symbol
+        self.pending = None  # candidate boundary frame (evidence, first changed row, seq)
+        self.outliers = 0
+
+    def evidence(self, bits, levels=None):
+        # Return (n,n) per-LED evidence in [0, 1]
+        e = np.asarray(bits, dtype=np.float32)
+        if levels is not None and self.soft:
+            e = (1 - self.soft) * e + self.soft * np.asarray(levels, dtype=np.float32)
+        return e.reshape(self.n, self.n)
+
+    def changed(self, e, sum, count):
+        # Return (n,) bool rows of evidence e that disagree with the vote sum/count, rows without votes never disagree
+        seen = count > 0
+        p = sum / np.maximum(count, 1)[:, None]
+        return seen & ((np.abs(e - p) > 0.5).mean(1) > self.change)
+
+    def add(self, e, seq, rows=slice(None)):
+        if self.seq is None:
+            self.seq = seq
+        self.sum[rows] += e[rows]
+        self.count[rows] += 1
+
+    def emit(self):
+        # Return the current Symbol and reset, None if no frames were voted
+        if not self.count.any():
+            return None
+        p = self.sum / np.maximum(self.count, 1)[:, None]
+        s = Symbol((p > 0.5).astype(np.uint8).reshape(-1), float(np.abs(2 * p - 1).mean()), int(self.count.max()),
+                   self.seq)
+        self.sum[:], self.count[:], self.seq = 0, 0, None
+        return s
+
+    def update(self, bits, levels=None, seq=None):
+        # Add one frame, return the list of completed Symbols (usually empty, one at a symbol boundary)
+        e, out = self.evidence(bits, levels), []
+        if self.pending is not None:
+            pe, r, pseq = self.pending
+            self.pending = None
+            if not self.count.any():  # no current symbol, the candidate starts one
+                self.add(pe, pseq)
+            elif not self.changed(e, self.sum, self.count).any():  # pending frame was an outlier
+                self.outliers += 1
+            else:
+                self.add(pe, pseq, slice(0, r))  # rolling shutter: rows above the change belong to the old symbol
+                out.append(self.emit())
+                self.add(pe, pseq, slice(r, None))
+                if self.changed(e, self.sum, self.count).any():  # disagrees with the candidate too, 1-frame symbol
+                    self.add(pe, pseq, slice(0, r))  # assume rows above the change were unchanged
+                    out.append(self.emit())
+                    self.pending = e, 0, seq
+                    return [s for s in out if s]
+        rows = self.changed(e, self.sum, self.count)
+        if rows.any():
+            self.pending = e, int(rows.argmax()), seq  # candidate boundary, confirmed or rejected by the next frame
+        else:
+            self.add(e, seq)
+            if self.max_frames and self.count.max() >= self.max_frames:
+                out.append(self.emit())
+        return [s for s in out if s]
+
+    def flush(self):
+        # Emit the last symbol at end of stream
+        if self.pending is not None:
+            pe, r, pseq = self.pending
+            self.pending = None
+            if self.count.any():
+                self.add(pe, pseq, slice(0, r))
+                s = self.emit()
+                self.add(pe, pseq, slice(r, None))
+                self.add(pe, pseq, slice(0, r))
+                return [x for x in (s, self.emit()) if x]
+            self.add(pe, pseq)
+        return [s for s in (self.emit(),) if s]
+
+
+class SymbolDecoder:
+    """Temporal decoder stage for several transmitters, i.e. the panels of a stream in a fixed (tracked) order.
+
+    Args:
+        valid: emit only symbols whose voted header is valid
+        min_confidence: emit only symbols at or above this confidence
+        kwargs: SymbolVoter() arguments
+    """
+
+    def __init__(self, valid=True, min_confidence=0.0, **kwargs):
+        self.valid, self.min_confidence, self.kwargs = valid, min_confidence, kwargs
+        self.voters = {}
+
+    def _filter(self, key, symbols):
+        return [(key, s) for s in symbols
+                if (not self.valid or is_valid(s.bits)) and s.confidence >= self.min_confidence]
+
+    def update(self, bits, levels=None, seq=None, keys=None):
+        """Vote one frame's panels, return completed [(key, Symbol), ...].
+
+        Args:
+            bits: (k,n*n) decoded bits, one row per panel
+            levels: (k,n*n) soft LED levels or None
+            seq: frame sequence number
+            keys: k transmitter keys, default panel index
+        """
+        out = []
+        for j, b in enumerate(bits):
+            key = j if keys is None else keys[j]
+            if key not in self.voters:
+                self.voters[key] = SymbolVoter(**self.kwargs)
+            out += self._filter(key, self.voters[key].update(b, None if levels is None else levels[j], seq))
+        return out
+
+    def flush(self):
+        # Emit the last symbol of every transmitter
+        return [x for key, v in self.voters.items() for x in self._filter(key, v.flush())]
+
+
+class CachedDecoder:
+    """Pipeline decode stage returning (bits, leds, levels), with an LRU cache of panel crops.
+
+    Cameras and streams repeat frames (duplicated reads, held symbols on static scenes), and a repeated crop is looked
+    up by its CRC32 instead of being re-thresholded and re-labelled.
+
+    Args:
+        wh: (min, max) exclusive LED box width and height
+        n: cells per side
+        maxsize: cached crops
+    """
+
+    def __init__(self, wh=(2, 20), n=GRID, maxsize=64):
+        self.wh, self.n, self.maxsize = wh, n, maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __call__(self, im, boxes):
+        crops = crop_boxes([im], [boxes])
+        keys = [(zlib.crc32(np.ascontiguousarray(x)), x.shape) for x in crops]
+        y = [None] * len(crops)
+        with self.lock:
+            for i, k in enumerate(keys):
+                if k in self.cache:
+                    self.cache.move_to_end(k)
+                    y[i] = self.cache[k]
+        miss = [i for i, x in enumerate(y) if x is None]
+        if miss:
+            bits, leds = decode_crops([crops[i] for i in miss], self.wh, self.n)
+            levels = led_levels([crops[i] for i in miss], self.n)
+            with self.lock:
+                for i, b, k, lv in zip(miss, bits, leds, levels):
+                    y[i] = self.cache[keys[i]] = b, k, lv
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+        self.hits += len(crops) - len(miss)
+        self.misses += len(miss)
+        n2 = self.n * self.n
+        if not y:
+            return np.zeros((0, n2), dtype=np.uint8), np.zeros(0, dtype=np.int32), np.zeros((0, n2), dtype=np.float32)
+        return tuple(np.stack(x) for x in zip(*y))
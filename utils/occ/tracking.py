@@ -0,0 +1,159 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Detector-seeded LED-panel tracking for OCC receivers
+
+Usage:
+    from utils.occ.pipeline import Pipeline
+    from utils.occ.tracking import DetectorTracker, yolo_detector
+
+    locate = DetectorTracker(yolo_detector('leds.pt'), interval=30)  # YOLO every 30 frames, tracker in between
+    for r in Pipeline('video.mp4', locate=locate):
+        ...
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+
+class BoxTracker:
+    """Cheap single-box tracker: constant-velocity prediction refined by normalized cross-correlation.
+
+    The template includes a `pad` border of background around the box and is blurred, so the match locks onto the
+    panel outline rather than the LED pattern, which changes with every symbol. The match score doubles as the tracking
+    confidence.
+
+    Args:
+        margin: search window padding as a fraction of the larger box side
+        pad: template context border as a fraction of the larger box side
+        blur: template blur sigma as a fraction of the larger box side
+    """
+
+    def __init__(self, margin=0.5, pad=0.25, blur=1 / 16):
+        self.margin, self.pad, self.blur = margin, pad, blur
+        self.box, self.template, self.score = None, None, 0.0
+        self.v = np.zeros(2, dtype=np.float32)  # velocity, pixels per frame
+
+    def _gray(self, im):
+        # Grayscale, downsampled by self.k (area interpolation) and blurred
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+        if self.k > 1:
+            im = cv2.resize(im, (im.shape[1] // self.k, im.shape[0] // self.k), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(im, (0, 0), self.sigma / self.k)
+
+    def init(self, frame, box):
+        # Start tracking xyxy box in frame
+        h, w = frame.shape[:2]
+        box = np.asarray(box, dtype=np.float32).clip(0, (w, h, w, h))
+        s = (box[2:] - box[:2]).max()
+        if s < 2:
+            self.box = None
+            return False
+        x1, y1, x2, y2 = (box + np.array((-1, -1, 1, 1)) * self.pad * s).clip(0, (w, h, w, h)).round().astype(int)
+        self.offset = box - (x1, y1, x1, y1)  # box relative to template top-left
+        self.sigma = max(self.blur * s, 0.5)
+        self.k = max(int(self.sigma / 2), 1)  # downsample factor, blur makes full resolution redundant
+        self.template = self._gray(frame[y1:y2, x1:x2])
+        self.box = box
+        self.v[:] = 0
+        self.score = 1.0
+        return True
+
+    def update(self, frame):
+        # Return (ok, xyxy box, score) for the next frame
+        if self.box is None:
+            return False, None, 0.0
+        h, w = frame.shape[:2]
+        th, tw = (x * self.k for x in self.template.shape)
+        x1, y1 = self.box[:2] - self.offset[:2] + self.v  # predicted template top-left
+        m = self.margin * max(tw, th)
+        sx1, sy1 = int(max(x1 - m, 0)), int(max(y1 - m, 0))
+        sx2, sy2 = int(min(x1 + tw + m, w)), int(min(y1 + th + m, h))
+        if sx2 - sx1 < tw or sy2 - sy1 < th:  # panel left the frame
+            self.box, self.score = None, 0.0
+            return False, None, 0.0
+        res = cv2.matchTemplate(self._gray(frame[sy1:sy2, sx1:sx2]), self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(res)
+        dx, dy = dx * self.k, dy * self.k
+        box = self.offset + (sx1 + dx, sy1 + dy, sx1 + dx, sy1 + dy)
+        self.v = 0.5 * self.v + 0.5 * (box[:2] - self.box[:2])
+        self.box, self.score = box.astype(np.float32), float(score)
+        return True, self.box, self.score
+
+
+class DetectorTracker:
+    """Pipeline locate stage: a detector seeds panel boxes and BoxTrackers propagate them between detector runs.
+
+    The detector runs every `interval` frames, whenever a tracker's confidence falls below `min_score`, and on every
+    frame while no panel is tracked (re-acquisition). Without a detector, boxes are seeded manually with seed().
+
+    Args:
+        detect: callable(frame) -> (k,4) xyxy boxes sorted by confidence, or None for manual seeding
+        interval: frames between detector runs while tracking
+        min_score: tracker confidence below which the detector re-runs (or the box is dropped in manual mode)
+        max_panels: maximum panels tracked at once
+    """
+
+    def __init__(self, detect=None, interval=30, min_score=0.6, max_panels=1):
+        self.detect, self.interval, self.min_score, self.max_panels = detect, interval, min_score, max_panels
+        self.trackers = []
+        self.pending = None  # boxes from seed(), applied on the locate thread
+        self.lock = threading.Lock()
+        self.age = 0  # frames since last detector run
+        self.detections, self.updates = 0, 0  # detector and tracker calls
+
+    def seed(self, boxes):
+        # Thread-safe manual (re)initialization with (k,4) xyxy boxes, i.e. from cv2.selectROI() on the display thread
+        with self.lock:
+            self.pending = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+    def _init(self, frame, boxes):
+        self.trackers = []
+        for b in boxes[:self.max_panels]:
+            t = BoxTracker()
+            if t.init(frame, b):
+                self.trackers.append(t)
+        self.age = 0
+
+    def __call__(self, frame):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            self._init(frame, pending)
+            return np.stack([t.box for t in self.trackers]) if self.trackers else np.zeros((0, 4), dtype=np.float32)
+
+        # Track
+        boxes, weak = [], not self.trackers
+        for t in self.trackers:
+            ok, box, score = t.update(frame)
+            self.updates += 1
+            if ok and score >= self.min_score:
+                boxes.append(box)
+            else:
+                weak = True
+        self.trackers = [t for t in self.trackers if t.box is not None and t.score >= self.min_score]
+        self.age += 1
+
+        # Detect (seed or re-acquire)
+        if self.detect is not None and (weak or self.age >= self.interval):
+            det = np.asarray(self.detect(frame), dtype=np.float32).reshape(-1, 4)
+            self.detections += 1
+            self._init(frame, det)
+            boxes = [t.box for t in self.trackers]
+        return np.stack(boxes) if boxes else np.zeros((0, 4), dtype=np.float32)
+
+
+def yolo_detector(weights='yolov5s.pt', device='', imgsz=640, conf_thres=0.25, iou_thres=0.45, classes=None,
+                  max_det=10):
+    # Return callable(BGR frame) -> (k,4) xyxy boxes sorted by confidence, from a DetectMultiBackend YOLOv5 model
+    from models.common import AutoShape, DetectMultiBackend
+    from utils.torch_utils import select_device
+
+    model = AutoShape(DetectMultiBackend(weights, device=select_device(device)), verbose=False)
+    model.conf, model.iou, model.classes, model.max_det = conf_thres, iou_thres, classes, max_det
+
+    def detect(frame):
+        return model(frame[..., ::-1], size=imgsz).xyxy[0][:, :4].cpu().numpy()  # BGR to RGB
+
+    return detect
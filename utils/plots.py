@@ -11,15 +11,11 @@ from pathlib import Path
 from urllib.error import URLError
 
 import cv2
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sn
 import torch
 from PIL import Image, ImageDraw, ImageFont
 
-from utils import TryExcept, threaded
+from utils import TryExcept, pyplot, threaded
 from utils.general import (CONFIG_DIR, FONT, LOGGER, check_font, check_requirements, clip_boxes, increment_path,
                            is_ascii, xywh2xyxy, xyxy2xywh)
 from utils.metrics import fitness
@@ -27,8 +23,6 @@ from utils.segment.general import scale_image
 
 # Settings
 RANK = int(os.getenv('RANK', -1))
-matplotlib.rc('font', **{'size': 11})
-matplotlib.use('Agg')  # for writing to files only
 
 
 class Colors:
@@ -174,6 +168,7 @@ def feature_visualization(x, module_type, stage, n=32, save_dir=Path('runs/detec
     n:              Maximum number of feature maps to plot
     save_dir:       Directory to save results
     """
+    plt = pyplot()
     if 'Detect' not in module_type:
         batch, channels, height, width = x.shape  # batch, channels, height, width
         if height > 1 and width > 1:
@@ -293,6 +288,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None):
 
 def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     # Plot LR simulating training for full epochs
+    plt = pyplot()
     optimizer, scheduler = copy(optimizer), copy(scheduler)  # do not modify originals
     y = []
     for _ in range(epochs):
@@ -310,6 +306,7 @@ def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
 
 def plot_val_txt():  # from utils.plots import *; plot_val()
     # Plot val.txt histograms
+    plt = pyplot()
     x = np.loadtxt('val.txt', dtype=np.float32)
     box = xyxy2xywh(x[:, :4])
     cx, cy = box[:, 0], box[:, 1]
@@ -327,6 +324,7 @@ def plot_val_txt():  # from utils.plots import *; plot_val()
 
 def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
     # Plot targets.txt histograms
+    plt = pyplot()
     x = np.loadtxt('targets.txt', dtype=np.float32).T
     s = ['x targets', 'y targets', 'width targets', 'height targets']
     fig, ax = plt.subplots(2, 2, figsize=(8, 8), tight_layout=True)
@@ -340,6 +338,7 @@ def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
 
 def plot_val_study(file='', dir='', x=None):  # from utils.plots import *; plot_val_study()
     # Plot file=study.txt generated by val.py (or plot all study*.txt in dir)
+    plt = pyplot()
     save_dir = Path(file).parent if file else Path(dir)
     plot2 = False  # plot additional results
     if plot2:
@@ -386,6 +385,11 @@ def plot_val_study(file='', dir='', x=None):  # from utils.plots import *; plot_
 @TryExcept()  # known issue https://github.com/ultralytics/yolov5/issues/5395
 def plot_labels(labels, names=(), save_dir=Path('')):
     # plot dataset labels
+    import matplotlib
+    import pandas as pd
+    import seaborn as sn
+
+    plt = pyplot()
     LOGGER.info(f"Plotting labels to {save_dir / 'labels.jpg'}... ")
     c, b = labels[:, 0], labels[:, 1:].transpose()  # classes, boxes
     nc = int(c.max() + 1)  # number of classes
@@ -433,6 +437,8 @@ def imshow_cls(im, labels=None, pred=None, names=None, nmax=25, verbose=False, f
     # Show classification image grid with labels (optional) and predictions (optional)
     from utils.augmentations import denormalize
 
+    plt = pyplot()
+
     names = names or [f'class{i}' for i in range(1000)]
     blocks = torch.chunk(denormalize(im.clone()).cpu().float(), len(im),
                          dim=0)  # select batch index 0, block by channels
@@ -460,6 +466,10 @@ def imshow_cls(im, labels=None, pred=None, names=None, nmax=25, verbose=False, f
 
 def plot_evolve(evolve_csv='path/to/evolve.csv'):  # from utils.plots import *; plot_evolve()
     # Plot evolve.csv hyp evolution results
+    import matplotlib
+    import pandas as pd
+
+    plt = pyplot()
     evolve_csv = Path(evolve_csv)
     data = pd.read_csv(evolve_csv)
     keys = [x.strip() for x in data.columns]
@@ -487,6 +497,9 @@ def plot_evolve(evolve_csv='path/to/evolve.csv'):  # from utils.plots import *;
 
 def plot_results(file='path/to/results.csv', dir=''):
     # Plot training results.csv. Usage: from utils.plots import *; plot_results('path/to/results.csv')
+    import pandas as pd
+
+    plt = pyplot()
     save_dir = Path(file).parent if file else Path(dir)
     fig, ax = plt.subplots(2, 5, figsize=(12, 6), tight_layout=True)
     ax = ax.ravel()
@@ -513,6 +526,7 @@ def plot_results(file='path/to/results.csv', dir=''):
 
 def profile_idetection(start=0, stop=0, labels=(), save_dir=''):
     # Plot iDetection '*.txt' per-image logs. from utils.plots import *; profile_idetection()
+    plt = pyplot()
     ax = plt.subplots(2, 4, figsize=(12, 6), tight_layout=True)[1].ravel()
     s = ['Images', 'Free Storage (GB)', 'RAM Usage (GB)', 'Battery', 'dt_raw (ms)', 'dt_smooth (ms)', 'real-world FPS']
     files = list(Path(save_dir).glob('frames*.txt'))
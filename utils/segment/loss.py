@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ..general import xywh2xyxy
-from ..loss import FocalLoss, smooth_BCE
+from ..loss import FocalLoss, assign_targets, smooth_BCE
 from ..metrics import bbox_iou
 from ..torch_utils import de_parallel
 from .general import crop_mask
@@ -39,6 +39,7 @@ class ComputeLoss:
         self.nl = m.nl  # number of layers
         self.nm = m.nm  # number of masks
         self.anchors = m.anchors
+        self.grids = {}  # (nl,2) grid sizes per prediction shape
         self.device = device
 
     def __call__(self, preds, targets, masks):  # predictions, targets, model
@@ -118,69 +119,34 @@ class ComputeLoss:
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
-        tcls, tbox, indices, anch, tidxs, xywhn = [], [], [], [], [], []
-        gain = torch.ones(8, device=self.device)  # normalized to gridspace gain
         ai = torch.arange(na, device=self.device).float().view(na, 1).repeat(1, nt)  # same as .repeat_interleave(nt)
         if self.overlap:
             batch = p[0].shape[0]
-            ti = []
-            for i in range(batch):
-                num = (targets[:, 0] == i).sum()  # find number of targets of each image
-                ti.append(torch.arange(num, device=self.device).float().view(1, num).repeat(na, 1) + 1)  # (na, num)
-            ti = torch.cat(ti, 1)  # (na, nt)
+            num = torch.bincount(targets[:, 0].long(), minlength=batch)  # number of targets of each image
+            ti = torch.arange(nt, device=self.device) - (num.cumsum(0) - num).repeat_interleave(num, output_size=nt)
+            ti = (ti.float() + 1).view(1, nt).repeat(na, 1)  # (na, nt) index within image, from 1
         else:
             ti = torch.arange(nt, device=self.device).float().view(1, nt).repeat(na, 1)
         targets = torch.cat((targets.repeat(na, 1, 1), ai[..., None], ti[..., None]), 2)  # append anchor indices
 
-        g = 0.5  # bias
-        off = torch.tensor(
-            [
-                [0, 0],
-                [1, 0],
-                [0, 1],
-                [-1, 0],
-                [0, -1],  # j,k,l,m
-                # [1, 1], [1, -1], [-1, 1], [-1, -1],  # jk,jm,lk,lm
-            ],
-            device=self.device).float() * g  # offsets
-
-        for i in range(self.nl):
-            anchors, shape = self.anchors[i], p[i].shape
-            gain[2:6] = torch.tensor(shape)[[3, 2, 3, 2]]  # xyxy gain
-
-            # Match targets to anchors
-            t = targets * gain  # shape(3,n,7)
-            if nt:
-                # Matches
-                r = t[..., 4:6] / anchors[:, None]  # wh ratio
-                j = torch.max(r, 1 / r).max(2)[0] < self.hyp['anchor_t']  # compare
-                # j = wh_iou(anchors, t[:, 4:6]) > model.hyp['iou_t']  # iou(3,n)=wh_iou(anchors(3,2), gwh(n,2))
-                t = t[j]  # filter
-
-                # Offsets
-                gxy = t[:, 2:4]  # grid xy
-                gxi = gain[[2, 3]] - gxy  # inverse
-                j, k = ((gxy % 1 < g) & (gxy > 1)).T
-                l, m = ((gxi % 1 < g) & (gxi > 1)).T
-                j = torch.stack((torch.ones_like(j), j, k, l, m))
-                t = t.repeat((5, 1, 1))[j]
-                offsets = (torch.zeros_like(gxy)[None] + off[:, None])[j]
-            else:
-                t = targets[0]
-                offsets = 0
-
-            # Define
-            bc, gxy, gwh, at = t.chunk(4, 1)  # (image, class), grid xy, grid wh, anchors
-            (a, tidx), (b, c) = at.long().T, bc.long().T  # anchors, image, class
-            gij = (gxy - offsets).long()
-            gi, gj = gij.T  # grid indices
-
-            # Append
-            indices.append((b, a, gj.clamp_(0, shape[2] - 1), gi.clamp_(0, shape[3] - 1)))  # image, anchor, grid
-            tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-            anch.append(anchors[a])  # anchors
-            tcls.append(c)  # class
-            tidxs.append(tidx)
-            xywhn.append(torch.cat((gxy, gwh), 1) / gain[2:6])  # xywh normalized
-
+        # Match targets to anchors and grid cells of all layers
+        shape = tuple(x.shape[2:4] for x in p)  # (ny, nx) per layer
+        if shape not in self.grids:
+            self.grids[shape] = torch.tensor([(nx, ny) for ny, nx in shape], device=self.device).float()
+        grid = self.grids[shape]
+        t, offsets, i, n = assign_targets(targets, self.anchors, grid, self.hyp['anchor_t'])
+
+        # Define
+        bc, gxy, gwh, at = t.chunk(4, 1)  # (image, class), grid xy, grid wh, anchors
+        (a, tidx), (b, c) = at.long().T, bc.long().T  # anchors, image, class
+        gij = torch.minimum((gxy - offsets).long().clamp_(0), grid.long()[i] - 1)
+        gi, gj = gij.T  # grid indices
+
+        # Split by layer
+        indices = list(zip(b.split(n), a.split(n), gj.split(n), gi.split(n)))  # image, anchor, grid
+        tbox = list(torch.cat((gxy - gij, gwh), 1).split(n))  # box
+        anch = list(self.anchors[i, a].split(n))  # anchors
+        tcls = list(c.split(n))  # class
+        tidxs = list(tidx.split(n))
+        xywhn = list((torch.cat((gxy, gwh), 1) / grid.repeat(1, 2)[i]).split(n))  # xywh normalized
         return tcls, tbox, indices, anch, tidxs, xywhn
@@ -0,0 +1,233 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Batching inference server: coalesce concurrent image requests into dynamic DetectMultiBackend batches
+
+Usage - Python, from any number of threads or asyncio tasks:
+    from utils.serving import BatchServer
+
+    server = BatchServer('yolov5s.pt', max_batch=16, max_wait=5)
+    results = server(im)  # Detections, blocks until its batch is done
+    future = server.submit(im)  # concurrent.futures.Future of Detections
+    results = await server.infer(im)  # asyncio
+
+Usage - HTTP or Unix-socket endpoint and load generator:
+    $ python serve.py --help
+"""
+
+import asyncio
+import http.client
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from models.common import AutoShape, DetectMultiBackend
+from utils.torch_utils import select_device
+
+DETECTION_URL = '/v1/object-detection'
+
+
+class BatchServer:
+    """In-process inference service forming dynamic batches from concurrent requests.
+
+    Requests are queued by any number of callers. A single worker thread takes the oldest request and waits up to
+    `max_wait` ms for more, up to `max_batch`, then runs one AutoShape pre-process, DetectMultiBackend forward and NMS
+    for the whole batch and resolves every request with its own single-image Detections. Requests of different sizes
+    are batched separately. AutoShape letterboxes a batch to its largest image, so detections can differ slightly from
+    a single-image call depending on which requests share the batch.
+
+    Args:
+        weights: model path, DetectMultiBackend or AutoShape model
+        device: cuda device, i.e. 0 or 0,1,2,3 or cpu
+        size: default inference size (pixels)
+        max_batch: maximum images per forward
+        max_wait: maximum time the oldest request waits for a batch to fill (ms)
+        half: use FP16 half-precision inference
+        cache: compiled-model cache directory, see DetectMultiBackend
+        kwargs: AutoShape attributes, i.e. conf=0.25, iou=0.45, classes=None, max_det=1000
+    """
+
+    def __init__(self, weights='yolov5s.pt', device='', size=640, max_batch=16, max_wait=5.0, half=False, cache=None,
+                 **kwargs):
+        model = weights
+        if isinstance(model, (str, Path)):
+            model = DetectMultiBackend(model, device=select_device(device), fp16=half, cache=cache)
+        self.model = model if isinstance(model, AutoShape) else AutoShape(model, verbose=False)
+        for k, v in kwargs.items():
+            setattr(self.model, k, v)
+        self.size, self.max_batch, self.max_wait = size, max_batch, max_wait
+        self.queue = queue.Queue()
+        self.batches = self.images = 0  # forwards and images served
+        self.closed = False
+        self.lock = threading.Lock()  # no requests queued after close()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, im, size=None):
+        # Queue one image (any AutoShape input except torch tensors), return a Future of its Detections
+        f = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('BatchServer is closed')
+            self.queue.put((im, size or self.size, f))
+        return f
+
+    def __call__(self, im, size=None, timeout=None):
+        return self.submit(im, size).result(timeout)
+
+    async def infer(self, im, size=None):
+        return await asyncio.wrap_future(self.submit(im, size))
+
+    def _run(self):
+        stop = False
+        while not stop:
+            r = self.queue.get()
+            if r is None:
+                break
+            batch, t = [r], time.perf_counter() + self.max_wait / 1E3
+            while len(batch) < self.max_batch:
+                try:
+                    r = self.queue.get(timeout=max(t - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if r is None:
+                    stop = True
+                    break
+                batch.append(r)
+            self._process([r for r in batch if r[2].set_running_or_notify_cancel()])
+
+    def _process(self, batch):
+        for size in dict.fromkeys(r[1] for r in batch):  # unique sizes, in request order
+            b = [r for r in batch if r[1] == size]
+            try:
+                results = self.model([r[0] for r in b], size=size).tolist()
+            except Exception as e:
+                for r in b:
+                    r[2].set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(b)
+            for r, x in zip(b, results):
+                r[2].set_result(x)
+
+    def stats(self):
+        return {'batches': self.batches, 'images': self.images, 'mean batch': self.images / max(self.batches, 1)}
+
+    def close(self):
+        # Serve queued requests and stop the worker, later submit() calls raise RuntimeError
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST an encoded image (jpg, png, ...) to DETECTION_URL, returns xyxy detections as JSON records
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        if self.path.split('?')[0] != DETECTION_URL:
+            return self.send_error(404)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if im is None:
+            return self.send_error(400, 'Image decoding failed')
+        results = self.server.model(im[..., ::-1])  # BGR to RGB
+        body = results.pandas().xyxy[0].to_json(orient='records').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    # http.client connection over a Unix socket
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix)
+
+
+def endpoint(model, address='0.0.0.0:5000'):
+    # Return a threaded HTTP server for BatchServer model on 'host:port' or a Unix socket path, call serve_forever()
+    if ':' in str(address):
+        host, port = str(address).rsplit(':', 1)
+        httpd = ThreadingHTTPServer((host, int(port)), Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        httpd = UnixHTTPServer(str(address), Handler)
+    httpd.model = model
+    return httpd
+
+
+def connect(address):
+    # Return an HTTP connection to 'host:port' or a Unix socket path
+    if ':' in str(address):
+        host, port = str(address).rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=60)
+    return UnixHTTPConnection(str(address))
+
+
+def load(address, data, clients=(1, 4, 16), requests=200):
+    """Load generator: POST encoded image `data` from concurrent clients, return p50/p99 latency vs throughput.
+
+    Args:
+        address: endpoint 'host:port' or Unix socket path
+        data: encoded image bytes
+        clients: concurrent clients, one keep-alive connection each
+        requests: requests per client count
+    """
+    y = []
+    for c in clients:
+        latency, lock, todo = [], threading.Lock(), [requests]
+
+        def client():
+            conn = connect(address)
+            while True:
+                with lock:
+                    if todo[0] <= 0:
+                        break
+                    todo[0] -= 1
+                t = time.perf_counter()
+                conn.request('POST', DETECTION_URL, body=data, headers={'Content-Type': 'application/octet-stream'})
+                r = conn.getresponse()
+                r.read()
+                assert r.status == 200, f'{r.status} {r.reason}'
+                with lock:
+                    latency.append(time.perf_counter() - t)
+            conn.close()
+
+        threads = [threading.Thread(target=client) for _ in range(c)]
+        t = time.perf_counter()
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        dt = time.perf_counter() - t
+        p50, p99 = np.percentile(latency, (50, 99)) * 1E3
+        y.append([c, len(latency) / dt, p50, p99])
+    return pd.DataFrame(y, columns=['clients', 'requests/s', 'p50 (ms)', 'p99 (ms)'])
@@ -21,8 +21,12 @@ Usage - formats:
 
 import argparse
 import json
+import math
 import os
 import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -36,12 +40,13 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from models.yolo import DetectionModel
 from utils.callbacks import Callbacks
-from utils.dataloaders import create_dataloader
+from utils.dataloaders import create_dataloader, prefetch
 from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size, check_requirements,
                            check_yaml, coco80_to_coco91_class, colorstr, increment_path, non_max_suppression,
                            print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
+from utils.metrics import APAccumulator, ConfusionMatrix, ap_per_class, box_iou, match_predictions
 from utils.plots import output_to_target, plot_images, plot_val_study
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -78,20 +83,17 @@ def process_batch(detections, labels, iouv):
     Returns:
         correct (array[N, 10]), for 10 IoU levels
     """
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
     iou = box_iou(labels[:, 1:], detections[:, :4])
     correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    return match_predictions(iou, correct_class, iouv)
+
+
+def update_stats(stats, correct, conf, pcls, tcls):
+    # Add one image's (correct, conf, pcls, tcls) to a stats list, or to an APAccumulator when streaming
+    if isinstance(stats, APAccumulator):
+        stats.update(correct, conf, pcls, tcls)
+    else:
+        stats.append((correct, conf, pcls, tcls))
 
 
 @smart_inference_mode()
@@ -108,6 +110,7 @@ def run(
         workers=8,  # max dataloader workers (per RANK in DDP mode)
         single_cls=False,  # treat as single-class dataset
         augment=False,  # augmented inference
+        tta_wbf=None,  # merge --augment views by weighted box fusion at this IoU, i.e. 0.55
         verbose=False,  # verbose output
         save_txt=False,  # save results to *.txt
         save_hybrid=False,  # save label+prediction hybrid results to *.txt
@@ -118,6 +121,8 @@ def run(
         exist_ok=False,  # existing project/name ok, do not increment
         half=True,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        ap_bins=0,  # streaming mAP with this many confidence bins, 0 for exact ap_per_class()
+        pipeline=False,  # overlap pre-process, inference and NMS/metrics across batches
         model=None,
         dataloader=None,
         save_dir=Path(''),
@@ -143,13 +148,18 @@ def run(
         stride, pt, jit, engine = model.stride, model.pt, model.jit, model.engine
         imgsz = check_img_size(imgsz, s=stride)  # check image size
         half = model.fp16  # FP16 supported on limited backends with CUDA
+        if pt:
+            for m in model.model.modules():
+                if isinstance(m, DetectionModel):
+                    m.tta_wbf = tta_wbf
         if engine:
             batch_size = model.batch_size
         else:
             device = model.device
             if not (pt or jit):
-                batch_size = 1  # export.py models default to batch-size 1
-                LOGGER.info(f'Forcing --batch-size 1 square inference (1,3,{imgsz},{imgsz}) for non-PyTorch models')
+                b = model.batch_size  # export.py models default to batch-size 1, None if exported with --dynamic
+                LOGGER.info(f'Square inference ({batch_size},3,{imgsz},{imgsz}) for non-PyTorch models' +
+                            (f', tiled into batch-size {b} model calls' if b and b != batch_size else ''))
 
         # Data
         data = check_dataset(data)  # check
@@ -192,25 +202,27 @@ def run(
     dt = Profile(), Profile(), Profile()  # profiling times
     loss = torch.zeros(3, device=device)
     jdict, stats, ap, ap_class = [], [], [], []
+    if ap_bins:
+        stats = APAccumulator(nc, niou, ap_bins, device)  # streaming metrics, constant memory
     callbacks.run('on_val_start')
-    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
-    for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
-        callbacks.run('on_val_batch_start')
+    if pipeline:
+        for x in dt:
+            x.cuda = False  # no device syncs, phases overlap
+
+    @smart_inference_mode()  # thread-local, pipeline stages run on worker threads
+    def preprocess(im, targets, paths, shapes):
         with dt[0]:
             if cuda:
                 im = im.to(device, non_blocking=True)
                 targets = targets.to(device)
             im = im.half() if half else im.float()  # uint8 to fp16/32
             im /= 255  # 0 - 255 to 0.0 - 1.0
-            nb, _, height, width = im.shape  # batch size, channels, height, width
+        return im, targets, paths, shapes
 
-        # Inference
-        with dt[1]:
-            preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
-
-        # Loss
-        if compute_loss:
-            loss += compute_loss(train_out, targets)[1]  # box, obj, cls
+    @smart_inference_mode()
+    def postprocess(batch_i, im, targets, paths, shapes, preds):
+        nonlocal seen
+        nb, _, height, width = im.shape  # batch size, channels, height, width
 
         # NMS
         targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
@@ -222,7 +234,8 @@ def run(
                                         labels=lb,
                                         multi_label=True,
                                         agnostic=single_cls,
-                                        max_det=max_det)
+                                        max_det=max_det,
+                                        time_limit=math.inf if pipeline else None)  # runs concurrently if pipelined
 
         # Metrics
         for si, pred in enumerate(preds):
@@ -234,7 +247,7 @@ def run(
 
             if npr == 0:
                 if nl:
-                    stats.append((correct, *torch.zeros((2, 0), device=device), labels[:, 0]))
+                    update_stats(stats, correct, *torch.zeros((2, 0), device=device), labels[:, 0])
                     if plots:
                         confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
                 continue
@@ -253,7 +266,7 @@ def run(
                 correct = process_batch(predn, labelsn, iouv)
                 if plots:
                     confusion_matrix.process_batch(predn, labelsn)
-            stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
+            update_stats(stats, correct, pred[:, 4], pred[:, 5], labels[:, 0])  # (correct, conf, pcls, tcls)
 
             # Save/log
             if save_txt:
@@ -269,13 +282,50 @@ def run(
 
         callbacks.run('on_val_batch_end', batch_i, im, targets, paths, shapes, preds)
 
+    # Pipelined: batch N+1 is prefetched while batch N runs inference and batch N-1 runs NMS and metrics on a thread
+    batches = prefetch(dataloader, preprocess, device=device) if pipeline else dataloader
+    executor, pending = ThreadPoolExecutor(1) if pipeline else None, deque()
+    t0 = time.time()
+    pbar = tqdm(batches, desc=s, total=len(dataloader), bar_format=TQDM_BAR_FORMAT)  # progress bar
+    for batch_i, batch in enumerate(pbar):
+        callbacks.run('on_val_batch_start')
+        im, targets, paths, shapes = batch if pipeline else preprocess(*batch)
+
+        # Inference
+        with dt[1]:
+            preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
+
+        # Loss
+        if compute_loss:
+            loss += compute_loss(train_out, targets)[1]  # box, obj, cls
+
+        # NMS and metrics
+        if pipeline:
+            pending.append(executor.submit(postprocess, batch_i, im, targets, paths, shapes, preds))
+            if len(pending) > 1:
+                pending.popleft().result()  # bound work in flight, raise worker errors
+        else:
+            postprocess(batch_i, im, targets, paths, shapes, preds)
+    if pipeline:
+        for f in pending:
+            f.result()
+        executor.shutdown()
+    t0 = time.time() - t0  # wall-clock time
+
     # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
-        ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
-        mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-    nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
+    if ap_bins:
+        if stats.any():
+            tp, fp, p, r, f1, ap, ap_class = stats.compute(plot=plots, save_dir=save_dir, names=names)
+            ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
+            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+        nt = stats.nt.cpu().numpy()  # number of targets per class
+    else:
+        stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
+        if len(stats) and stats[0].any():
+            tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+            ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
+            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+        nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
 
     # Print results
     pf = '%22s' + '%11i' * 2 + '%11.3g' * 4  # print format
@@ -284,7 +334,7 @@ def run(
         LOGGER.warning(f'WARNING ⚠️ no labels found in {task} set, can not compute metrics without labels')
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and len(ap_class):
         for i, c in enumerate(ap_class):
             LOGGER.info(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
 
@@ -292,7 +342,8 @@ def run(
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     if not training:
         shape = (batch_size, 3, imgsz, imgsz)
-        LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}' % t)
+        LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}, '
+                    f'{seen / t0:.1f} images/s wall-clock' % t)
 
     # Plots
     if plots:
@@ -350,6 +401,7 @@ def parse_opt():
     parser.add_argument('--workers', type=int, default=8, help='max dataloader workers (per RANK in DDP mode)')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta-wbf', nargs='?', type=float, const=0.55, help='--augment weighted box fusion IoU')
     parser.add_argument('--verbose', action='store_true', help='report mAP by class')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
@@ -360,6 +412,8 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--pipeline', action='store_true', help='overlap pre-process, inference and NMS across batches')
+    parser.add_argument('--ap-bins', type=int, default=0, help='streaming constant-memory mAP confidence bins, 0 exact')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     opt.save_json |= opt.data.endswith('coco.yaml')